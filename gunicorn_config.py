@@ -1,10 +1,13 @@
 # Gunicorn config variables
+import os
+
 loglevel = "debug"
 errorlog = "-"  # stderr
 accesslog = "-"  # stdout
 worker_tmp_dir = "/dev/shm"
 graceful_timeout = 120
-timeout = 30
+# Sandboxed extraction jobs are killed before this (see EXTRACTION_TIMEOUT)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
 keepalive = 5
 worker_class = "gthread"
 workers = 4
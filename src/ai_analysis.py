@@ -1,9 +1,16 @@
 from openai import OpenAI
 import os
+import re
 import json
+import hashlib
 import logging
 from datetime import datetime
+import batch_inference
+import llm_cache
+import metrics
 from mongo_handler import store_ai_historical_data
+from redis_handler import redis_client
+from text_filter import VALID_TEXT_FILTER
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -12,10 +19,16 @@ logger = logging.getLogger(__name__)
 
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
+COLUMN_CACHE_TTL = int(os.getenv("COLUMN_CACHE_TTL", 30 * 24 * 3600))  # 30 ngày
+COLUMN_SAMPLE_SIZE = 10
+DEFAULT_MODEL = "gpt-4o-mini"
+# Số lần gửi lại các yêu cầu thất bại của một lô thành lô mới
+BULK_BATCH_RETRIES = int(os.getenv("BULK_BATCH_RETRIES", 2))
+
 
 # Helper function for making OpenAI API calls
 def call_openai_api(
-    system_message, user_message, model="gpt-4o-mini", max_tokens=10, temperature=0
+    system_message, user_message, model=DEFAULT_MODEL, max_tokens=10, temperature=0
 ):
     try:
         response = client.chat.completions.create(
@@ -36,6 +49,92 @@ def call_openai_api(
         return None
 
 
+def is_cacheable(result, validate=None):
+    """Một câu trả lời được cache khi không phải lỗi (None) và đọc được theo `validate`."""
+    return result is not None and (validate is None or validate(result) is not None)
+
+
+def cached_openai_call(function, system_message, user_message, context=None, validate=None, **kwargs):
+    """
+    Gọi OpenAI qua cache hai tầng (LRU trong process, rồi Redis), khóa theo văn
+    bản đã chuẩn hóa, model, hash của system prompt và tham số ngữ cảnh.
+    `validate` đọc câu trả lời và trả về None nếu sai định dạng: câu trả lời
+    đó không được cache (và không được dùng nếu đã nằm trong cache).
+    Trả về (kết quả, lấy_từ_cache); lỗi gọi API (None) không được cache.
+    """
+    model = kwargs.pop("model", DEFAULT_MODEL)
+    key = llm_cache.cache_key(function, model, system_message, user_message, context, **kwargs)
+    result = llm_cache.get_cached(function, key)
+    if is_cacheable(result, validate):
+        return result, True
+
+    result = call_openai_api(system_message, user_message, model=model, **kwargs)
+    if is_cacheable(result, validate):
+        llm_cache.store(function, key, result)
+    return result, False
+
+
+def bulk_openai_calls(function, system_message, texts, context=None, validate=None, **kwargs):
+    """
+    Như cached_openai_call cho cả một danh sách nội dung, dùng cho các công việc
+    lớn chạy offline: các nội dung chưa có trong cache (mỗi nội dung chuẩn hóa
+    một lần) được gửi qua batch_inference thay vì giới hạn tốc độ realtime.
+    Yêu cầu nào của lô thất bại được gửi lại thành một lô mới, tối đa
+    BULK_BATCH_RETRIES lần; sau đó kết quả của nó là None. `validate` như ở
+    cached_openai_call. Với backend "local" cache không được dùng.
+    Trả về danh sách (kết quả, lấy_từ_cache) theo đúng thứ tự `texts`.
+    """
+    model = kwargs.pop("model", DEFAULT_MODEL)
+    keys = [
+        llm_cache.cache_key(function, model, system_message, text, context, **kwargs)
+        for text in texts
+    ]
+    # Câu trả lời offline của backend "local" không phải của model: không đọc
+    # và không ghi cache dùng chung với các lần gọi thật
+    use_cache = batch_inference.BATCH_BACKEND != "local"
+    results = {}
+    pending = {}
+    for text, key in zip(texts, keys):
+        if key in results or key in pending:
+            continue
+        cached = llm_cache.get_cached(function, key) if use_cache else None
+        if is_cacheable(cached, validate):
+            results[key] = (cached, True)
+        else:
+            pending[key] = text
+
+    for attempt in range(BULK_BATCH_RETRIES + 1):
+        if not pending:
+            break
+        if attempt:
+            logger.info(f"Gửi lại {len(pending)} yêu cầu thất bại của '{function}' (lần {attempt}).")
+        custom_ids = {f"{function}-{attempt}-{i}": key for i, key in enumerate(pending)}
+        answers = batch_inference.run_batch(
+            [
+                batch_inference.chat_request(custom_id, system_message, str(pending[key]), model, **kwargs)
+                for custom_id, key in custom_ids.items()
+            ],
+            description=function,
+        )
+        failed = {}
+        for custom_id, key in custom_ids.items():
+            result = answers.get(custom_id)
+            if result is None:
+                failed[key] = pending[key]
+                continue
+            if use_cache and is_cacheable(result, validate):
+                llm_cache.store(function, key, result)
+            results[key] = (result, False)
+        pending = failed
+
+    if pending:
+        logger.warning(f"{len(pending)} yêu cầu '{function}' vẫn thất bại sau {BULK_BATCH_RETRIES} lần gửi lại.")
+    for key in pending:
+        results[key] = (None, False)
+
+    return [results[key] for key in keys]
+
+
 # Analyzes a column based on description
 def analyze_column(description):
     system_message = (
@@ -48,72 +147,343 @@ def analyze_column(description):
         "Chỉ trả về đúng từ 'true' hoặc 'false', không thêm bất kỳ nội dung nào khác."
     )
     result = call_openai_api(system_message, description)
-    return result.lower() == "true"
+    return bool(result) and result.lower() == "true"
+
+
+COLUMN_BATCH_SYSTEM_MESSAGE = (
+    "Bạn là một chuyên gia phân tích dữ liệu về ngân sách nhà nước và quy định lập dự toán chi thường xuyên.\n"
+    "Bạn sẽ nhận được danh sách các cột của một bảng dữ liệu, mỗi cột được đánh số và kèm theo một số giá trị mẫu.\n\n"
+    "Chi thường xuyên bao gồm các nhiệm vụ như: chi cho giáo dục, y tế, an sinh xã hội, quốc phòng, an ninh, "
+    "chi trả lương cho cán bộ công chức, chi phí hành chính, bảo dưỡng cơ sở vật chất, và các hoạt động thường xuyên khác của các cơ quan, tổ chức công lập.\n\n"
+    "Nhiệm vụ của bạn là xác định cột chứa tên các nhiệm vụ của dự toán chi thường xuyên.\n"
+    "Chỉ trả về số thứ tự của cột đó. Nếu không có cột nào phù hợp, trả về 0. Không trả về bất kỳ nội dung nào khác."
+)
+
+
+def describe_column(df, col):
+    """Mô tả một cột bằng tên cột và tối đa 10 giá trị mẫu, trả về '' nếu cột không có chữ."""
+    try:
+        values_list = df[col].dropna().head(COLUMN_SAMPLE_SIZE).tolist()
+    except Exception as e:
+        logger.exception(f"Lỗi khi xử lý cột '{col}': {e}")
+        return ""
+    # Bỏ qua các cột chỉ có số, số tiền hoặc ô trống
+    if not any(VALID_TEXT_FILTER.reason(str(value)) is None for value in values_list):
+        return ""
+    return f'Tên Cột là "{col}" có các giá trị: {values_list}'
+
+
+def column_cache_key(df):
+    """
+    Khóa cache theo chữ ký header (tên các cột), các giá trị mẫu của từng cột
+    (như trong mô tả gửi cho model) và prompt đang dùng. Header chung chung
+    ("Unnamed: n", không có dòng header) không làm các bảng khác nhau trùng khóa.
+    """
+    samples = [
+        [str(value).strip().lower() for value in df.iloc[:, idx].dropna().head(COLUMN_SAMPLE_SIZE)]
+        for idx in range(df.shape[1])
+    ]
+    signature = json.dumps(
+        [[str(col).strip().lower() for col in df.columns], samples, COLUMN_BATCH_SYSTEM_MESSAGE],
+        ensure_ascii=False,
+        default=str,
+    )
+    return f"column_identification:{hashlib.sha1(signature.encode('utf-8')).hexdigest()}"
+
+
+def identify_column_batched(candidates):
+    """
+    Gửi tất cả các cột ứng viên trong một request.
+    Trả về (đã_có_kết_quả, cột); đã_có_kết_quả là False nếu không đọc được câu trả lời.
+    """
+    user_message = "\n".join(
+        f"{idx}. {description}" for idx, (_, description) in enumerate(candidates, start=1)
+    )
+    result = call_openai_api(COLUMN_BATCH_SYSTEM_MESSAGE, user_message, max_tokens=5)
+    match = re.fullmatch(r"\s*(\d+)\s*\.?\s*", result or "")
+    if not match or int(match.group(1)) > len(candidates):
+        logger.debug(f"Không đọc được kết quả xác định cột: {result}")
+        return False, None
+
+    choice = int(match.group(1))
+    return True, (candidates[choice - 1][0] if choice else None)
 
 
 # Analyzes and identifies relevant columns from a DataFrame
 def analyze_and_identify_column(df):
-    column_descriptions = []
+    cache_key = column_cache_key(df)
+    try:
+        cached = redis_client.get(cache_key)
+    except Exception as e:
+        logger.warning(f"Không đọc được cache xác định cột: {e}")
+        cached = None
+    if cached:
+        column = json.loads(cached)["column"]
+        if column is not None and column in df.columns:
+            logger.debug(f"Cột lấy từ cache: {column}")
+            return column
+
+    candidates = []
     for col in df.columns:
+        description = describe_column(df, col)
+        if description:
+            candidates.append((col, description))
+
+    if not candidates:
+        logger.debug("Không có cột nào chứa dữ liệu dạng chữ.")
+        return None
+
+    answered, column = identify_column_batched(candidates)
+    if not answered:
+        # Dự phòng: hỏi từng cột và dừng ngay khi tìm thấy
+        column = next((col for col, desc in candidates if analyze_column(desc)), None)
+    elif column is not None:
+        # Không cache kết quả "không có cột", để lần sau được hỏi lại
         try:
-            values_list = df[col].dropna().head(10).tolist()
-            description = (
-                f'Tên Cột là "{col}" có các giá trị: {values_list}'
-                if values_list
-                else ""
-            )
-            column_descriptions.append(description)
+            redis_client.set(cache_key, json.dumps({"column": column}), ex=COLUMN_CACHE_TTL)
         except Exception as e:
-            logger.exception(f"Lỗi khi xử lý cột '{col}': {e}")
-            column_descriptions.append("")
-
-    potential_columns = {
-        col: analyze_column(desc)
-        for col, desc in zip(df.columns, column_descriptions)
-        if desc
-    }
+            logger.warning(f"Không lưu được cache xác định cột: {e}")
+
+    if column is not None:
+        logger.debug(f"Cột được xác định là: {column}")
+    else:
+        logger.debug("Không xác định được cột nào phù hợp.")
+    return column
+
+
+RELEVANCE_SCORE_SYSTEM_MESSAGE = (
+    "Bạn là một chuyên gia về lập dự toán chi thường xuyên trong ngân sách nhà nước Việt Nam.\n"
+    "Nhiệm vụ của bạn là đánh giá xem liệu nội dung sau có phải là một nhiệm vụ của dự toán chi thường xuyên hay không, dựa trên các tiêu chí sau:\n"
+    "- Phải thuộc hoạt động thường xuyên và liên tục của đơn vị hành chính sự nghiệp bao gồm: giáo dục, y tế, an sinh xã hội, quốc phòng, an ninh, chi trả lương, chi phí hành chính, bảo dưỡng cơ sở vật chất\n"
+    "- Phục vụ cho việc duy trì và vận hành hàng ngày của đơn vị.\n"
+    "- Không bao gồm chi phí đầu tư lớn hoặc mua sắm tài sản cố định.\n"
+    "Hãy suy nghĩ kỹ và đưa ra một đánh giá bằng số từ 1 đến 10, trong đó:\n"
+    "1 - Hoàn toàn không phải là nhiệm vụ chi thường xuyên.\n"
+    "10 - Chắc chắn là nhiệm vụ chi thường xuyên.\n"
+    "Chỉ trả về một con số từ 1 đến 10. không trả về bất cứ văn bản nào khác"
+)
+RELEVANCE_SCORE_MODEL = "ft:gpt-4o-mini-2024-07-18:personal:bumas-estimas-score-2:AAXyMp2C"
+
+# Chấm điểm theo lô: nhiều nội dung được đánh số trong một lần gọi. Model
+# fine-tune chỉ được huấn luyện cho từng nội dung, nên lô dùng model riêng;
+# khi bật chấm theo lô, mọi nội dung đều qua model này để điểm cùng thang.
+SCORE_BATCH_MODEL = os.getenv("SCORE_BATCH_MODEL", DEFAULT_MODEL)
+SCORE_BATCH_TOKENS_PER_ITEM = 6
+RELEVANCE_SCORE_BATCH_SYSTEM_MESSAGE = (
+    "Bạn là một chuyên gia về lập dự toán chi thường xuyên trong ngân sách nhà nước Việt Nam.\n"
+    "Bạn sẽ nhận được một danh sách nội dung, mỗi dòng một nội dung được đánh số.\n"
+    "Với từng nội dung, hãy đánh giá xem đó có phải là một nhiệm vụ của dự toán chi thường xuyên hay không, dựa trên các tiêu chí sau:\n"
+    "- Phải thuộc hoạt động thường xuyên và liên tục của đơn vị hành chính sự nghiệp bao gồm: giáo dục, y tế, an sinh xã hội, quốc phòng, an ninh, chi trả lương, chi phí hành chính, bảo dưỡng cơ sở vật chất\n"
+    "- Phục vụ cho việc duy trì và vận hành hàng ngày của đơn vị.\n"
+    "- Không bao gồm chi phí đầu tư lớn hoặc mua sắm tài sản cố định.\n"
+    "Đánh giá bằng số từ 1 đến 10, trong đó:\n"
+    "1 - Hoàn toàn không phải là nhiệm vụ chi thường xuyên.\n"
+    "10 - Chắc chắn là nhiệm vụ chi thường xuyên.\n"
+    "Trả về đúng một dòng cho mỗi nội dung theo dạng '<số thứ tự>: <điểm>', ví dụ '1: 8', theo đúng thứ tự. "
+    "Không trả về bất cứ văn bản nào khác."
+)
+BATCH_SCORE_LINE_PATTERN = re.compile(r"^\s*(\d+)\s*[:.)]\s*(\d{1,2})\s*$")
 
-    for col, analysis in potential_columns.items():
-        if analysis:
-            logger.debug(f"Cột được xác định là: {col}")
-            return col
 
-    logger.debug("Không xác định được cột nào phù hợp.")
-    return None
+def parse_relevance_score(result):
+    """Đọc điểm 1-10 từ câu trả lời của model; trả về None nếu không đọc được."""
+    result = (result or "").strip()
+    if not result.isdigit() or not 1 <= int(result) <= 10:
+        return None
+    return int(result)
 
 
 # Calculates relevance score using OpenAI
-def calculate_relevance_score(text):
-    system_message = (
-        "Bạn là một chuyên gia về lập dự toán chi thường xuyên trong ngân sách nhà nước Việt Nam.\n"
-        "Nhiệm vụ của bạn là đánh giá xem liệu nội dung sau có phải là một nhiệm vụ của dự toán chi thường xuyên hay không, dựa trên các tiêu chí sau:\n"
-        "- Phải thuộc hoạt động thường xuyên và liên tục của đơn vị hành chính sự nghiệp bao gồm: giáo dục, y tế, an sinh xã hội, quốc phòng, an ninh, chi trả lương, chi phí hành chính, bảo dưỡng cơ sở vật chất\n"
-        "- Phục vụ cho việc duy trì và vận hành hàng ngày của đơn vị.\n"
-        "- Không bao gồm chi phí đầu tư lớn hoặc mua sắm tài sản cố định.\n"
-        "Hãy suy nghĩ kỹ và đưa ra một đánh giá bằng số từ 1 đến 10, trong đó:\n"
-        "1 - Hoàn toàn không phải là nhiệm vụ chi thường xuyên.\n"
-        "10 - Chắc chắn là nhiệm vụ chi thường xuyên.\n"
-        "Chỉ trả về một con số từ 1 đến 10. không trả về bất cứ văn bản nào khác"
-    )
-    result = call_openai_api(
+def calculate_relevance_score(text, default=1):
+    """
+    Chấm điểm một nội dung bằng model fine-tune. Trả về `default` nếu không
+    đọc được điểm từ câu trả lời (lỗi gọi API hoặc sai định dạng).
+    """
+    return calculate_relevance_score_cached(text, default)[0]
+
+
+def calculate_relevance_score_cached(text, default=1):
+    """
+    Như calculate_relevance_score, trả về (điểm, lấy_từ_cache) để chỉ đếm
+    những lần gọi model thật.
+    """
+    system_message = RELEVANCE_SCORE_SYSTEM_MESSAGE
+    result, cached = cached_openai_call(
+        "relevance_score",
         system_message,
         text,
-        model="ft:gpt-4o-mini-2024-07-18:personal:bumas-estimas-score-2:AAXyMp2C",
+        validate=parse_relevance_score,
+        model=RELEVANCE_SCORE_MODEL,
         max_tokens=1,
     )
+    if not cached:
+        store_ai_historical_data(
+            {
+                "system_message": system_message,
+                "user_message": text,
+                "result": result,
+                "timestamp": datetime.now().timestamp(),
+            }
+        )
+    score = parse_relevance_score(result)
+    if score is None:
+        logger.warning(f"Không thể chuyển đổi trọng số: {result!r}")
+        return default, cached
+    return score, cached
+
+
+def parse_batch_scores(result, count):
+    """
+    Đọc điểm của một lô gồm `count` nội dung từ câu trả lời dạng '<số>: <điểm>'.
+    Kiểm tra chặt: chỉ cần một dòng sai dạng hoặc số thứ tự ngoài lô là bỏ cả
+    câu trả lời; số thứ tự lặp lại hoặc điểm ngoài 1-10 bị bỏ.
+    Trả về {số thứ tự: điểm} cho các nội dung đọc được.
+    """
+    scores = {}
+    repeated = set()
+    for line in (result or "").splitlines():
+        if not line.strip():
+            continue
+        match = BATCH_SCORE_LINE_PATTERN.match(line)
+        if not match or not 1 <= int(match.group(1)) <= count:
+            logger.debug(f"Câu trả lời chấm điểm theo lô sai định dạng: {result!r}")
+            return {}
+        index, score = int(match.group(1)), int(match.group(2))
+        if index in scores or index in repeated:
+            repeated.add(index)
+            scores.pop(index, None)
+            continue
+        if 1 <= score <= 10:
+            scores[index] = score
+    return scores
+
+
+def request_batch_scores(texts):
+    """
+    Gửi các nội dung, đánh số từ 1, trong một lần gọi SCORE_BATCH_MODEL với
+    prompt theo lô. Trả về {số thứ tự: điểm} cho các nội dung đọc được.
+    """
+    system_message = RELEVANCE_SCORE_BATCH_SYSTEM_MESSAGE
+    # Mỗi nội dung phải nằm trên một dòng
+    user_message = "\n".join(
+        f"{number}. {' '.join(text.split())}" for number, text in enumerate(texts, start=1)
+    )
+    result = call_openai_api(
+        system_message,
+        user_message,
+        model=SCORE_BATCH_MODEL,
+        max_tokens=SCORE_BATCH_TOKENS_PER_ITEM * len(texts),
+    )
     store_ai_historical_data(
         {
             "system_message": system_message,
-            "user_message": text,
+            "user_message": user_message,
             "result": result,
             "timestamp": datetime.now().timestamp(),
         }
     )
+    return parse_batch_scores(result, len(texts))
+
+
+def calculate_relevance_scores(texts, default=1):
+    """
+    Chấm điểm nhiều nội dung trong một lần gọi API: các nội dung chưa có trong
+    cache được đánh số và gửi cùng nhau. Mọi điểm, kể cả của lô một nội dung
+    và của các lần chấm lại, đều dùng prompt theo lô và SCORE_BATCH_MODEL: thang
+    điểm của model này khác model fine-tune, nên một lần tải lên không được
+    trộn điểm của hai model. Nội dung nào không đọc được điểm được chấm lại
+    riêng; nội dung vẫn lỗi nhận điểm `default` mà không làm hỏng cả lô.
+    Trả về (danh sách điểm theo đúng thứ tự `texts`, số lần gọi API lô và gọi
+    lại, số lần gọi tránh được: nội dung lấy từ cache và nội dung được chấm
+    chung lô ngoài nội dung đầu tiên).
+    """
+    system_message = RELEVANCE_SCORE_BATCH_SYSTEM_MESSAGE
+    scores = [None] * len(texts)
+    keys = [
+        llm_cache.cache_key("relevance_score_batch", SCORE_BATCH_MODEL, system_message, text)
+        for text in texts
+    ]
+    pending = []
+    calls = 0
+    saved = 0
+    for index, key in enumerate(keys):
+        cached = parse_relevance_score(llm_cache.get_cached("relevance_score_batch", key))
+        if cached is not None:
+            scores[index] = cached
+            saved += 1
+        else:
+            pending.append(index)
+
+    if not pending:
+        return scores, calls, saved
+
     try:
-        return int(result) if result.isdigit() else 1
-    except ValueError:
-        logger.exception("Không thể chuyển đổi trọng số.")
-        return 1
+        parsed = request_batch_scores([texts[index] for index in pending])
+    except Exception as e:
+        logger.error(f"Lỗi chấm điểm lô {len(pending)} nội dung: {e}")
+        parsed = {}
+    calls += 1
+    for number, index in enumerate(pending, start=1):
+        if number in parsed:
+            scores[index] = parsed[number]
+            llm_cache.store("relevance_score_batch", keys[index], str(parsed[number]))
+    saved += max(0, len(parsed) - 1)
+
+    fallbacks = [index for index in pending if scores[index] is None] if len(pending) > 1 else []
+    metrics.increment("scoring.batch.calls")
+    metrics.increment("scoring.batch.items", len(pending))
+    metrics.increment("scoring.batch.fallbacks", len(fallbacks))
+    if fallbacks:
+        logger.debug(f"Chấm lại từng nội dung cho {len(fallbacks)}/{len(pending)} nội dung của lô.")
+    for index in fallbacks:
+        try:
+            score = request_batch_scores([texts[index]]).get(1)
+        except Exception as e:
+            logger.error(f"Lỗi chấm điểm nội dung '{texts[index]}': {e}")
+            score = None
+        if score is not None:
+            scores[index] = score
+            llm_cache.store("relevance_score_batch", keys[index], str(score))
+    calls += len(fallbacks)
+
+    for index in pending:
+        if scores[index] is None:
+            logger.warning(f"Không đọc được điểm của nội dung '{texts[index]}'.")
+            scores[index] = default
+    return scores, calls, saved
+
+
+def calculate_relevance_scores_bulk(texts):
+    """
+    Chấm điểm một danh sách nội dung bằng model và prompt của
+    calculate_relevance_score, qua batch endpoint (xem bulk_openai_calls).
+    Trả về danh sách điểm theo đúng thứ tự `texts`.
+    """
+    system_message = RELEVANCE_SCORE_SYSTEM_MESSAGE
+    scores = []
+    for text, (result, cached) in zip(
+        texts,
+        bulk_openai_calls(
+            "relevance_score",
+            system_message,
+            texts,
+            validate=parse_relevance_score,
+            model=RELEVANCE_SCORE_MODEL,
+            max_tokens=1,
+        ),
+    ):
+        if not cached:
+            store_ai_historical_data(
+                {
+                    "system_message": system_message,
+                    "user_message": text,
+                    "result": result,
+                    "timestamp": datetime.now().timestamp(),
+                }
+            )
+        score = parse_relevance_score(result)
+        scores.append(score if score is not None else 1)
+    return scores
 
 
 # Determines if the task is relevant
@@ -148,6 +518,22 @@ def calculate_relevance_score_2(text):
     return score
 
 
+SUB_KIND_ITEM_ANSWER_PATTERN = re.compile(r"^\s*(\d{3}\s*(,\s*\d{3}\s*)*)?$")
+SOURCE_CODES = ("12", "13")
+
+
+def parse_sub_kind_items(result):
+    """Đọc danh sách mã khoản ('071, 075') hoặc chuỗi rỗng; trả về None nếu sai định dạng."""
+    result = (result or "").strip().strip("'\"")
+    return result if SUB_KIND_ITEM_ANSWER_PATTERN.match(result) else None
+
+
+def parse_source_code(result):
+    """Đọc mã nguồn '12' hoặc '13'; trả về None nếu sai định dạng."""
+    result = (result or "").strip().strip("'\"")
+    return result if result in SOURCE_CODES else None
+
+
 # Mapping khoản cho từng nhiệm vụ chi thường xuyên
 def sub_kind_item_mapping(text, sub_kind_items, info=None):
     sub_kind_item_message = (
@@ -165,20 +551,24 @@ def sub_kind_item_mapping(text, sub_kind_items, info=None):
         "Lưu ý: chỉ trả về mã số khoản (ví dụ: '071, 075', '072', '073') hoặc để trống nếu không xác định được.\n"
         "Không trả về bất kỳ văn bản hoặc thông tin bổ sung nào khác ngoài mã số khoản."
     )
-    result = call_openai_api(
+    result, cached = cached_openai_call(
+        "sub_kind_item",
         system_message,
         text,
+        context=[sub_kind_items or [], info or []],
+        validate=parse_sub_kind_items,
         model="ft:gpt-4o-mini-2024-07-18:personal:bumas-estimas-ski:AArgHQX1",
         max_tokens=30,
     )
-    store_ai_historical_data(
-        {
-            "system_message": system_message,
-            "user_message": text,
-            "result": result,
-            "timestamp": datetime.now().timestamp(),
-        }
-    )
+    if not cached:
+        store_ai_historical_data(
+            {
+                "system_message": system_message,
+                "user_message": text,
+                "result": result,
+                "timestamp": datetime.now().timestamp(),
+            }
+        )
     return result
 
 
@@ -197,16 +587,24 @@ def source_mapping(text, sources):
         f"{source_message}"
         "Chỉ trả về mã số '12' hoặc '13', không trả về bất kỳ văn bản nào khác."
     )
-    result = call_openai_api(system_message, text, max_tokens=15)
-
-    store_ai_historical_data(
-        {
-            "system_message": system_message,
-            "user_message": text,
-            "result": result,
-            "timestamp": datetime.now().timestamp(),
-        }
+    result, cached = cached_openai_call(
+        "source",
+        system_message,
+        text,
+        context=sources or [],
+        validate=parse_source_code,
+        max_tokens=15,
     )
+
+    if not cached:
+        store_ai_historical_data(
+            {
+                "system_message": system_message,
+                "user_message": text,
+                "result": result,
+                "timestamp": datetime.now().timestamp(),
+            }
+        )
     return result
 
 
@@ -227,7 +625,14 @@ def parent_task_mapping(tasks, task_prediction, num_preceding_tasks=10):
         else max(0, prediction_index - num_preceding_tasks)
     )
 
-    preceding_tasks = tasks[start_index:prediction_index]
+    # Chỉ xét các nhiệm vụ đứng trước trong cùng file và cùng sheet/trang
+    prediction_task = tasks[prediction_index]
+    preceding_tasks = [
+        task
+        for task in tasks[start_index:prediction_index]
+        if task.get("file") == prediction_task.get("file")
+        and task.get("table") == prediction_task.get("table")
+    ]
 
     text = "\n".join(
         f"- {task.get('name', '')}"
@@ -265,19 +670,46 @@ def parent_task_mapping(tasks, task_prediction, num_preceding_tasks=10):
 
 
 # Mapping khoản lĩnh vực giáo dục cho từng nhiệm vụ chi thường xuyên
+SUB_KIND_ITEM_EDUCATION_SYSTEM_MESSAGE = (
+    "Bạn là một chuyên gia về lập dự toán chi thường xuyên ngân sách nhà nước Việt Nam. "
+    "Nhiệm vụ của bạn là xác định liệu nội dung sau thuộc khoản nào trong mục lục ngân sách nhà nước dựa trên các quy tắc sau:\n"
+    "- 'Mầm non', 'Mẫu giáo', '24 tháng đến 36 tháng', hoặc các nhiệm vụ phục vụ cấp mầm non, mẫu giáo: chỉ dùng khoản '071'.\n"
+    "- 'Tiểu học': chỉ dùng khoản '072'.\n"
+    "- 'Trung học', 'THCS': chỉ dùng khoản '073'.\n"
+    "- 'Trung cấp', 'Nghề', 'Trung cấp nghề': chỉ dùng khoản '075'.\n"
+    "- Nhiệm vụ chứa nghị quyết số '8/2022/NQ ngày 15/7/2022': Khoản '074, 075' \n"
+    "- Nhiệm vụ chứa nghị định '116/2016/NĐ-CP ngày 18/7/2016': Khoản '072, 073, 074' \n"
+    "Nếu không xác định được cụ thể, trả về tất cả các khoản '071, 072, 073, 074, 075'."
+)
+
+
+def parse_education_sub_kind_items(result):
+    """
+    Đọc danh sách mã khoản lĩnh vực giáo dục; prompt luôn yêu cầu ít nhất một
+    khoản, nên câu trả lời rỗng cũng là sai định dạng (None).
+    """
+    return parse_sub_kind_items(result) or None
+
+
 def sub_kind_item_education_mapping(text):
-    system_message = (
-        "Bạn là một chuyên gia về lập dự toán chi thường xuyên ngân sách nhà nước Việt Nam. "
-        "Nhiệm vụ của bạn là xác định liệu nội dung sau thuộc khoản nào trong mục lục ngân sách nhà nước dựa trên các quy tắc sau:\n"
-        "- 'Mầm non', 'Mẫu giáo', '24 tháng đến 36 tháng', hoặc các nhiệm vụ phục vụ cấp mầm non, mẫu giáo: chỉ dùng khoản '071'.\n"
-        "- 'Tiểu học': chỉ dùng khoản '072'.\n"
-        "- 'Trung học', 'THCS': chỉ dùng khoản '073'.\n"
-        "- 'Trung cấp', 'Nghề', 'Trung cấp nghề': chỉ dùng khoản '075'.\n"
-        "- Nhiệm vụ chứa nghị quyết số '8/2022/NQ ngày 15/7/2022': Khoản '074, 075' \n"
-        "- Nhiệm vụ chứa nghị định '116/2016/NĐ-CP ngày 18/7/2016': Khoản '072, 073, 074' \n"
-        "Nếu không xác định được cụ thể, trả về tất cả các khoản '071, 072, 073, 074, 075'."
-    )
-    return call_openai_api(system_message, text, max_tokens=15)
+    return call_openai_api(SUB_KIND_ITEM_EDUCATION_SYSTEM_MESSAGE, text, max_tokens=15)
+
+
+def sub_kind_item_education_mapping_bulk(texts):
+    """
+    Xác định khoản lĩnh vực giáo dục cho một danh sách nhiệm vụ qua batch
+    endpoint (xem bulk_openai_calls). Trả về danh sách kết quả theo đúng thứ tự.
+    """
+    return [
+        result
+        for result, _ in bulk_openai_calls(
+            "sub_kind_item_education",
+            SUB_KIND_ITEM_EDUCATION_SYSTEM_MESSAGE,
+            texts,
+            validate=parse_education_sub_kind_items,
+            max_tokens=15,
+        )
+    ]
 
 
 # Filters rows based on a relevance score
@@ -1,15 +1,29 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import uuid
-import redis
 import json
 import logging
 from predict import estimate_data_predict, parent_predict
-from process_and_analyze_data import process_files_and_analyze_data
+from process_and_analyze_data import (
+    PREVIEW_ROWS,
+    preview_files,
+    process_files_and_analyze_data,
+)
 import os
 from functools import wraps
 
+import metrics
 from mongo_handler import store_task_data
+from redis_handler import redis_client
+from upload_store import (
+    append_chunk,
+    complete_upload,
+    create_chunked_upload,
+    load_uploads,
+    save_uploads,
+    upload_status,
+)
+from utils.text_utils import text_hash
 
 app = Flask(__name__)
 CORS(app)
@@ -25,15 +39,11 @@ app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024
 
 ALLOWED_EXTENSIONS = {"xlsx", "xls", "pdf", "png", "jpg", "jpeg"}
 THRESHOLD = int(os.getenv("THRESHOLD", 7))
+# Thời gian giữ điểm theo hash dòng để phân tích lại file tải lên nhiều lần
+ROW_SCORES_TTL = int(os.getenv("ROW_SCORES_TTL", 7 * 24 * 3600))
 
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 API_KEY = os.getenv("API_KEY", "b4d11cc5-826c-48dd-ac2f-b0fa4d4339e2")
 
-# Kết nối tới Redis
-redis_client = redis.StrictRedis(
-    host=REDIS_HOST, port=6379, db=0, decode_responses=True
-)
-
 
 def allowed_file(filename):
     """Kiểm tra định dạng file cho phép"""
@@ -56,6 +66,64 @@ def update_cached_tasks(key, tasks):
     redis_client.set(key, json.dumps(tasks), ex=3600)  # Thời gian hết hạn là 1 giờ
 
 
+def row_scores_key(key):
+    """Khóa Redis lưu điểm theo hash dòng của một session"""
+    return f"row_scores:{key}"
+
+
+def is_model_score(score):
+    """Điểm thật của model là số nguyên 1-10; 0 là nội dung rỗng hoặc chấm lỗi"""
+    try:
+        return 1 <= int(score) <= 10
+    except (TypeError, ValueError):
+        return False
+
+
+def get_row_scores(key):
+    """
+    Lấy điểm các dòng đã phân tích của một session trước, theo hash dòng.
+    Nếu không còn, dựng lại từ danh sách tasks đã cache của session đó.
+    Chỉ điểm thật của model được dùng lại; lỗi Redis thì chấm lại tất cả.
+    """
+    try:
+        row_scores = redis_client.hgetall(row_scores_key(key))
+        if row_scores:
+            return {
+                row_hash: int(score)
+                for row_hash, score in row_scores.items()
+                if is_model_score(score)
+            }
+        return {
+            text_hash(task["name"]): int(task["score"])
+            for task in get_cached_tasks(key)
+            if task.get("name") and is_model_score(task.get("score"))
+        }
+    except Exception as e:
+        logger.warning(f"Không đọc được điểm của session {key}, chấm lại tất cả: {e}")
+        return {}
+
+
+def update_row_scores(key, tasks):
+    """
+    Lưu điểm theo hash dòng của session để các lần tải lên sau dùng lại.
+    Dòng chấm lỗi (điểm 0) không được lưu để lần sau được chấm lại.
+    """
+    row_scores = {
+        text_hash(task["name"]): int(task["score"])
+        for task in tasks
+        if task.get("name") and is_model_score(task.get("score"))
+    }
+    if not row_scores:
+        return
+    try:
+        pipeline = redis_client.pipeline()
+        pipeline.hset(row_scores_key(key), mapping=row_scores)
+        pipeline.expire(row_scores_key(key), ROW_SCORES_TTL)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"Không lưu được điểm theo dòng của session {key}: {e}")
+
+
 def del_cached_tasks(key):
     """Xóa dữ liệu tasks từ Redis"""
     redis_client.delete(key)
@@ -143,17 +211,51 @@ def health():
     return jsonify({"status": "ok"}), 200
 
 
+@app.route("/metrics", methods=["GET"])
+@api_key_required
+def metrics_endpoint():
+    """Trả về các bộ đếm và tỉ lệ cache hit của tất cả các worker"""
+    try:
+        return jsonify(create_result("success", data=metrics.snapshot())), 200
+    except Exception as e:
+        return (
+            jsonify(create_result("error", message=f"Error reading metrics: {str(e)}")),
+            500,
+        )
+
+
 @app.route("/analysis/task", methods=["POST"])
 @api_key_required
 def analysis():
-    """Xử lý phân tích tasks từ file tải lên."""
+    """
+    Xử lý phân tích tasks từ file tải lên.
+    - preview=true: chỉ đọc vài dòng đầu mỗi sheet/bảng, trả về cột được chọn,
+      văn bản mẫu và upload_key.
+    - upload_key: phân tích đầy đủ các file đã tải lên khi preview hoặc tải lên
+      theo từng phần qua /uploads, không cần gửi lại.
+    """
     try:
-        if "file" not in request.files:
+        upload_key = request.form.get("upload_key")
+        if upload_key:
+            status = upload_status(upload_key)
+            if status is not None and not status["complete"]:
+                return (
+                    jsonify(create_result("error", data=status, message="Upload is not complete")),
+                    409,
+                )
+            files = load_uploads(upload_key)
+            if files is None:
+                return (
+                    jsonify(create_result("error", message="Upload not found or expired")),
+                    404,
+                )
+        elif "file" not in request.files:
             return (
                 jsonify(create_result("error", message="No file part in the request")),
                 400,
             )
-        files = request.files.getlist("file")
+        else:
+            files = request.files.getlist("file")
 
         logger.debug(f"Received {len(files)} file(s) for processing.")
         if not files:
@@ -162,8 +264,23 @@ def analysis():
                 400,
             )
 
-        all_results, errors = process_files_and_analyze_data(files)
-   
+        if request.form.get("preview", "").lower() in ("1", "true", "yes"):
+            return preview_analysis(files, upload_key)
+
+        try:
+            # Phân tích lại: dùng lại điểm các dòng không đổi của session trước
+            previous_session_key = request.form.get("previous_session_key")
+            previous_scores = (
+                get_row_scores(previous_session_key) if previous_session_key else None
+            )
+
+            all_results, errors, stats = process_files_and_analyze_data(
+                files, previous_scores
+            )
+        finally:
+            if upload_key:
+                close_files(files)
+
         if not all_results and errors:
             if errors:
                 logger.error(f"No task data found. Errors: {errors}")
@@ -187,6 +304,7 @@ def analysis():
         # Tạo session_key và lưu vào Redis
         session_key = str(uuid.uuid4())
         update_cached_tasks(session_key, all_results)
+        update_row_scores(session_key, all_results)
         # insert data to turning
         store_task_data(all_results)
         
@@ -200,6 +318,10 @@ def analysis():
                         "session_key": session_key,
                         "tasks": remove_duplicate_tasks(all_results),
                         "errors": errors or None,
+                        "reused_rows": stats["reused"],
+                        "rescored_rows": stats["rescored"],
+                        "llm_calls": stats["llm_calls"],
+                        "llm_calls_saved": stats["llm_calls_saved"],
                     },
                     message=(
                         "Data processed successfully"
@@ -218,6 +340,128 @@ def analysis():
         )
 
 
+def close_files(files):
+    """Đóng các file mở từ upload store"""
+    for file in files:
+        file.close()
+
+
+def preview_analysis(files, upload_key=None):
+    """Xem trước cột và văn bản sẽ được chọn, lưu file để phân tích đầy đủ sau"""
+    if upload_key:
+        try:
+            previews, errors = preview_files(files, preview_rows())
+        finally:
+            close_files(files)
+    else:
+        upload_key = save_uploads(files)
+        previews, errors = preview_files(files, preview_rows())
+
+    return (
+        jsonify(
+            create_result(
+                "success" if previews else "error",
+                data={
+                    "upload_key": upload_key,
+                    "previews": previews,
+                    "errors": errors or None,
+                },
+                message="Preview generated" if previews else "No task data found",
+            )
+        ),
+        200 if previews else 404,
+    )
+
+
+def preview_rows():
+    """Số dòng đọc mỗi sheet/bảng khi xem trước"""
+    try:
+        return max(1, int(request.form.get("preview_rows", PREVIEW_ROWS)))
+    except ValueError:
+        return PREVIEW_ROWS
+
+
+@app.route("/uploads", methods=["POST"])
+@api_key_required
+def create_upload():
+    """
+    Tạo một file tải lên theo từng phần (JSON: filename, size, upload_key tùy
+    chọn để thêm file vào upload đã có). Trả về upload_key và file_index.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        upload_key, file_index = create_chunked_upload(
+            data.get("filename"), int(data.get("size") or 0), data.get("upload_key")
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify(create_result("error", message=str(e))), 400
+
+    return (
+        jsonify(
+            create_result(
+                "success",
+                data={"upload_key": upload_key, "file_index": file_index, "offset": 0},
+            )
+        ),
+        201,
+    )
+
+
+@app.route("/uploads/<upload_key>/<int:file_index>", methods=["PUT"])
+@api_key_required
+def upload_chunk(upload_key, file_index):
+    """
+    Ghi một phần của file tại vị trí `offset` (query string); nội dung là thân
+    request. Nếu offset không khớp, trả về 409 kèm offset để tiếp tục tải lên.
+    """
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify(create_result("error", message="Query parameter offset is required")), 400
+
+    try:
+        accepted, received = append_chunk(upload_key, file_index, offset, request.stream)
+    except ValueError as e:
+        status = upload_status(upload_key)
+        return jsonify(create_result("error", data=status, message=str(e))), 404 if status is None else 400
+
+    if not accepted:
+        return (
+            jsonify(
+                create_result(
+                    "error", data={"offset": received}, message="Chunk offset does not match"
+                )
+            ),
+            409,
+        )
+    return jsonify(create_result("success", data={"offset": received})), 200
+
+
+@app.route("/uploads/<upload_key>", methods=["GET"])
+@api_key_required
+def get_upload(upload_key):
+    """Trạng thái upload: số byte đã nhận của từng file"""
+    status = upload_status(upload_key)
+    if status is None:
+        return jsonify(create_result("error", message="Upload not found or expired")), 404
+    return jsonify(create_result("success", data=status)), 200
+
+
+@app.route("/uploads/<upload_key>/complete", methods=["POST"])
+@api_key_required
+def finish_upload(upload_key):
+    """
+    Hoàn tất upload khi mọi file đã nhận đủ; sau đó gửi upload_key tới
+    /analysis/task để phân tích.
+    """
+    try:
+        status = complete_upload(upload_key)
+    except ValueError as e:
+        status = upload_status(upload_key)
+        return jsonify(create_result("error", data=status, message=str(e))), 404 if status is None else 409
+    return jsonify(create_result("success", data=status)), 200
+
+
 @app.route("/analysis/hierarchy/<key>", methods=["POST"])
 @api_key_required
 def analysis_hierarchy(key):
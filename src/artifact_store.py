@@ -0,0 +1,203 @@
+# artifact_store.py
+
+import os
+import json
+import uuid
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import metrics
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Extraction results are kept on local disk, keyed by the sha256 of the
+# uploaded bytes, so a file uploaded again is never parsed or OCRed again.
+# Only the texts of the selected column are stored, with their coordinates,
+# not the full extracted tables
+ARTIFACT_STORE_ENABLED = os.getenv("ARTIFACT_STORE_ENABLED", "true").lower() == "true"
+ARTIFACT_STORE_DIR = os.getenv(
+    "ARTIFACT_STORE_DIR", os.path.join(tempfile.gettempdir(), "bumas_artifacts")
+)
+# Least recently used artifacts are evicted above this size. The store is
+# walked after ARTIFACT_EVICT_EVERY_BYTES of writes or ARTIFACT_EVICT_INTERVAL
+# seconds, not on every write
+ARTIFACT_STORE_MAX_BYTES = int(os.getenv("ARTIFACT_STORE_MAX_BYTES", 1024 * 1024 * 1024))
+ARTIFACT_EVICT_EVERY_BYTES = ARTIFACT_STORE_MAX_BYTES // 20
+ARTIFACT_EVICT_INTERVAL = int(os.getenv("ARTIFACT_EVICT_INTERVAL", 300))
+# Bumped when extraction changes, so older artifacts are no longer read
+ARTIFACT_VERSION = 1
+
+ARTIFACT_SCHEMA = pa.schema(
+    [
+        ("table", pa.string()),
+        ("row", pa.int32()),
+        ("column", pa.int32()),
+        ("text", pa.string()),
+        ("stt", pa.string()),
+    ]
+)
+
+_evict_lock = threading.Lock()
+_last_evict = None
+_written_bytes = 0
+
+
+def content_hash(content):
+    """Return the sha256 of the bytes of an uploaded file."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def artifact_path(file_hash, part=None):
+    """
+    Return the path of the artifact of a file, or of one part of it (a sheet
+    name or a page range).
+    """
+    name = file_hash
+    if part is not None:
+        name += "_" + hashlib.sha256(str(part).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(ARTIFACT_STORE_DIR, f"v{ARTIFACT_VERSION}", file_hash[:2], f"{name}.parquet")
+
+
+def load_artifact(file_hash, part=None):
+    """
+    Read the extracted texts of a file from the store. The Parquet file is
+    memory-mapped and touched, so eviction sees it as recently used.
+
+    :return: Tuple of (valid_texts, errors), or None on a miss.
+    """
+    if not ARTIFACT_STORE_ENABLED:
+        return None
+
+    path = artifact_path(file_hash, part)
+    try:
+        table = pq.read_table(path, memory_map=True)
+        os.utime(path)
+    except FileNotFoundError:
+        metrics.increment("artifact_store.miss")
+        return None
+    except Exception as e:
+        logger.warning(f"Artifact store read failed for {path}: {e}")
+        metrics.increment("artifact_store.miss")
+        return None
+
+    errors = json.loads((table.schema.metadata or {}).get(b"errors", b"[]"))
+    texts = []
+    for cell in table.to_pylist():
+        text_obj = {
+            "id": str(uuid.uuid4()),
+            "name": cell["text"],
+            "table": cell["table"],
+            "row": cell["row"],
+            "column": cell["column"],
+        }
+        if cell["stt"] is not None:
+            text_obj["stt"] = cell["stt"]
+        texts.append(text_obj)
+
+    metrics.increment("artifact_store.hit")
+    logger.debug(f"Artifact store hit for {file_hash} ({part}): {len(texts)} texts.")
+    return texts, errors
+
+
+def store_artifact(file_hash, part, texts, errors):
+    """
+    Write the extracted texts of a file to the store with their cell
+    coordinates. The file is written next to its final path and renamed, so
+    readers never see a partial artifact.
+    """
+    if not ARTIFACT_STORE_ENABLED:
+        return
+
+    path = artifact_path(file_hash, part)
+    table = pa.Table.from_pylist(
+        [
+            {
+                "table": text_obj.get("table"),
+                "row": text_obj.get("row"),
+                "column": text_obj.get("column"),
+                "text": text_obj["name"],
+                "stt": text_obj.get("stt"),
+            }
+            for text_obj in texts
+        ],
+        schema=ARTIFACT_SCHEMA,
+    ).replace_schema_metadata({"errors": json.dumps(errors, ensure_ascii=False)})
+
+    # Threads of one worker may store the same artifact at the same time
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, tmp_path)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Artifact store write failed for {path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+
+    maybe_evict_artifacts(size)
+
+
+def maybe_evict_artifacts(written_bytes):
+    """
+    Run evict_artifacts once ARTIFACT_EVICT_EVERY_BYTES were written by this
+    process since the last run, or ARTIFACT_EVICT_INTERVAL seconds passed.
+    """
+    global _last_evict, _written_bytes
+    with _evict_lock:
+        _written_bytes += written_bytes
+        now = time.monotonic()
+        if (
+            _last_evict is not None
+            and _written_bytes < ARTIFACT_EVICT_EVERY_BYTES
+            and now - _last_evict < ARTIFACT_EVICT_INTERVAL
+        ):
+            return
+        _last_evict = now
+        _written_bytes = 0
+    evict_artifacts()
+
+
+def evict_artifacts():
+    """Delete the least recently used artifacts while the store is above ARTIFACT_STORE_MAX_BYTES."""
+    entries = []
+    total_bytes = 0
+    for root, _, filenames in os.walk(ARTIFACT_STORE_DIR):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # Files being written are skipped, leftovers of a crashed writer are not
+            if filename.endswith(".tmp") and time.time() - stat.st_mtime < ARTIFACT_EVICT_INTERVAL:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+
+    if total_bytes <= ARTIFACT_STORE_MAX_BYTES:
+        return
+
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        metrics.increment("artifact_store.evictions")
+        logger.debug(f"Evicted artifact {path}")
+        if total_bytes <= ARTIFACT_STORE_MAX_BYTES:
+            break
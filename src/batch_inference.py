@@ -0,0 +1,240 @@
+# batch_inference.py
+
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+
+from openai import OpenAI
+
+import metrics
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+# Bulk jobs go through an asynchronous batch endpoint instead of the realtime
+# rate limit: "openai" (Batch API) or "local" (files on disk, for testing)
+BATCH_BACKEND = os.getenv("BATCH_BACKEND", "openai")
+# The local backend never calls the API: every request is answered with this
+# text, unless a responder was installed with set_local_responder
+LOCAL_BATCH_ANSWER = os.getenv("LOCAL_BATCH_ANSWER", "")
+BATCH_DIR = os.getenv("BATCH_DIR", os.path.join(tempfile.gettempdir(), "bumas_batches"))
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))  # Per batch file
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", 30))
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", 25 * 3600))
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def chat_request(custom_id, system_message, user_message, model, max_tokens=10, temperature=0):
+    """
+    Build one line of a batch file: the chat completion that call_openai_api
+    would send, tagged with the id used to join its answer back.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message},
+            ],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": 1,
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+        },
+    }
+
+
+def write_batch_file(requests, description):
+    """Write requests to a JSONL batch file in BATCH_DIR and return its path."""
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    path = os.path.join(BATCH_DIR, f"{description}_{uuid.uuid4().hex}.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    return path
+
+
+def submit_batch(path, description):
+    """Upload a batch file and start the batch. Returns the batch id."""
+    if BATCH_BACKEND == "local":
+        return submit_local_batch(path)
+
+    with open(path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata={"description": description},
+    )
+    return batch.id
+
+
+def retrieve_batch(batch_id):
+    """Return the state of a batch as {"id", "status", "output_file_id", "error_file_id"}."""
+    if BATCH_BACKEND == "local":
+        with open(os.path.join(BATCH_DIR, batch_id, "batch.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    batch = client.batches.retrieve(batch_id)
+    return {
+        "id": batch.id,
+        "status": batch.status,
+        "output_file_id": batch.output_file_id,
+        "error_file_id": batch.error_file_id,
+    }
+
+
+def read_batch_file(file_id):
+    """Return the lines of an output or error file of a batch."""
+    if BATCH_BACKEND == "local":
+        with open(file_id, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = client.files.content(file_id).text
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+_local_responder = None
+
+
+def set_local_responder(responder):
+    """
+    Install the callable that answers the requests of local batches: it gets
+    the request body and returns the answer text, or raises to fail the
+    request. None restores the canned LOCAL_BATCH_ANSWER.
+    """
+    global _local_responder
+    _local_responder = responder
+
+
+def local_completion(body):
+    """Answer one request of a local batch offline, as a chat completion body."""
+    answer = _local_responder(body) if _local_responder is not None else LOCAL_BATCH_ANSWER
+    return {
+        "id": f"local_completion_{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "model": body.get("model"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+def submit_local_batch(path):
+    """
+    Offline stand-in for the Batch API: answer every request of the file with
+    local_completion and write the output file in the Batch API format.
+    The batch is complete when this returns.
+    """
+    batch_id = f"local_batch_{uuid.uuid4().hex}"
+    batch_dir = os.path.join(BATCH_DIR, batch_id)
+    os.makedirs(batch_dir)
+    output_path = os.path.join(batch_dir, "output.jsonl")
+
+    with open(path, encoding="utf-8") as f, open(output_path, "w", encoding="utf-8") as output:
+        for line in f:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                response = {"status_code": 200, "body": local_completion(request["body"])}
+                error = None
+            except Exception as e:
+                response = None
+                error = {"message": str(e)}
+            output.write(json.dumps(
+                {"custom_id": request["custom_id"], "response": response, "error": error},
+                ensure_ascii=False,
+            ) + "\n")
+
+    with open(os.path.join(batch_dir, "batch.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {"id": batch_id, "status": "completed", "output_file_id": output_path, "error_file_id": None}, f
+        )
+    return batch_id
+
+
+def wait_for_batches(batch_ids):
+    """
+    Poll batches every BATCH_POLL_INTERVAL seconds until all of them reached
+    a final status. Raises TimeoutError after BATCH_TIMEOUT seconds.
+    """
+    start_time = time.monotonic()
+    batches = {}
+    while True:
+        for batch_id in batch_ids:
+            if batch_id not in batches or batches[batch_id]["status"] not in BATCH_FINAL_STATUSES:
+                batches[batch_id] = retrieve_batch(batch_id)
+        waiting = [b["id"] for b in batches.values() if b["status"] not in BATCH_FINAL_STATUSES]
+        if not waiting:
+            break
+        if time.monotonic() - start_time > BATCH_TIMEOUT:
+            raise TimeoutError(f"Batches still running after {BATCH_TIMEOUT:.0f}s: {waiting}")
+        logger.info(f"Waiting for {len(waiting)}/{len(batch_ids)} batch(es).")
+        time.sleep(BATCH_POLL_INTERVAL)
+
+    metrics.observe("batch_inference.wait", time.monotonic() - start_time)
+    return [batches[batch_id] for batch_id in batch_ids]
+
+
+def response_content(line):
+    """Return the answer of one output line, or None if the request failed."""
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        return None
+    try:
+        return response["body"]["choices"][0]["message"]["content"].strip()
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def run_batch(requests, description="bulk"):
+    """
+    Run chat requests through the batch endpoint: write them to JSONL batch
+    files of at most BATCH_MAX_REQUESTS lines, submit them, wait until they
+    finish and join the answers back by custom id.
+
+    :param requests: Requests built with chat_request, with unique custom ids.
+    :return: Dictionary of custom id to answer; failed requests map to None.
+    """
+    batch_ids = []
+    for start in range(0, len(requests), BATCH_MAX_REQUESTS):
+        path = write_batch_file(requests[start:start + BATCH_MAX_REQUESTS], description)
+        batch_ids.append(submit_batch(path, description))
+        logger.info(f"Submitted batch {batch_ids[-1]} ({BATCH_BACKEND}) from {path}.")
+
+    answers = {request["custom_id"]: None for request in requests}
+    for batch in wait_for_batches(batch_ids):
+        if batch["status"] != "completed":
+            logger.warning(f"Batch {batch['id']} ended as {batch['status']}.")
+        for file_id in (batch["output_file_id"], batch["error_file_id"]):
+            if not file_id:
+                continue
+            for line in read_batch_file(file_id):
+                if line.get("custom_id") in answers:
+                    answers[line["custom_id"]] = response_content(line)
+
+    failed = sum(answer is None for answer in answers.values())
+    metrics.increment("batch_inference.requests", len(requests))
+    metrics.increment("batch_inference.failed", failed)
+    logger.info(f"Batch '{description}': {len(requests) - failed}/{len(requests)} answers.")
+    return answers
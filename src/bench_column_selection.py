@@ -0,0 +1,84 @@
+# bench_column_selection.py
+
+import random
+import logging
+import argparse
+from io import StringIO
+
+import pandas as pd
+
+import layout_cache
+from bench_utils import time_call
+from process_and_analyze_data import find_best_column_in_dataframe, find_best_column_in_rows
+
+# Configure logging for the benchmark script
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+TASK_WORDS = [
+    "Chi", "lương", "giáo", "viên", "mầm", "non", "tiền", "điện", "nước",
+    "các", "phòng", "học", "hỗ", "trợ", "học sinh", "sửa", "chữa", "trường",
+]
+
+
+def generate_sheet(rows, columns, seed=0):
+    """
+    Build a budget-like sheet: an STT column, one task column and numeric columns.
+    """
+    rng = random.Random(seed)
+    data = {"STT": [str(i + 1) for i in range(rows)]}
+    data["Nội dung"] = [
+        " ".join(rng.choice(TASK_WORDS) for _ in range(rng.randint(3, 8)))
+        for _ in range(rows)
+    ]
+    for col in range(columns - 2):
+        data[f"Số tiền {col + 1}"] = [
+            f"{rng.randint(1, 999)}.{rng.randint(0, 999):03d}" for _ in range(rows)
+        ]
+    return pd.DataFrame(data, dtype=str)
+
+
+def legacy_find_best_column(df):
+    """The former selection: the DataFrame rendered to Markdown and its lines parsed back."""
+    markdown_buffer = StringIO()
+    df.to_markdown(markdown_buffer, index=False)
+    rows = (
+        [item.strip() for item in line.strip("|").split("|")]
+        for line in markdown_buffer.getvalue().splitlines()
+        if line.startswith("|") and not line.startswith("|---")
+    )
+    return find_best_column_in_rows(rows)
+
+
+def run_benchmark(sizes, columns, repeat):
+    """
+    Compare the Markdown round-trip with the DataFrame-native column selection.
+    The layout cache is off: both paths detect the column, without Redis.
+    """
+    layout_cache.LAYOUT_CACHE_ENABLED = False
+    for rows in sizes:
+        df = generate_sheet(rows, columns)
+
+        markdown_ms, markdown_texts = time_call(
+            lambda: legacy_find_best_column(df.fillna("")), repeat
+        )
+        dataframe_ms, dataframe_texts = time_call(
+            lambda: find_best_column_in_dataframe(df), repeat
+        )
+
+        if [t["name"] for t in markdown_texts] != [t["name"] for t in dataframe_texts]:
+            logger.warning(f"Selected texts differ for {rows} rows.")
+
+        logger.info(
+            f"{rows:>7} rows x {columns} cols: markdown {markdown_ms:9.1f} ms, "
+            f"dataframe {dataframe_ms:9.1f} ms, speedup x{markdown_ms / dataframe_ms:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark best-column selection.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--columns", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run_benchmark(args.sizes, args.columns, args.repeat)
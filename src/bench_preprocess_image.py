@@ -0,0 +1,128 @@
+# bench_preprocess_image.py
+
+import logging
+import argparse
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from bench_utils import time_call
+from process_and_analyze_data import load_grayscale_image, normalize_resolution, preprocess_image
+
+# Configure logging for the benchmark script
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Synthetic pages: a 1 MP small scan, an A4 page at 300 DPI and a 12 MP phone photo
+DEFAULT_SIZES = ["1000x1000", "2480x3508", "4000x3000"]
+
+
+def generate_table_image(width, height, rows=30, columns=4, seed=0):
+    """
+    Draw a budget-like table on a noisy gray page: a ruled grid with text in
+    every cell and a stamp outside the grid. Returns (image, grid_mask).
+    """
+    rng = np.random.default_rng(seed)
+    image = np.clip(rng.normal(235, 8, (height, width)), 0, 255).astype(np.uint8)
+    grid_mask = np.zeros_like(image)
+
+    left, top = width // 10, height // 8
+    right, bottom = width - width // 10, height - height // 5
+    thickness = max(1, width // 1000)
+    font_scale = width / 2000
+    row_height = (bottom - top) / rows
+    column_edges = np.linspace(left, right, columns + 1).astype(int)
+
+    for row in range(rows + 1):
+        y = int(top + row * row_height)
+        cv2.line(image, (left, y), (right, y), 30, thickness)
+        cv2.line(grid_mask, (left, y), (right, y), 255, thickness)
+    for x in column_edges:
+        cv2.line(image, (int(x), top), (int(x), bottom), 30, thickness)
+        cv2.line(grid_mask, (int(x), top), (int(x), bottom), 255, thickness)
+    for row in range(rows):
+        y = int(top + (row + 0.7) * row_height)
+        for col in range(columns):
+            text = str(row + 1) if col == 0 else "Chi nhiem vu" if col == 1 else "1.250.000"
+            cv2.putText(
+                image, text, (int(column_edges[col]) + 10, y),
+                cv2.FONT_HERSHEY_SIMPLEX, font_scale, 20, thickness,
+            )
+    cv2.circle(image, (right - width // 10, bottom + height // 10), width // 20, 60, thickness * 3)
+    return image, grid_mask
+
+
+def encode_jpeg(image):
+    """Encode an image as the JPEG bytes of an uploaded photo."""
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def legacy_preprocess_image(content):
+    """The former preprocessing: full-size decode, fixed 40 px kernels, PIL round-trip."""
+    image = np.array(Image.open(BytesIO(content)).convert("L"))
+    _, binary_image = cv2.threshold(image, 150, 255, cv2.THRESH_BINARY_INV)
+    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (40, 1))
+    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 40))
+    horizontal_lines = cv2.morphologyEx(binary_image, cv2.MORPH_OPEN, horizontal_kernel, iterations=2)
+    vertical_lines = cv2.morphologyEx(binary_image, cv2.MORPH_OPEN, vertical_kernel, iterations=2)
+    mask = cv2.add(horizontal_lines, vertical_lines)
+    processed_image = cv2.subtract(binary_image, mask)
+    return Image.fromarray(cv2.bitwise_not(processed_image)), mask
+
+
+def current_preprocess_image(content):
+    """The resolution-aware preprocessing, as run before OCR."""
+    image = normalize_resolution(load_grayscale_image(BytesIO(content)))
+    processed, _, _, line_mask = preprocess_image(image)
+    return processed, line_mask
+
+
+def line_quality(line_mask, grid_mask):
+    """
+    Compare a line mask with the drawn grid at the grid's size. Returns
+    (recall, precision): the share of the grid found, and the share of the
+    mask on the grid; the rest are text strokes or stamp arcs that would be
+    erased before OCR.
+    """
+    if line_mask.shape != grid_mask.shape:
+        line_mask = cv2.resize(line_mask, grid_mask.shape[::-1], interpolation=cv2.INTER_NEAREST)
+    kernel = np.ones((5, 5), np.uint8)
+    found = np.count_nonzero(cv2.dilate(line_mask, kernel)[grid_mask > 0])
+    on_grid = np.count_nonzero(line_mask[cv2.dilate(grid_mask, kernel) > 0])
+    recall = found / max(1, np.count_nonzero(grid_mask))
+    precision = on_grid / max(1, np.count_nonzero(line_mask))
+    return recall, precision
+
+
+def run_benchmark(sizes, repeat):
+    """
+    Report, for both preprocessing paths from JPEG bytes to OCR input, ms per
+    input megapixel, the megapixels handed to OCR and the recall/precision
+    of the line mask.
+    """
+    for size in sizes:
+        width, height = (int(value) for value in size.split("x"))
+        image, grid_mask = generate_table_image(width, height)
+        content = encode_jpeg(image)
+        megapixels = width * height / 1e6
+
+        for name, preprocess in (("legacy", legacy_preprocess_image), ("current", current_preprocess_image)):
+            elapsed_ms, (processed, line_mask) = time_call(lambda: preprocess(content), repeat)
+            recall, precision = line_quality(line_mask, grid_mask)
+            ocr_megapixels = np.asarray(processed).size / 1e6
+            logger.info(
+                f"{size:>10} ({megapixels:4.1f} MP) {name:>7}: {elapsed_ms / megapixels:5.1f} ms/MP, "
+                f"{ocr_megapixels:4.1f} MP to OCR, line recall {recall:.0%}, precision {precision:.0%}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark image preprocessing before OCR.")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="WIDTHxHEIGHT")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run_benchmark(args.sizes, args.repeat)
@@ -0,0 +1,14 @@
+# bench_utils.py
+
+from time import perf_counter
+
+
+def time_call(func, repeat):
+    """Return the best wall time in milliseconds over `repeat` runs and the last result."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        best = min(best, perf_counter() - start)
+    return best * 1000, result
@@ -0,0 +1,205 @@
+# excel_reader.py
+
+import logging
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from itertools import islice
+from collections import defaultdict
+from datetime import datetime
+
+from openpyxl import load_workbook
+from openpyxl.utils.cell import range_boundaries
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Constants
+SPREADSHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+MERGE_CELL_TAG = f"{SPREADSHEET_NS}mergeCell"
+SHEET_TAG = f"{SPREADSHEET_NS}sheet"
+WORKBOOK_PART = "xl/workbook.xml"
+WORKBOOK_RELS_PART = "xl/_rels/workbook.xml.rels"
+RELATIONSHIP_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+RELATIONSHIP_TAG = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+
+
+class SheetRow(list):
+    """
+    The cells of a sheet row as strings, with `row_number`: its 0-based
+    position in the sheet, which stays right when empty rows are skipped.
+    """
+
+    __slots__ = ("row_number",)
+
+    def __init__(self, cells, row_number):
+        super().__init__(cells)
+        self.row_number = row_number
+
+
+def format_cell_value(value):
+    """Convert a raw openpyxl cell value to the string pandas would give with dtype=str."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return str(value)
+
+
+def is_empty_sheet(worksheet):
+    """
+    Decide from the sheet's <dimension> metadata whether it can hold a table.
+    Excel and openpyxl both write "A1" for sheets without data.
+    """
+    max_row = worksheet.max_row
+    max_column = worksheet.max_column
+    if max_row is None or max_column is None:
+        # No dimension recorded, the rows have to be read to find out.
+        return False
+    return max_row <= 1 and max_column <= 1
+
+
+def sheet_part_paths(archive):
+    """
+    Map the sheet names of an .xlsx archive to the paths of their XML parts,
+    following the relationships of xl/workbook.xml.
+    """
+    with archive.open(WORKBOOK_PART) as source:
+        workbook = ET.parse(source).getroot()
+    with archive.open(WORKBOOK_RELS_PART) as source:
+        relationships = ET.parse(source).getroot()
+
+    targets = {rel.get("Id"): rel.get("Target") for rel in relationships.iter(RELATIONSHIP_TAG)}
+    paths = {}
+    for sheet in workbook.iter(SHEET_TAG):
+        target = targets.get(sheet.get(RELATIONSHIP_ID))
+        if not target:
+            continue
+        if target.startswith("/"):
+            paths[sheet.get("name")] = target.lstrip("/")
+        else:
+            paths[sheet.get("name")] = posixpath.normpath(posixpath.join(posixpath.dirname(WORKBOOK_PART), target))
+    return paths
+
+
+def read_merged_ranges(archive, part_path):
+    """
+    Collect the merged cell ranges of a sheet from its XML part in the archive.
+    openpyxl does not expose merged cells in read-only mode, so the sheet XML
+    is scanned with iterparse and every element is released once seen.
+    Returns a list of (min_col, min_row, max_col, max_row) tuples.
+    """
+    merged_ranges = []
+    try:
+        source = archive.open(part_path)
+    except KeyError as e:
+        logger.debug(f"Cannot open XML part '{part_path}': {e}")
+        return merged_ranges
+
+    try:
+        for _, element in ET.iterparse(source, events=("end",)):
+            if element.tag == MERGE_CELL_TAG:
+                ref = element.get("ref")
+                if ref:
+                    merged_ranges.append(range_boundaries(ref))
+            element.clear()
+    except ET.ParseError as e:
+        logger.warning(f"Cannot read merged cells of '{part_path}': {e}")
+    finally:
+        source.close()
+
+    return merged_ranges
+
+
+def iter_sheet_rows(worksheet, merged_ranges=None):
+    """
+    Yield the rows of a read-only worksheet as SheetRow lists of strings.
+    Only cells inside a merged range receive the value of its top-left cell;
+    other empty cells stay empty. Fully empty rows are skipped, the
+    `row_number` of each row is its position in the sheet.
+    """
+    ranges_by_start_row = defaultdict(list)
+    for min_col, min_row, max_col, max_row in merged_ranges or []:
+        ranges_by_start_row[min_row].append((min_col, max_col, max_row))
+
+    # Each active range is [min_col, max_col, max_row, value]
+    active_ranges = []
+
+    for row_idx, values in enumerate(worksheet.iter_rows(values_only=True), start=1):
+        row = [format_cell_value(value) for value in values]
+
+        for min_col, max_col, max_row in ranges_by_start_row.pop(row_idx, ()):
+            value = row[min_col - 1] if min_col <= len(row) else ""
+            active_ranges.append([min_col, max_col, max_row, value])
+
+        if active_ranges:
+            for min_col, max_col, _, value in active_ranges:
+                if max_col > len(row):
+                    row.extend([""] * (max_col - len(row)))
+                row[min_col - 1 : max_col] = [value] * (max_col - min_col + 1)
+            active_ranges = [r for r in active_ranges if r[2] > row_idx]
+
+        if any(row):
+            yield SheetRow(row, row_idx - 1)
+
+
+def list_visible_sheet_names(file_stream):
+    """
+    Return the names of the visible sheets of an .xlsx workbook, in workbook
+    order, reading only xl/workbook.xml (shared strings are not loaded).
+    """
+    with zipfile.ZipFile(file_stream) as archive:
+        with archive.open(WORKBOOK_PART) as source:
+            root = ET.parse(source).getroot()
+    return [
+        sheet.get("name")
+        for sheet in root.iter(SHEET_TAG)
+        if sheet.get("state", "visible") == "visible"
+    ]
+
+
+def iter_workbook_sheets(file_stream, sheet_names=None, max_rows=None):
+    """
+    Open an .xlsx workbook in read-only mode and yield (sheet_name, rows) pairs
+    for every visible, non-empty sheet, optionally limited to `sheet_names`.
+    Each rows iterator must be consumed before the next sheet is requested;
+    only one row is held at a time.
+    With `max_rows`, only the first rows of each sheet are read. Merged cells
+    are not expanded then: they are listed after the last row of the sheet
+    XML, and finding them would mean parsing the whole sheet.
+    """
+    workbook = load_workbook(file_stream, read_only=True, data_only=True, keep_links=False)
+    archive = None
+    try:
+        for worksheet in workbook.worksheets:
+            if sheet_names is not None and worksheet.title not in sheet_names:
+                continue
+            if worksheet.sheet_state != "visible":
+                logger.debug(f"Skipping {worksheet.sheet_state} sheet: {worksheet.title}")
+                continue
+            if is_empty_sheet(worksheet):
+                logger.debug(f"Skipping empty sheet: {worksheet.title}")
+                continue
+
+            if max_rows is not None:
+                yield worksheet.title, islice(iter_sheet_rows(worksheet), max_rows)
+                continue
+
+            if archive is None:
+                archive = zipfile.ZipFile(file_stream)
+                part_paths = sheet_part_paths(archive)
+            if worksheet.title in part_paths:
+                merged_ranges = read_merged_ranges(archive, part_paths[worksheet.title])
+            else:
+                logger.debug(f"No XML part found for sheet '{worksheet.title}'.")
+                merged_ranges = []
+            yield worksheet.title, iter_sheet_rows(worksheet, merged_ranges)
+    finally:
+        if archive is not None:
+            archive.close()
+        workbook.close()
@@ -1,16 +1,21 @@
 import pandas as pd
 import os
+import argparse
 from ai_analysis import (
     analyze_and_identify_column,
     calculate_relevance_score,
+    calculate_relevance_scores_bulk,
     filter_rows,
     sub_kind_item_education_mapping,
+    sub_kind_item_education_mapping_bulk,
 )
 from data_processing import process_data
 from utils.hierarchy_utils import assign_hierarchy_order
 
 
-def final(folder_path):
+def final(folder_path, bulk=False):
+    # bulk=True: gửi toàn bộ nội dung qua batch endpoint (batch_inference) thay vì
+    # gọi API từng dòng, để công việc lớn không tranh giới hạn tốc độ realtime
 
     # 1. Xử lý dữ liệu ban đầu từ file Excel
     combined_data_cleaned = process_data(folder_path)
@@ -52,9 +57,14 @@ def final(folder_path):
         print(f"Đã xác định được cột cần xử lý: {identified_column}")
 
         # 4. Sử dụng AI để xác định nhiệm vụ chi thường xuyên đánh trọng số và thêm cột "score"
-        combined_data_cleaned["score"] = combined_data_cleaned[identified_column].apply(
-            calculate_relevance_score
-        )
+        if bulk:
+            combined_data_cleaned["score"] = calculate_relevance_scores_bulk(
+                combined_data_cleaned[identified_column].tolist()
+            )
+        else:
+            combined_data_cleaned["score"] = combined_data_cleaned[identified_column].apply(
+                calculate_relevance_score
+            )
 
         # combined_data_cleaned["is_task"] = combined_data_cleaned[
         #     identified_column
@@ -71,9 +81,14 @@ def final(folder_path):
         print(
             "\n\n\nMapping khoản lĩnh vực giáo dục cho từng nhiệm vụ chi thường xuyên"
         )
-        filtered_data["Khoản"] = filtered_data[identified_column].apply(
-            sub_kind_item_education_mapping
-        )
+        if bulk:
+            filtered_data["Khoản"] = sub_kind_item_education_mapping_bulk(
+                filtered_data[identified_column].tolist()
+            )
+        else:
+            filtered_data["Khoản"] = filtered_data[identified_column].apply(
+                sub_kind_item_education_mapping
+            )
 
         # 7. Đánh lại số thứ tự cha-con
         # if stt_column is not None:
@@ -91,5 +106,10 @@ def final(folder_path):
 
 
 if __name__ == "__main__":
-    folder_path = os.path.join(os.getcwd(), "src", "files")
-    final(folder_path)
+    parser = argparse.ArgumentParser(description="Xử lý và chấm điểm các file dự toán trong thư mục.")
+    parser.add_argument("--folder", default=os.path.join(os.getcwd(), "src", "files"))
+    parser.add_argument(
+        "--bulk", action="store_true", help="Chấm điểm qua batch endpoint (BATCH_BACKEND)."
+    )
+    args = parser.parse_args()
+    final(args.folder, bulk=args.bulk)
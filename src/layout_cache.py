@@ -0,0 +1,156 @@
+# layout_cache.py
+
+import os
+import re
+import json
+import hashlib
+import logging
+
+import metrics
+from redis_handler import redis_client
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Constants
+LAYOUT_CACHE_ENABLED = os.getenv("LAYOUT_CACHE_ENABLED", "true").lower() == "true"
+LAYOUT_CACHE_TTL = int(os.getenv("LAYOUT_CACHE_TTL", 30 * 24 * 3600))  # 30 days
+# Rows read from the top of a sheet to find the header and the STT column
+LAYOUT_SAMPLE_ROWS = int(os.getenv("LAYOUT_SAMPLE_ROWS", 15))
+# Rows used as header when the sheet has no STT column
+DEFAULT_HEADER_ROWS = 3
+# Data rows whose STT values go into the fingerprint
+STT_SHAPE_ROWS = 3
+
+STT_HEADERS = {"stt", "tt", "số tt", "số thứ tự"}
+STT_NUMBER_PATTERN = re.compile(r"^\d{1,3}(?:\.\d{1,2})*$")
+STT_ROMAN_PATTERN = re.compile(r"^[ivxlc]+$", re.IGNORECASE)
+STT_LETTER_PATTERN = re.compile(r"^[a-zđ]$", re.IGNORECASE)
+STT_SYMBOLS = {"-", "+", "*", "•"}
+DIGITS_PATTERN = re.compile(r"\d+")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_header_cell(value):
+    """Lower-case a header cell, collapse whitespace and mask numbers (years, amounts)."""
+    value = WHITESPACE_PATTERN.sub(" ", str(value).strip().lower())
+    return DIGITS_PATTERN.sub("#", value)
+
+
+def stt_class(value):
+    """
+    Classify an STT cell: "D", "D.D"... for numbers, "R" for roman numerals,
+    "L" for single letters, the symbol itself for "-", "+", "*", "•", "_" for
+    empty cells and None for anything that is not an STT value.
+    """
+    value = str(value).strip().rstrip(".")
+    if not value:
+        return "_"
+    if STT_NUMBER_PATTERN.match(value):
+        return ".".join("D" for _ in value.split("."))
+    if STT_ROMAN_PATTERN.match(value):
+        return "R"
+    if STT_LETTER_PATTERN.match(value):
+        return "L"
+    if value in STT_SYMBOLS:
+        return value
+    return None
+
+
+def find_stt_column(rows):
+    """
+    Return the index of the STT (hierarchy) column in the sample rows, or None.
+    A column headed "STT" wins; otherwise the leftmost column with the most
+    STT-like values, if it has at least two.
+    """
+    stt_counts = {}
+    for row in rows:
+        for col_idx, value in enumerate(row):
+            if normalize_header_cell(value) in STT_HEADERS:
+                return col_idx
+            if stt_class(value) not in (None, "_"):
+                stt_counts[col_idx] = stt_counts.get(col_idx, 0) + 1
+
+    if not stt_counts:
+        return None
+    best_column = max(sorted(stt_counts), key=stt_counts.get)
+    return best_column if stt_counts[best_column] >= 2 else None
+
+
+def layout_fingerprint(sample_rows):
+    """
+    Fingerprint the layout of a table from its first rows: the normalized
+    header rows, the column count, the STT column and the STT shape of the
+    first data rows. Returns (fingerprint, stt_column); the fingerprint is
+    None when the sample has no header text to recognise a template by.
+    """
+    sample_rows = [[str(value) for value in row] for row in sample_rows]
+    column_count = max((len(row) for row in sample_rows), default=0)
+    stt_column = find_stt_column(sample_rows)
+
+    header_end = min(DEFAULT_HEADER_ROWS, len(sample_rows))
+    if stt_column is not None:
+        for row_idx, row in enumerate(sample_rows):
+            value = row[stt_column] if stt_column < len(row) else ""
+            if stt_class(value) not in (None, "_"):
+                header_end = row_idx
+                break
+
+    header = [[normalize_header_cell(value) for value in row] for row in sample_rows[:header_end]]
+    if not any(value for row in header for value in row):
+        return None, stt_column
+
+    stt_shape = [
+        stt_class(row[stt_column]) if stt_column < len(row) else "_"
+        for row in sample_rows[header_end : header_end + STT_SHAPE_ROWS]
+    ] if stt_column is not None else []
+
+    payload = json.dumps(
+        [column_count, stt_column, header, stt_shape], ensure_ascii=False
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest(), stt_column
+
+
+def layout_cache_key(scope, fingerprint):
+    """Build the Redis key; `scope` separates the column selection strategies."""
+    return f"layout:{scope}:{fingerprint}"
+
+
+def get_cached_layout(scope, fingerprint):
+    """
+    Return the cached layout {"task_column", "hierarchy_column"} for a
+    fingerprint, or None. Hits and misses are counted per scope.
+    """
+    if not LAYOUT_CACHE_ENABLED or fingerprint is None:
+        return None
+
+    try:
+        cached = redis_client.get(layout_cache_key(scope, fingerprint))
+    except Exception as e:
+        logger.warning(f"Layout cache lookup failed: {e}")
+        cached = None
+
+    if cached:
+        metrics.increment(f"layout_cache.{scope}.hit")
+        logger.debug(f"Layout cache hit for {scope} fingerprint {fingerprint}.")
+        return json.loads(cached)
+
+    metrics.increment(f"layout_cache.{scope}.miss")
+    return None
+
+
+def store_layout(scope, fingerprint, task_column, hierarchy_column=None):
+    """Remember the columns chosen for a layout fingerprint."""
+    if not LAYOUT_CACHE_ENABLED or fingerprint is None or task_column is None:
+        return
+
+    layout = {"task_column": task_column, "hierarchy_column": hierarchy_column}
+    try:
+        redis_client.set(
+            layout_cache_key(scope, fingerprint), json.dumps(layout), ex=LAYOUT_CACHE_TTL
+        )
+    except Exception as e:
+        logger.warning(f"Layout cache store failed: {e}")
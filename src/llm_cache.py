@@ -0,0 +1,116 @@
+# llm_cache.py
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+from redis_handler import redis_client
+from utils.text_utils import canonical_text
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Answers of the model are cached per function in this process (LRU) and in
+# Redis, shared by every gunicorn worker and node
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 30 * 24 * 3600))  # 30 days
+LLM_CACHE_LOCAL_SIZE = int(os.getenv("LLM_CACHE_LOCAL_SIZE", 10000))
+# Bumped when the cached values change meaning
+LLM_CACHE_VERSION = 1
+
+
+class LRUCache:
+    """A thread-safe, size-bounded dictionary that drops the least recently used key."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_local_cache = LRUCache(LLM_CACHE_LOCAL_SIZE)
+
+
+def cache_key(function, model, system_message, text, context=None, **params):
+    """
+    Build the cache key of a model call from the canonical text, the model
+    id, a hash of the system prompt, the context arguments of the function
+    (candidate codes, extra instructions...) and the call parameters.
+    """
+    prompt_hash = hashlib.sha256(system_message.encode("utf-8")).hexdigest()
+    signature = json.dumps(
+        [model, prompt_hash, canonical_text(text), context, params],
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    digest = hashlib.sha256(signature.encode("utf-8")).hexdigest()
+    return f"llm_cache:{LLM_CACHE_VERSION}:{function}:{digest}"
+
+
+def get_cached(function, key):
+    """
+    Return the cached answer for a key, looking in this process first, then in
+    Redis. Hits and misses are counted per function.
+    """
+    if not LLM_CACHE_ENABLED:
+        return None
+
+    value = _local_cache.get(key)
+    if value is not None:
+        metrics.increment(f"llm_cache.{function}.hit")
+        metrics.increment(f"llm_cache.{function}.local_hit")
+        return value
+
+    try:
+        value = redis_client.get(key)
+    except Exception as e:
+        logger.warning(f"LLM cache lookup failed: {e}")
+        value = None
+
+    if value is not None:
+        _local_cache.put(key, value)
+        metrics.increment(f"llm_cache.{function}.hit")
+        return value
+
+    metrics.increment(f"llm_cache.{function}.miss")
+    return None
+
+
+def store(function, key, value):
+    """Cache an answer in both tiers. Failed calls (None) are never cached."""
+    if not LLM_CACHE_ENABLED or value is None:
+        return
+
+    _local_cache.put(key, value)
+    try:
+        redis_client.set(key, value, ex=LLM_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"LLM cache store failed for {function}: {e}")
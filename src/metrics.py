@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+import threading
+from collections import defaultdict
+
+from redis_handler import redis_client
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Counters of every gunicorn worker and extraction process are summed in this hash
+METRICS_KEY = os.getenv("METRICS_KEY", "bumas:metrics")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+
+_lock = threading.Lock()
+_pending = defaultdict(float)  # Increments not yet written to Redis
+_local = defaultdict(float)  # Totals of this process, used when Redis is down
+_last_flush = time.monotonic()
+
+
+def increment(name, value=1):
+    """
+    Add `value` to the counter `name`. Counters are buffered in memory and
+    written to Redis at most every METRICS_FLUSH_INTERVAL seconds.
+    """
+    with _lock:
+        _pending[name] += value
+        _local[name] += value
+        flush_due = time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL
+    if flush_due:
+        flush()
+
+
+def observe(name, seconds):
+    """Record one timed operation as `<name>.count` and `<name>.seconds`."""
+    increment(f"{name}.count")
+    increment(f"{name}.seconds", seconds)
+
+
+def flush():
+    """Write buffered increments to Redis; they are kept for later on failure."""
+    global _last_flush
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+
+    if not pending:
+        return
+
+    try:
+        pipeline = redis_client.pipeline()
+        for name, value in pending.items():
+            pipeline.hincrbyfloat(METRICS_KEY, name, value)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"Cannot flush metrics to Redis: {e}")
+        with _lock:
+            for name, value in pending.items():
+                _pending[name] += value
+
+
+def with_rates(counters):
+    """
+    Derive `<name>.hit_rate` for every `<name>.hit` / `<name>.miss` pair and
+    `<name>.fallback_rate` for every `<name>.fallbacks` / `<name>.items` pair.
+    """
+    rates = {}
+    for name, value in counters.items():
+        if name.endswith(".hit"):
+            base = name[: -len(".hit")]
+            total = value + counters.get(f"{base}.miss", 0)
+            rates[f"{base}.hit_rate"] = round(value / total, 4) if total else 0.0
+        elif name.endswith(".fallbacks"):
+            base = name[: -len(".fallbacks")]
+            items = counters.get(f"{base}.items", 0)
+            rates[f"{base}.fallback_rate"] = round(value / items, 4) if items else 0.0
+    return {"counters": counters, "rates": rates}
+
+
+def snapshot():
+    """Return all counters with derived hit rates, aggregated across processes."""
+    flush()
+    try:
+        counters = {
+            name: float(value) for name, value in redis_client.hgetall(METRICS_KEY).items()
+        }
+    except Exception as e:
+        logger.warning(f"Cannot read metrics from Redis, reporting local counters: {e}")
+        with _lock:
+            counters = dict(_local)
+    return with_rates(counters)
@@ -0,0 +1,178 @@
+# ocr_boxes.py
+
+import os
+import json
+import logging
+from bisect import bisect_right
+from collections import defaultdict
+
+import numpy as np
+
+import metrics
+from ocr_pool import OCR_LANG
+from redis_handler import redis_client
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Word boxes of an OCRed image are kept so it can be rebuilt into rows without OCR
+OCR_BOX_CACHE_ENABLED = os.getenv("OCR_BOX_CACHE_ENABLED", "true").lower() == "true"
+OCR_BOX_CACHE_TTL = int(os.getenv("OCR_BOX_CACHE_TTL", 7 * 24 * 3600))  # 7 days
+# Bumped when the box data layout changes
+OCR_BOX_VERSION = 1
+# Whitespace wider than this many word heights separates two columns
+COLUMN_GAP_HEIGHTS = 1.5
+# Words whose centers are closer than this many word heights are on one line
+LINE_TOLERANCE_HEIGHTS = 0.6
+
+
+def ruling_positions(line_mask, axis, min_fill):
+    """
+    Return the positions of ruling lines in a line mask: the centers of the
+    runs of rows (axis=1) or columns (axis=0) filled at least `min_fill`.
+    """
+    profile = np.count_nonzero(line_mask, axis=axis)
+    filled = np.flatnonzero(profile >= line_mask.shape[axis] * min_fill)
+    if not len(filled):
+        return []
+    runs = np.split(filled, np.flatnonzero(np.diff(filled) > 1) + 1)
+    return [int(run.mean()) for run in runs]
+
+
+def box_cache_key(image_hash):
+    """Build the Redis key of the box data of an image."""
+    return f"ocr_boxes:{OCR_BOX_VERSION}:{OCR_LANG}:{image_hash}"
+
+
+def get_cached_boxes(image_hash):
+    """Return the cached box data of an image (by sha256 of its bytes), or None."""
+    if not OCR_BOX_CACHE_ENABLED:
+        return None
+
+    try:
+        cached = redis_client.get(box_cache_key(image_hash))
+    except Exception as e:
+        logger.warning(f"OCR box cache lookup failed: {e}")
+        cached = None
+
+    if cached:
+        metrics.increment("ocr_boxes.hit")
+        logger.debug(f"OCR box cache hit for image {image_hash}.")
+        return json.loads(cached)
+
+    metrics.increment("ocr_boxes.miss")
+    return None
+
+
+def store_boxes(image_hash, box_data):
+    """Cache the box data of an image."""
+    if not OCR_BOX_CACHE_ENABLED:
+        return
+
+    try:
+        redis_client.set(
+            box_cache_key(image_hash),
+            json.dumps(box_data, ensure_ascii=False),
+            ex=OCR_BOX_CACHE_TTL,
+        )
+    except Exception as e:
+        logger.warning(f"OCR box cache store failed: {e}")
+
+
+def whitespace_column_edges(words, min_gap):
+    """
+    Find column boundaries in the x projection of all words: every gap of at
+    least `min_gap` pixels that no word crosses separates two columns.
+    """
+    spans = sorted((word["left"], word["left"] + word["width"]) for word in words)
+    edges = []
+    _, span_right = spans[0]
+    for left, right in spans[1:]:
+        if left - span_right >= min_gap:
+            edges.append((span_right + left) // 2)
+        span_right = max(span_right, right)
+    return edges
+
+
+def cluster_lines(words, tolerance):
+    """Group words into lines by the vertical center of their boxes, top to bottom."""
+    lines = []
+    for word in sorted(words, key=lambda word: word["top"] + word["height"] / 2):
+        center = word["top"] + word["height"] / 2
+        if lines and center - lines[-1]["center"] <= tolerance:
+            line = lines[-1]
+            line["words"].append(word)
+            line["center"] += (center - line["center"]) / len(line["words"])
+        else:
+            lines.append({"center": center, "words": [word]})
+    return [line["words"] for line in lines]
+
+
+def cell_text(words, line_height):
+    """Join the words of a cell line by line, left to right."""
+    words = sorted(
+        words, key=lambda word: (round((word["top"] + word["height"] / 2) / line_height), word["left"])
+    )
+    return " ".join(word["text"] for word in words)
+
+
+def build_table_rows(box_data):
+    """
+    Rebuild the rows and columns of a table from OCR word boxes.
+    Ruling lines found in the image delimit rows and columns when present, so
+    that a wrapped cell stays in one row. Otherwise rows are the text lines
+    and columns are split on whitespace; a line holding a single lower-case
+    fragment continues the cell above it.
+
+    :param box_data: {"words", "rows", "columns"} as produced by OCR, where
+                     rows/columns are the positions of the ruling lines.
+    :return: List of rows, each a list of cell strings.
+    """
+    words = box_data["words"]
+    if not words:
+        return []
+
+    line_height = max(1.0, float(np.median([word["height"] for word in words])))
+    column_edges = box_data.get("columns") or []
+    if len(column_edges) < 2:
+        column_edges = whitespace_column_edges(words, line_height * COLUMN_GAP_HEIGHTS)
+    row_edges = box_data.get("rows") or []
+
+    def column_of(word):
+        return bisect_right(column_edges, word["left"] + word["width"] / 2)
+
+    if len(row_edges) >= 2:
+        row_words = defaultdict(list)
+        for word in words:
+            row_words[bisect_right(row_edges, word["top"] + word["height"] / 2)].append(word)
+        grouped_rows = [row_words[row] for row in sorted(row_words)]
+    else:
+        grouped_rows = cluster_lines(words, line_height * LINE_TOLERANCE_HEIGHTS)
+
+    column_count = len(column_edges) + 1
+    rows = []
+    for row in grouped_rows:
+        cells = defaultdict(list)
+        for word in row:
+            cells[column_of(word)].append(word)
+        rows.append([cell_text(cells[col], line_height) if col in cells else "" for col in range(column_count)])
+
+    if len(row_edges) >= 2:
+        return rows
+
+    merged_rows = []
+    for row in rows:
+        filled = [col for col, value in enumerate(row) if value]
+        if (
+            merged_rows
+            and len(filled) == 1
+            and row[filled[0]][0].islower()
+            and merged_rows[-1][filled[0]]
+        ):
+            merged_rows[-1][filled[0]] += " " + row[filled[0]]
+            continue
+        merged_rows.append(row)
+    return merged_rows
@@ -0,0 +1,311 @@
+# ocr_pool.py
+
+import os
+import time
+import signal
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+import metrics
+
+try:
+    import tesserocr
+except ImportError:  # Falls back to the pytesseract CLI wrapper
+    tesserocr = None
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+OCR_LANG = os.getenv("OCR_LANG", "vie")
+OCR_PSM = 12  # Sparse text with orientation detection, as used for uploaded images
+OCR_LINE_PSM = 7  # A single text line, for line crops OCRed again
+OCR_CONFIG = f"--oem 3 --psm {OCR_PSM}"
+WORD_LEVEL = 5  # Level of words in tesseract TSV output
+# Long-lived OCR processes per gunicorn worker; 0 runs OCR in the calling process
+OCR_POOL_SIZE = int(os.getenv("OCR_POOL_SIZE", min(2, os.cpu_count() or 1)))
+OCR_START_METHOD = os.getenv("OCR_START_METHOD", "forkserver")
+# Seconds an image may spend in a worker, counted from when the worker takes it
+OCR_TIMEOUT = int(os.getenv("OCR_TIMEOUT", 120))
+OCR_START_POLL = 1.0  # Seconds between checks whether a queued image was started
+
+_engine = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+_use_pool = OCR_POOL_SIZE > 0
+# Workers report (task id, pid) on this queue when they start a task; the
+# pool's listener thread records when, so the timeout excludes queueing
+_started_queue = None
+_started = {}  # Task id -> (worker pid, monotonic start time), None while queued
+_started_lock = threading.Lock()
+_task_ids = itertools.count()
+
+
+def get_engine():
+    """
+    Return the tesserocr API of this thread, loading the language model on
+    first use. None when tesserocr is not installed.
+    """
+    if tesserocr is None:
+        return None
+    api = getattr(_engine, "api", None)
+    if api is None:
+        start_time = time.monotonic()
+        api = tesserocr.PyTessBaseAPI(
+            lang=OCR_LANG, psm=OCR_PSM, oem=tesserocr.OEM.DEFAULT
+        )
+        _engine.api = api
+        metrics.observe("ocr_pool.model_load", time.monotonic() - start_time)
+        logger.debug(f"Loaded tesseract model '{OCR_LANG}' in process {os.getpid()}.")
+    return api
+
+
+def set_image(api, image):
+    """Hand a grayscale numpy buffer to tesserocr as raw bytes, without going through PIL."""
+    if isinstance(image, np.ndarray):
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape
+        api.SetImageBytes(image.tobytes(), width, height, 1, width)
+    else:
+        api.SetImage(image)
+
+
+def recognize(image):
+    """
+    OCR a grayscale image (numpy array or PIL image) with the loaded model.
+    Returns (text, seconds spent recognizing).
+    """
+    start_time = time.monotonic()
+    api = get_engine()
+    if api is not None:
+        api.SetPageSegMode(OCR_PSM)
+        set_image(api, image)
+        text = api.GetUTF8Text()
+    else:
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        text = pytesseract.image_to_string(image, lang=OCR_LANG, config=OCR_CONFIG)
+    return text, time.monotonic() - start_time
+
+
+def recognize_words(image, psm=OCR_PSM):
+    """
+    OCR an image and return its words with boxes and confidences, as
+    ([{"text", "conf", "left", "top", "width", "height", "line"}], seconds).
+    `line` numbers the text lines found by tesseract, in reading order.
+    """
+    start_time = time.monotonic()
+    words = []
+    api = get_engine()
+    if api is not None:
+        # The engine is reused, so the mode is set for every image
+        api.SetPageSegMode(psm)
+        set_image(api, image)
+        api.Recognize()
+        iterator = api.GetIterator()
+        line = -1
+        level = tesserocr.RIL.WORD
+        for word in tesserocr.iterate_level(iterator, level) if iterator else []:
+            if word.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                line += 1
+            text = word.GetUTF8Text(level)
+            if not text or not text.strip():
+                continue
+            left, top, right, bottom = word.BoundingBox(level)
+            words.append({
+                "text": text.strip(), "conf": round(word.Confidence(level), 1),
+                "left": left, "top": top, "width": right - left, "height": bottom - top,
+                "line": max(line, 0),
+            })
+    else:
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        data = pytesseract.image_to_data(
+            image, lang=OCR_LANG, config=f"--oem 3 --psm {psm}", output_type=pytesseract.Output.DICT
+        )
+        lines = {}
+        for i, text in enumerate(data["text"]):
+            if int(data["level"][i]) != WORD_LEVEL or not str(text).strip():
+                continue
+            line_key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            words.append({
+                "text": str(text).strip(), "conf": round(float(data["conf"][i]), 1),
+                "left": int(data["left"][i]), "top": int(data["top"][i]),
+                "width": int(data["width"][i]), "height": int(data["height"][i]),
+                "line": lines.setdefault(line_key, len(lines)),
+            })
+    return words, time.monotonic() - start_time
+
+
+def init_ocr_worker(started_queue=None):
+    """Load the language model once when an OCR worker starts."""
+    global _started_queue
+    _started_queue = started_queue
+    get_engine()
+    metrics.increment("ocr_pool.worker_starts")
+    metrics.flush()
+    logger.debug(f"OCR worker {os.getpid()} ready.")
+
+
+def run_started(task_id, task, image, *args):
+    """Worker side of run: report that the task started, then run it."""
+    if _started_queue is not None:
+        _started_queue.put((task_id, os.getpid()))
+    return task(image, *args)
+
+
+def listen_started(started_queue):
+    """Record the start of pool tasks until the pool is replaced (None)."""
+    while (message := started_queue.get()) is not None:
+        task_id, pid = message
+        with _started_lock:
+            # A late message of a finished task is dropped
+            if task_id in _started:
+                _started[task_id] = (pid, time.monotonic())
+
+
+def use_local_engine():
+    """
+    Run OCR in the calling process, e.g. in extraction workers that are
+    long-lived processes themselves and keep their own model loaded.
+    """
+    global _use_pool
+    _use_pool = False
+
+
+def get_pool():
+    """Return the OCR process pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            mp_context = multiprocessing.get_context(OCR_START_METHOD)
+            if OCR_START_METHOD == "forkserver":
+                mp_context.set_forkserver_preload([__name__])
+            started_queue = mp_context.Queue()
+            _pool = ProcessPoolExecutor(
+                max_workers=OCR_POOL_SIZE,
+                mp_context=mp_context,
+                initializer=init_ocr_worker,
+                initargs=(started_queue,),
+            )
+            _pool.started_queue = started_queue
+            threading.Thread(
+                target=listen_started, args=(started_queue,), name="ocr-started", daemon=True
+            ).start()
+            logger.info(f"Started OCR pool with {OCR_POOL_SIZE} worker(s).")
+        return _pool
+
+
+def reset_pool(broken_pool):
+    """Replace a pool whose worker crashed; other threads may have done it already."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken_pool:
+            _pool.shutdown(wait=False)
+            _pool.started_queue.put(None)
+            _pool = None
+            metrics.increment("ocr_pool.restarts")
+            logger.warning("OCR pool broken, it will be restarted.")
+
+
+def wait_for_task(future, task_id):
+    """
+    Wait for a pool task, allowing it OCR_TIMEOUT seconds from when a worker
+    started it; time spent queued behind other images does not count.
+    Raises TimeoutError with the pid of the worker that is still busy.
+    """
+    while True:
+        with _started_lock:
+            started = _started.get(task_id)
+        if started is None:
+            try:
+                return future.result(timeout=OCR_START_POLL)
+            except FutureTimeoutError:
+                continue
+        pid, start_time = started
+        try:
+            return future.result(timeout=max(0.0, OCR_TIMEOUT - (time.monotonic() - start_time)))
+        except FutureTimeoutError:
+            raise FutureTimeoutError(pid)
+
+
+def run(task, image, *args):
+    """
+    Run an OCR task (recognize or recognize_words) through the pool of
+    long-lived workers. A crashed worker restarts the pool and the image is
+    retried once. A worker still on the image OCR_TIMEOUT seconds after it
+    started it is killed and the TimeoutError is raised; the image is not
+    retried. Images in flight on the other workers see the pool break and
+    are retried like after a crash.
+    """
+    if not _use_pool:
+        result, seconds = task(image, *args)
+        metrics.observe("ocr_pool.recognize", seconds)
+        return result
+
+    # Arrays pickle faster than PIL images on the way to the worker
+    image = np.asarray(image)
+    start_time = time.monotonic()
+    for attempt in range(2):
+        pool = get_pool()
+        task_id = next(_task_ids)
+        with _started_lock:
+            _started[task_id] = None
+        try:
+            future = pool.submit(run_started, task_id, task, image, *args)
+            result, seconds = wait_for_task(future, task_id)
+            break
+        except BrokenProcessPool:
+            reset_pool(pool)
+            if attempt:
+                raise
+        except FutureTimeoutError as e:
+            metrics.increment("ocr_pool.timeouts")
+            pid = e.args[0]
+            logger.warning(f"OCR worker {pid} still busy after {OCR_TIMEOUT}s, killing it.")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            reset_pool(pool)
+            raise
+        finally:
+            with _started_lock:
+                _started.pop(task_id, None)
+
+    metrics.observe("ocr_pool.recognize", seconds)
+    # Request time minus recognition time is spent queueing and transferring
+    metrics.observe("ocr_pool.request", time.monotonic() - start_time)
+    return result
+
+
+def image_to_string(image):
+    """
+    OCR an image to plain text.
+
+    :param image: PIL image or numpy array.
+    :return: Recognized text.
+    """
+    return run(recognize, image)
+
+
+def image_to_data(image, psm=OCR_PSM):
+    """
+    OCR an image to words with their boxes and confidences.
+
+    :param image: PIL image or numpy array.
+    :param psm: Tesseract page segmentation mode, OCR_LINE_PSM for one line.
+    :return: List of word dictionaries, see recognize_words.
+    """
+    return run(recognize_words, image, psm)
@@ -0,0 +1,181 @@
+# pdf_triage.py
+
+import os
+import logging
+from collections import Counter
+
+from PyPDF2.generic import ContentStream
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Routes a page can take
+ROUTE_TEXT = "text"  # Plain text layer, no table structure
+ROUTE_LATTICE = "lattice"  # Table drawn with ruling lines
+ROUTE_STREAM = "stream"  # Table laid out with whitespace only
+ROUTE_OCR = "ocr"  # Scanned page, no usable text layer
+ROUTE_SKIP = "skip"  # Blank, cover or signature page
+
+# Characters per 10,000 pt² under which a page has no usable text layer (A4 is ~50 units)
+PDF_TRIAGE_MIN_DENSITY = float(os.getenv("PDF_TRIAGE_MIN_DENSITY", 0.5))
+# Path segments (lines and rectangles) from which a page is treated as a ruled table
+PDF_TRIAGE_LATTICE_MIN_RULES = int(os.getenv("PDF_TRIAGE_LATTICE_MIN_RULES", 12))
+# Text columns (x positions shared by several text runs) that make a whitespace table
+PDF_TRIAGE_STREAM_MIN_COLUMNS = int(os.getenv("PDF_TRIAGE_STREAM_MIN_COLUMNS", 3))
+PDF_TRIAGE_COLUMN_MIN_RUNS = 3
+# Pages with less text than this and no table are covers or signature pages
+PDF_TRIAGE_SKIP_MAX_CHARS = int(os.getenv("PDF_TRIAGE_SKIP_MAX_CHARS", 150))
+# Text runs starting within this many points are in the same column
+COLUMN_TOLERANCE = 4.0
+# Nesting depth followed into form XObjects
+MAX_FORM_DEPTH = 3
+# OCR pages are rasterized one at a time, so they are never merged into ranges
+PAGE_BY_PAGE_ROUTES = {ROUTE_OCR}
+
+TEXT_SHOW_OPERATORS = {b"Tj", b"TJ", b"'", b'"'}
+RULE_OPERATORS = {b"re", b"l"}
+
+
+def count_string_chars(operand):
+    """Count the non-blank characters of a text show operand (a string or a TJ array)."""
+    if isinstance(operand, bytes):
+        operand = operand.decode("latin-1")
+    if isinstance(operand, str):
+        return sum(1 for char in operand if not char.isspace())
+    if isinstance(operand, list):
+        return sum(count_string_chars(item) for item in operand)
+    return 0
+
+
+def scan_content_stream(content, reader, resources, stats, depth=0):
+    """
+    Walk the operators of a content stream and accumulate into `stats` the
+    characters shown, the ruling path segments, the images drawn (and the
+    widest one, in pixels) and the x position of every text run. Form
+    XObjects are followed up to MAX_FORM_DEPTH.
+    """
+    xobjects = resources.get("/XObject", {}) if resources else {}
+    if hasattr(xobjects, "get_object"):
+        xobjects = xobjects.get_object()
+    line_x = 0.0
+
+    for operands, operator in ContentStream(content, reader).operations:
+        if operator == b"BT":
+            line_x = 0.0
+        elif operator == b"Tm":
+            line_x = float(operands[4])
+        elif operator in (b"Td", b"TD"):
+            line_x += float(operands[0])
+        elif operator in TEXT_SHOW_OPERATORS:
+            chars = count_string_chars(operands[-1])
+            if chars:
+                stats["chars"] += chars
+                stats["runs"] += 1
+                stats["run_x"][round(line_x / COLUMN_TOLERANCE)] += 1
+        elif operator in RULE_OPERATORS:
+            stats["rules"] += 1
+        elif operator == b"INLINE IMAGE":
+            stats["images"] += 1
+        elif operator == b"Do":
+            xobject = xobjects.get(operands[0])
+            xobject = xobject.get_object() if xobject is not None else None
+            if xobject is None:
+                continue
+            if xobject.get("/Subtype") == "/Image":
+                stats["images"] += 1
+                stats["image_width"] = max(stats["image_width"], int(xobject.get("/Width", 0)))
+            elif xobject.get("/Subtype") == "/Form" and depth < MAX_FORM_DEPTH:
+                scan_content_stream(
+                    xobject, reader, xobject.get("/Resources", resources), stats, depth + 1
+                )
+
+
+def page_stats(page, reader):
+    """
+    Collect the cheap layout signals of a page without any layout analysis:
+    characters in the text layer, their density, ruling lines, images, the
+    resolution of a full-page scan and the number of text columns.
+    """
+    stats = {"chars": 0, "runs": 0, "rules": 0, "images": 0, "image_width": 0, "run_x": Counter()}
+    content = page.get_contents()
+    if content is not None:
+        resources = page.get("/Resources")
+        resources = resources.get_object() if resources is not None else None
+        scan_content_stream(content, reader, resources, stats)
+
+    width = float(page.mediabox.width)
+    area = width * float(page.mediabox.height)
+    run_x = stats.pop("run_x")
+    # A scan spans the page width, so its pixel width gives the scan DPI
+    stats["image_dpi"] = round(stats.pop("image_width") * 72 / width) if width else 0
+    stats["columns"] = sum(1 for runs in run_x.values() if runs >= PDF_TRIAGE_COLUMN_MIN_RUNS)
+    stats["density"] = round(stats["chars"] / (area / 10000), 2) if area else 0.0
+    return stats
+
+
+def route_page(stats):
+    """Pick the extraction route of a page from its stats."""
+    if stats["density"] < PDF_TRIAGE_MIN_DENSITY:
+        return ROUTE_OCR if stats["images"] else ROUTE_SKIP
+    if stats["rules"] >= PDF_TRIAGE_LATTICE_MIN_RULES:
+        return ROUTE_LATTICE
+    if stats["columns"] >= PDF_TRIAGE_STREAM_MIN_COLUMNS:
+        return ROUTE_STREAM
+    if stats["chars"] < PDF_TRIAGE_SKIP_MAX_CHARS:
+        return ROUTE_SKIP
+    return ROUTE_TEXT
+
+
+def triage_pdf_pages(reader, page_numbers):
+    """
+    Classify pages of a PDF so that only table pages go through camelot.
+    A page that cannot be inspected falls back to the stream route.
+
+    :param reader: PdfReader of the document.
+    :param page_numbers: 1-based page numbers to classify.
+    :return: List of (page_number, route) in the given order.
+    """
+    routes = []
+    for page_number in page_numbers:
+        try:
+            stats = page_stats(reader.pages[page_number - 1], reader)
+            route = route_page(stats)
+        except Exception as e:
+            logger.warning(f"Cannot triage page {page_number} of PDF file, using stream: {e}")
+            stats, route = None, ROUTE_STREAM
+        logger.info(f"PDF page {page_number} routed to {route}: {stats}")
+        routes.append((page_number, route))
+    return routes
+
+
+def group_page_routes(routes, chunk_size):
+    """
+    Merge consecutive pages that share a route into page ranges of at most
+    `chunk_size` pages. Skipped pages are dropped and OCR pages stay alone.
+
+    :return: List of (route, page_range) such as ("lattice", "3-6").
+    """
+    chunk_size = max(1, chunk_size)
+    groups = []
+    for page_number, route in routes:
+        if route == ROUTE_SKIP:
+            continue
+        if groups:
+            last_route, first, last = groups[-1]
+            if (
+                last_route == route
+                and route not in PAGE_BY_PAGE_ROUTES
+                and last == page_number - 1
+                and page_number - first < chunk_size
+            ):
+                groups[-1] = (route, first, page_number)
+                continue
+        groups.append((route, page_number, page_number))
+
+    return [
+        (route, f"{first}-{last}" if last != first else str(first))
+        for route, first, last in groups
+    ]
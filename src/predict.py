@@ -3,6 +3,8 @@ from ai_analysis import sub_kind_item_mapping, source_mapping, parent_task_mappi
 import os
 import logging
 
+import metrics
+
 MAX_CONCURRENT_TASKS = int(os.getenv("MAX_THREADS", 10))
 
 
@@ -19,17 +21,46 @@ def process_task(task, sub_kind_items, sources, info=None):
 
 
 def estimate_data_predict(tasks, sub_kind_items, sources, info=None):
-    """Xử lý tất cả các task sử dụng ThreadPoolExecutor."""
+    """Xử lý tất cả các task sử dụng ThreadPoolExecutor, giữ nguyên thứ tự các task."""
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS) as executor:
-        futures = [executor.submit(process_task, task, sub_kind_items, sources, info) for task in tasks]
-        results = [future.result() for future in concurrent.futures.as_completed(futures)]
+        results = list(
+            executor.map(lambda task: process_task(task, sub_kind_items, sources, info), tasks)
+        )
     return results
 
 
-def process_parent_task(task, tasks):
+def same_table(task, other):
+    """Hai task cùng file và cùng sheet/trang (task không có tọa độ được coi là cùng bảng)."""
+    return task.get("file") == other.get("file") and task.get("table") == other.get("table")
+
+
+def stt_parent(task, tasks, index):
+    """
+    Tìm cha theo STT nhiều cấp (ví dụ '1.2' có cha là '1') trong các task đứng
+    trước cùng bảng, không cần gọi LLM. Trả về None nếu không xác định được.
+    """
+    stt = str(task.get("stt") or "").strip().rstrip(".")
+    if "." not in stt or not stt.replace(".", "").isdigit():
+        return None
+
+    parent_stt = stt.rsplit(".", 1)[0]
+    for previous in reversed(tasks[:index]):
+        if not same_table(task, previous):
+            continue
+        if str(previous.get("stt") or "").strip().rstrip(".") == parent_stt:
+            return previous.get("name", "")
+    return None
+
+
+def process_parent_task(task, tasks, index=None):
     """Xử lý parent task sử dụng đa luồng."""
     try:
-        task["parent"] = parent_task_mapping(tasks, task["name"])
+        parent = stt_parent(task, tasks, index) if index is not None else None
+        if parent is not None:
+            metrics.increment("parent.stt_resolved")
+            task["parent"] = parent
+        else:
+            task["parent"] = parent_task_mapping(tasks, task["name"])
     except Exception as e:
         logging.info(f"Error processing task '{task['name']}': {e}")
         task["parent"] = None
@@ -37,8 +68,15 @@ def process_parent_task(task, tasks):
 
 
 def parent_predict(tasks):
-    """Xử lý parent task sử dụng ThreadPoolExecutor."""
+    """
+    Xử lý parent task sử dụng ThreadPoolExecutor. Các task phải theo thứ tự
+    trong tài liệu; kết quả giữ nguyên thứ tự đó.
+    """
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS) as executor:
-        futures = [executor.submit(process_parent_task, task, tasks) for task in tasks]
-        results = [future.result() for future in concurrent.futures.as_completed(futures)]
+        results = list(
+            executor.map(
+                lambda indexed: process_parent_task(indexed[1], tasks, indexed[0]),
+                enumerate(tasks),
+            )
+        )
     return results
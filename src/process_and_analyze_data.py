@@ -1,24 +1,59 @@
 # process_and_analyze_data.py
 
 import os
-import re
+import mmap
+import time
+import queue
+import signal
+import resource
 import uuid
+import hashlib
 import logging
+import zipfile
 import tempfile
-from io import BytesIO, StringIO
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import subprocess
+import multiprocessing
+from io import BytesIO
+from itertools import chain, islice
+from contextlib import nullcontext
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 import cv2
 import numpy as np
-import pytesseract
 from PIL import Image
 
 import pandas as pd
 import camelot
+from PyPDF2 import PdfReader
 from werkzeug.utils import secure_filename
 
-from ai_analysis import calculate_relevance_score
+import metrics
+import ocr_pool
+from ai_analysis import calculate_relevance_score_cached, calculate_relevance_scores
+from artifact_store import content_hash, load_artifact, store_artifact
+from excel_reader import iter_workbook_sheets, list_visible_sheet_names
+from layout_cache import (
+    LAYOUT_SAMPLE_ROWS,
+    get_cached_layout,
+    layout_fingerprint,
+    store_layout,
+)
+from ocr_boxes import build_table_rows, get_cached_boxes, ruling_positions, store_boxes
+from pdf_triage import (
+    ROUTE_LATTICE,
+    ROUTE_OCR,
+    ROUTE_STREAM,
+    ROUTE_TEXT,
+    group_page_routes,
+    page_stats,
+    triage_pdf_pages,
+)
+from text_filter import TASK_TEXT_FILTER, VALID_TEXT_FILTER
+from utils.near_duplicates import NearDuplicateIndex
+from utils.text_utils import text_hash
 
 # Configure logging
 logging.basicConfig(
@@ -27,71 +62,94 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Constants
-MONEY_PATTERN = re.compile(r"^\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2})?$")
-NUMBER_PATTERN = re.compile(r"^-?\d+[.,]?\d*$")
-EXCLUDE_KEYWORDS = {
-    "unnamed",
-    "phụ biểu",
-    "tạm tính",
-    "xã",
-    "huyện",
-    "tỉnh",
-    "quận",
-    "tổng cộng",
-    "stt",
-}
-KEYWORDS_TO_EXCLUDE = {
-    "chỉ tiêu",
-    "nội dung",
-    "nhiệm vụ",
-    "tổng số",
-    "dự toán chi",
-    "chỉ tiêu xác định dự toán",
-    "gồm",
-    "gồm:",
-    "nhiệm vụ ctx"
-}
-PREFIXES_TO_EXCLUDE = {"đơn vị tính:"}
 ALLOWED_EXTENSIONS = {"xlsx", "xls", "pdf", "png", "jpg", "jpeg"}
 MAX_CONCURRENT_TASKS = int(os.getenv("MAX_THREADS", 10))
-
-START_WORDS_TO_EXCLUDE = {
-    "nguyễn",
-    "trần",
-    "lê",
-    "hoàng",
-    "bùi",
-    "vũ",
-    "hà",
-    "lương",
-    "phạm",
-    "la",
-    "lự",
-    "bàn",
-    "triệu",
-    "ma",
-    "chu",
-    "vi",
-    "lý",
-    "ngô",
-    "đặng",
-    "sầm",
-    "nông",
-    "hứa",
-    "đỗ",
-    "dương",
-    "phùng",
-    "trương",
-    "vàng",
-    "sùng",
-    "vương",
-    "giàng",
-}
-
-START_WORDS_REGEX = re.compile(
-    rf"^(?:{'|'.join(map(re.escape, START_WORDS_TO_EXCLUDE))})\b(?:\s+\w+){{1,3}}$",
-    re.IGNORECASE,
-)
+# "thread" runs extractors in a per-request thread pool; "process" uses a
+# long-lived process pool so pandas, camelot and OpenCV work is not GIL-bound
+# (a crashed worker fails every job pending in the pool, of any request);
+# "sandbox" runs every job in its own child with time and memory limits
+EXTRACTION_BACKEND = os.getenv("EXTRACTION_BACKEND", "thread").lower()
+MAX_EXTRACTION_PROCESSES = int(os.getenv("MAX_PROCESSES", os.cpu_count() or 1))
+EXTRACTION_START_METHOD = os.getenv("EXTRACTION_START_METHOD", "forkserver")
+# Bounded queues between the extraction, filtering and scoring stages: extracted
+# batches (one per file, sheet or page range) and single rows waiting for a score
+EXTRACTED_QUEUE_SIZE = int(os.getenv("EXTRACTED_QUEUE_SIZE", 8))
+SCORE_QUEUE_SIZE = int(os.getenv("SCORE_QUEUE_SIZE", 4 * MAX_CONCURRENT_TASKS))
+# Texts scored per model call. 1 scores every text with the single-text
+# fine-tuned model; above 1 every text of the upload, even a batch of one or
+# a re-score, goes through the batch prompt and SCORE_BATCH_MODEL, because
+# the two models do not share a calibration. A scoring worker waits this
+# many seconds for each further text of a batch
+SCORE_BATCH_SIZE = max(1, int(os.getenv("SCORE_BATCH_SIZE", 1)))
+SCORE_BATCH_WAIT = float(os.getenv("SCORE_BATCH_WAIT", 0.05))
+# A sandboxed job is killed after this many seconds, or when it allocates
+# more than this much memory on top of what the child starts with. The
+# timeout stays below the gunicorn worker timeout (GUNICORN_TIMEOUT), so the
+# job is killed before the worker is
+GUNICORN_TIMEOUT = int(os.getenv("GUNICORN_TIMEOUT", 30))
+EXTRACTION_TIMEOUT = int(os.getenv("EXTRACTION_TIMEOUT", max(1, GUNICORN_TIMEOUT - 5)))
+EXTRACTION_MAX_MEMORY_MB = int(os.getenv("EXTRACTION_MAX_MEMORY_MB", 2048))
+# Extractors turn their errors into messages, except these: the sandbox has
+# to see a MemoryError to report the memory limit of the job
+FATAL_ERRORS = (MemoryError,)
+# Workbooks at least this large are split into one process-pool job per sheet
+SHEET_PARALLEL_MIN_BYTES = int(os.getenv("SHEET_PARALLEL_MIN_BYTES", 2 * 1024 * 1024))
+EXCEL_EXTENSIONS = {"xlsx", "xls"}
+# Texts at least this similar (estimated Jaccard of character 3-grams) share
+# one score. The default 1 only merges texts that are equal after
+# canonicalization: near-duplicates such as "Mua máy tính" and "Mua máy tính
+# bảng" can deserve different scores, so lower it only after checking the
+# score agreement of the merged rows
+DEDUP_SIMILARITY = float(os.getenv("DEDUP_SIMILARITY", 1.0))
+# Where a task comes from: file, sheet or page ("table"), row, column and STT
+TASK_SOURCE_FIELDS = ("file", "table", "row", "column", "stt")
+IMAGE_EXTENSIONS = {"png", "jpg", "jpeg"}
+# PDFs are parsed in page ranges of this size, PDF_PAGE_WORKERS ranges at a time
+PDF_PAGES_PER_CHUNK = int(os.getenv("PDF_PAGES_PER_CHUNK", 4))
+PDF_PAGE_WORKERS = int(os.getenv("PDF_PAGE_WORKERS", 4))
+NO_PDF_TABLES_ERROR = "No tables found in PDF file."
+# Scanned pages are rasterized at the resolution of the scan, clamped to a
+# range that keeps Vietnamese diacritics legible without oversized images
+PDF_OCR_MIN_DPI = int(os.getenv("PDF_OCR_MIN_DPI", 200))
+PDF_OCR_MAX_DPI = int(os.getenv("PDF_OCR_MAX_DPI", 400))
+PDF_OCR_DPI_BUCKET = 50
+PDF_OCR_DEFAULT_DPI = int(os.getenv("PDF_OCR_DEFAULT_DPI", 300))
+GHOSTSCRIPT_TIMEOUT = int(os.getenv("GHOSTSCRIPT_TIMEOUT", 60))
+# Table images are cropped to their ruled grid and OCRed as this many
+# horizontal bands in parallel, cut along ruling lines
+OCR_BANDS = int(os.getenv("OCR_BANDS", 4))
+OCR_MIN_BAND_HEIGHT = 40
+# Line components at least this share of the image size belong to the grid
+TABLE_LINE_MIN_RATIO = 0.2
+# Grids smaller than this share of the image are not cropped to
+TABLE_MIN_AREA_RATIO = 0.1
+# A row of the horizontal line mask this full is a ruling line
+RULING_LINE_MIN_FILL = 0.5
+TABLE_PADDING = 5
+# Lines OCRed below this mean confidence are OCRed again on their own with
+# other binarizations, at most OCR_MAX_RETRY_LINES per image
+OCR_LINE_MIN_CONF = float(os.getenv("OCR_LINE_MIN_CONF", 60))
+OCR_MAX_RETRY_LINES = int(os.getenv("OCR_MAX_RETRY_LINES", 20))
+OCR_RETRY_SCALE = 2.0
+OCR_LINE_PADDING = 4
+# Images are resized so that their long side is in this range before
+# preprocessing; an A4 page rasterized at 300 DPI is left as it is
+PREPROCESS_MIN_SIDE = int(os.getenv("PREPROCESS_MIN_SIDE", 1200))
+PREPROCESS_MAX_SIDE = int(os.getenv("PREPROCESS_MAX_SIDE", 3600))
+# Line detection runs at this scale with kernels spanning this share of the
+# image side (40 px on a 2000 px page at full size, as before)
+LINE_DETECTION_SCALE = 0.5
+LINE_KERNEL_RATIO = 0.02
+LINE_KERNEL_MIN = 8
+BINARY_THRESHOLD = 150
+# Layout cache scope of the "most valid texts" column selection
+LAYOUT_SCOPE = "valid_count"
+# Preview: rows read per sheet/table, sample texts returned, PDF pages parsed
+PREVIEW_ROWS = int(os.getenv("PREVIEW_ROWS", 50))
+PREVIEW_SAMPLE_SIZE = int(os.getenv("PREVIEW_SAMPLE_SIZE", 10))
+PREVIEW_PDF_PAGES = os.getenv("PREVIEW_PDF_PAGES", "1")
+# "streaming" reads .xlsx row by row; "pandas" loads whole sheets as before
+EXCEL_READER_MODE = os.getenv("EXCEL_READER_MODE", "streaming").lower()
 
 
 def allowed_file(filename):
@@ -101,86 +159,220 @@ def allowed_file(filename):
 
 def is_valid_text(text):
     """Determine if the text is valid based on predefined criteria."""
-    if not isinstance(text, str):
-        return False
+    return VALID_TEXT_FILTER.reason(text) is None
 
-    text = text.strip()
 
-    if len(text) < 5:
-        return False
+def build_task_records(cells, table=None, column=None):
+    """
+    Wrap selected cells (row_index, text, stt) into task dictionaries with a
+    unique 'id', the 'name' of the text and its coordinates: the 'table'
+    (sheet, page or image), the 'row' and 'column' in it and the STT value of
+    the row when the table has an STT column.
+    """
+    records = []
+    for row, text, stt in cells:
+        record = {"id": str(uuid.uuid4()), "name": text, "table": table, "row": row, "column": column}
+        if stt is not None:
+            record["stt"] = stt
+        records.append(record)
+    return records
 
-    if MONEY_PATTERN.match(text):
-        return False
 
-    if NUMBER_PATTERN.match(text):
-        return False
+def numbered_rows(rows):
+    """
+    Pair rows with their row index: the `row_number` of sheet rows, whose
+    empty rows were skipped, or else the position in the iterable.
+    """
+    for position, items in enumerate(rows):
+        yield getattr(items, "row_number", position), items
 
-    if text.startswith("-----") or text.startswith(":-----"):
-        return False
 
-    if any(text.lower().startswith(keyword) for keyword in EXCLUDE_KEYWORDS):
-        return False
+def select_best_column_in_rows(rows, remember_layout=True):
+    """
+    Identify the column with the most valid texts in an iterable of rows.
+    Rows are consumed one at a time, so a streamed sheet is never materialized;
+    only the valid strings are kept. When the layout of the first rows is a
+    known template, the cached column is used and no other column is inspected.
+    Returns (best_column, cells) where cells are (row_index, text, stt) for the
+    valid texts; stt is the STT value of the row, if the table has an STT
+    column. best_column is None if nothing is valid.
+    """
+    rows = iter(rows)
+    sample_rows = list(islice(rows, LAYOUT_SAMPLE_ROWS))
+    fingerprint, stt_column = layout_fingerprint(sample_rows)
+    layout = get_cached_layout(LAYOUT_SCOPE, fingerprint)
+    rows = chain(sample_rows, rows)
+
+    def stt_value(items):
+        if stt_column is None or stt_column >= len(items):
+            return None
+        return str(items[stt_column]).strip()
+
+    # A stale layout whose column is not in these rows is detected again
+    if layout is not None and not any(layout["task_column"] < len(items) for items in sample_rows):
+        logger.debug(f"Cached layout column {layout['task_column']} is out of range, detecting again.")
+        layout = None
+
+    if layout is not None:
+        best_column = layout["task_column"]
+        if stt_column == best_column:
+            stt_column = None
+        cells = [
+            (row_idx, items[best_column].strip(), stt_value(items))
+            for row_idx, items in numbered_rows(rows)
+            if best_column < len(items) and is_valid_text(items[best_column])
+        ]
+        logger.debug(f"Cached layout column {best_column} gave {len(cells)} valid texts.")
+        return best_column, cells
+
+    valid_cells_per_column = defaultdict(list)
+
+    for row_idx, items in numbered_rows(rows):
+        stt = stt_value(items)
+        for col_idx, item in enumerate(items):
+            if is_valid_text(item):
+                valid_cells_per_column[col_idx].append((row_idx, item.strip(), stt))
+
+    if not valid_cells_per_column:
+        logger.warning("No valid columns found in rows.")
+        return None, []
 
-    return True
+    # Identify the column with the highest count of valid texts
+    best_column = max(
+        sorted(valid_cells_per_column),
+        key=lambda col_idx: len(valid_cells_per_column[col_idx]),
+    )
+    logger.debug(
+        f"Best column identified: Column {best_column} with {len(valid_cells_per_column[best_column])} valid texts."
+    )
+    if remember_layout:
+        store_layout(LAYOUT_SCOPE, fingerprint, best_column, stt_column)
+
+    cells = valid_cells_per_column[best_column]
+    if stt_column == best_column:
+        cells = [(row_idx, text, None) for row_idx, text, _ in cells]
+    return best_column, cells
 
 
-def convert_dataframe_to_markdown(df):
+def find_best_column_in_rows(rows, table=None):
     """
-    Convert a DataFrame to a Markdown-formatted string.
+    Identify the column with the most valid texts in an iterable of rows.
+    Returns a list of dictionaries with valid texts from the best column.
     """
-    markdown_buffer = StringIO()
-    df.to_markdown(markdown_buffer, index=False)
-    markdown_content = markdown_buffer.getvalue()
-    logger.debug("Converted DataFrame to Markdown.")
-    return markdown_content
+    best_column, cells = select_best_column_in_rows(rows)
+    return build_task_records(cells, table, best_column)
 
 
-def find_best_column_in_markdown(md_string):
+def select_best_column_in_dataframe(df, include_header=True, remember_layout=True):
+    """
+    Identify the column of a DataFrame with the most valid texts without a
+    Markdown round-trip. Valid cells are counted per column first and texts
+    are collected only for the winning column. The header row takes part in
+    the count, as it did in the Markdown table. A cached layout skips the
+    count and only validates the cached column.
+    Returns (best_column, cells) as select_best_column_in_rows does; with
+    `include_header` the header is row 0.
     """
-    Identify the column in the Markdown table with the most valid texts.
+    if df.shape[1] == 0:
+        logger.warning("No valid columns found in DataFrame.")
+        return None, []
+
+    values = df.fillna("").astype(str).to_numpy(dtype=object)
+    header = [str(col) for col in df.columns]
+
+    sample_rows = ([header] if include_header else []) + values[:LAYOUT_SAMPLE_ROWS].tolist()
+    fingerprint, stt_column = layout_fingerprint(sample_rows[:LAYOUT_SAMPLE_ROWS])
+    layout = get_cached_layout(LAYOUT_SCOPE, fingerprint)
+
+    if layout is not None and layout["task_column"] < values.shape[1]:
+        best_column = layout["task_column"]
+        column_mask = VALID_TEXT_FILTER.mask(values[:, best_column])
+        header_valid = include_header and is_valid_text(header[best_column])
+    else:
+        valid_mask = VALID_TEXT_FILTER.mask(values)
+        column_count = valid_mask.sum(axis=0)
+
+        header_mask = np.zeros(len(header), dtype=bool)
+        if include_header:
+            header_mask = np.array([is_valid_text(col) for col in header], dtype=bool)
+            column_count = column_count + header_mask
+
+        best_column = int(np.argmax(column_count))
+        if column_count[best_column] == 0:
+            logger.warning("No valid columns found in DataFrame.")
+            return None, []
+
+        logger.debug(
+            f"Best column identified: Column {best_column} with {column_count[best_column]} valid texts."
+        )
+        if remember_layout:
+            store_layout(LAYOUT_SCOPE, fingerprint, best_column, stt_column)
+        column_mask = valid_mask[:, best_column]
+        header_valid = header_mask[best_column]
+
+    if stt_column == best_column or (stt_column is not None and stt_column >= values.shape[1]):
+        stt_column = None
+    first_row = 1 if include_header else 0
+
+    cells = []
+    if header_valid:
+        stt = header[stt_column].strip() if stt_column is not None else None
+        cells.append((0, header[best_column].strip(), stt))
+    for value_idx in np.flatnonzero(column_mask):
+        stt = values[value_idx, stt_column].strip() if stt_column is not None else None
+        cells.append((first_row + int(value_idx), values[value_idx, best_column].strip(), stt))
+    return best_column, cells
+
+
+def find_best_column_in_dataframe(df, include_header=True, table=None):
+    """
+    Identify the column of a DataFrame with the most valid texts.
     Returns a list of dictionaries with valid texts from the best column.
-    Each dictionary contains a unique 'id' and the 'name' of the text.
-    """
-    column_count = defaultdict(int)
-    valid_texts_per_column = defaultdict(list)
-
-    for line in md_string.splitlines():
-        if line.startswith("|") and not line.startswith("|---"):
-            # Split the line into columns and strip whitespace
-            items = [item.strip() for item in line.strip("|").split("|")]
-
-            for col_idx, item in enumerate(items):
-                if is_valid_text(item):
-                    column_count[col_idx] += 1
-                    valid_texts_per_column[col_idx].append(
-                        {
-                            "id": str(
-                                uuid.uuid4()
-                            ),  # Generate a unique UUID for each text item
-                            "name": item,
-                        }
-                    )
+    """
+    best_column, cells = select_best_column_in_dataframe(df, include_header)
+    return build_task_records(cells, table, best_column)
 
-    if not column_count:
-        logger.warning("No valid columns found in Markdown.")
-        return []
 
-    # Identify the column with the highest count of valid texts
-    best_column = max(column_count, key=column_count.get)
-    logger.debug(
-        f"Best column identified: Column {best_column} with {column_count[best_column]} valid texts."
-    )
+def process_excel_file_streaming(file_stream, sheet_names=None):
+    """
+    Process an .xlsx file row by row with openpyxl in read-only mode.
+    Hidden and empty sheets are skipped and only merged cells are expanded.
+    `sheet_names` limits the work to some sheets, e.g. one per pool job.
+    """
+    valid_texts = []
+    errors = []
+
+    try:
+        for sheet_name, rows in iter_workbook_sheets(file_stream, sheet_names):
+            logger.debug(f"Streaming sheet: {sheet_name}")
+            texts = find_best_column_in_rows(rows, table=sheet_name)
+            valid_texts.extend(texts)
+        logger.info("Successfully streamed Excel file.")
+    except FATAL_ERRORS:
+        raise
+    except Exception as e:
+        logger.error(f"Error reading Excel file: {e}")
+        return [], [f"Error reading Excel file: {str(e)}"]
 
-    return valid_texts_per_column[best_column]
+    return valid_texts, errors
 
 
 def process_excel_file(file_stream):
     """
-    Process an Excel file and extract valid texts from its sheets via Markdown conversion.
+    Process an Excel file and extract valid texts from its sheets.
+    .xlsx workbooks are streamed unless EXCEL_READER_MODE is "pandas"; legacy .xls
+    files are always loaded with pandas.
     """
+    if EXCEL_READER_MODE == "streaming" and zipfile.is_zipfile(file_stream):
+        file_stream.seek(0)
+        return process_excel_file_streaming(file_stream)
+    file_stream.seek(0)
+
     try:
         sheet_dict = pd.read_excel(file_stream, sheet_name=None, dtype=str)
         logger.info("Successfully read Excel file.")
+    except FATAL_ERRORS:
+        raise
     except Exception as e:
         logger.error(f"Error reading Excel file: {e}")
         return [], [f"Error reading Excel file: {str(e)}"]
@@ -190,162 +382,621 @@ def process_excel_file(file_stream):
 
     for sheet_name, df in sheet_dict.items():
         logger.debug(f"Processing sheet: {sheet_name}")
-        df_filled = df.fillna("").ffill(axis=0)
-        md_string = convert_dataframe_to_markdown(df_filled)
-        texts = find_best_column_in_markdown(md_string)
+        texts = find_best_column_in_dataframe(df, table=sheet_name)
         valid_texts.extend(texts)
 
     return valid_texts, errors
 
 
-def process_pdf_file(file_stream):
+def count_pdf_pages(pdf_path):
+    """Return the number of pages of a PDF file."""
+    return len(PdfReader(pdf_path).pages)
+
+
+def split_page_ranges(page_count, chunk_size=PDF_PAGES_PER_CHUNK):
+    """Split pages 1..page_count into camelot page ranges such as "1-4", "5-8"."""
+    chunk_size = max(1, chunk_size)
+    return [
+        f"{start}-{min(start + chunk_size - 1, page_count)}"
+        for start in range(1, page_count + 1, chunk_size)
+    ]
+
+
+def expand_page_range(pages):
+    """Expand a page range such as "5-8" into single pages ["5", "6", "7", "8"]."""
+    first, _, last = pages.partition("-")
+    return [str(page) for page in range(int(first), int(last or first) + 1)]
+
+
+def extract_pdf_tables(pdf_path, pages, flavor=ROUTE_STREAM):
     """
-    Process a PDF file and extract valid texts from its tables via Markdown conversion.
+    Run camelot on some pages and select the best column of every table found.
+    Ruled pages use the lattice flavor and fall back to stream when camelot
+    finds no table along the lines.
+    Returns a tuple of (valid_texts, errors).
     """
-    try:
-        with tempfile.NamedTemporaryFile(delete=True, suffix=".pdf") as tmp_pdf:
-            tmp_pdf.write(file_stream.read())
-            tmp_pdf.flush()
-            tables = camelot.read_pdf(tmp_pdf.name, pages="all", flavor="stream")
-            logger.info(f"Successfully read PDF file with {tables.n} tables found.")
-    except Exception as e:
-        logger.error(f"Error reading PDF file: {e}")
-        return [], [f"Error reading PDF file: {str(e)}"]
-
-    if not tables:
-        logger.warning("No tables found in PDF file.")
-        return [], ["No tables found in PDF file."]
+    tables = camelot.read_pdf(pdf_path, pages=pages, flavor=flavor)
+    if flavor == ROUTE_LATTICE and tables.n == 0:
+        logger.debug(f"No lattice table on pages {pages} of PDF file, retrying with stream.")
+        tables = camelot.read_pdf(pdf_path, pages=pages, flavor=ROUTE_STREAM)
+    logger.debug(f"Read pages {pages} of PDF file with {tables.n} tables found.")
 
     valid_texts = []
     errors = []
 
     for table_num, table in enumerate(tables, start=1):
-        logger.debug(f"Processing table {table_num} in PDF.")
-        df = table.df
-        df_filled = df.fillna("").ffill(axis=0)
-        md_string = convert_dataframe_to_markdown(df_filled)
-        texts = find_best_column_in_markdown(md_string)
+        logger.debug(f"Processing table {table_num} on page {table.page} in PDF.")
+        # camelot names the columns 0..n, which never count as valid texts
+        texts = find_best_column_in_dataframe(
+            table.df, include_header=False, table=f"page {table.page} table {table.order}"
+        )
         if texts:
             valid_texts.extend(texts)
         else:
-            error_msg = f"No valid texts found in table {table_num}."
+            error_msg = f"No valid texts found in table {table_num} on page {table.page}."
             logger.warning(error_msg)
             errors.append(error_msg)
 
     return valid_texts, errors
 
-def preprocess_image(file_stream):
+
+def process_pdf_pages(pdf_path, pages, flavor=ROUTE_STREAM):
     """
-    Preprocess the image to improve OCR accuracy by removing table lines and adjusting contrast.
+    Extract the tables of a page range. When camelot fails on the range, each
+    page is retried alone so that a broken page only reports an error for itself.
     """
-    # Load image using OpenCV
-    image = np.array(Image.open(file_stream).convert("L"))  # Convert to grayscale
+    try:
+        return extract_pdf_tables(pdf_path, pages, flavor)
+    except FATAL_ERRORS:
+        raise
+    except Exception as e:
+        page_numbers = expand_page_range(pages)
+        if len(page_numbers) == 1:
+            logger.error(f"Error reading page {pages} of PDF file: {e}")
+            return [], [f"Error reading page {pages}: {str(e)}"]
+        logger.warning(f"Error reading pages {pages} of PDF file, retrying page by page: {e}")
+
+    valid_texts = []
+    errors = []
+    for page in page_numbers:
+        try:
+            texts, page_errors = extract_pdf_tables(pdf_path, page, flavor)
+        except FATAL_ERRORS:
+            raise
+        except Exception as e:
+            logger.error(f"Error reading page {page} of PDF file: {e}")
+            errors.append(f"Error reading page {page}: {str(e)}")
+            continue
+        valid_texts.extend(texts)
+        errors.extend(page_errors)
+
+    return valid_texts, errors
 
-    # Apply binary threshold to make the image black and white
-    _, binary_image = cv2.threshold(image, 150, 255, cv2.THRESH_BINARY_INV)
 
-    # Define horizontal and vertical kernels to detect lines
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (40, 1))
-    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 40))
+def process_pdf_text_pages(pdf_path, pages):
+    """
+    Read pages without table structure straight from the text layer, one row
+    per line, so that camelot never runs on them.
+    """
+    reader = PdfReader(pdf_path)
+    rows = []
+    row_lines = []
+    for page in expand_page_range(pages):
+        text = reader.pages[int(page) - 1].extract_text() or ""
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        rows.extend([line] for line in lines)
+        row_lines.extend((page, line_idx) for line_idx in range(len(lines)))
+
+    # Lines of free text are not a template worth remembering
+    best_column, cells = select_best_column_in_rows(rows, remember_layout=False)
+    records = build_task_records(cells, column=best_column)
+    for record in records:
+        page, record["row"] = row_lines[record["row"]]
+        record["table"] = f"page {page}"
+    return records, []
+
+
+def choose_ocr_dpi(image_dpi):
+    """
+    Rasterize a scanned page at the DPI of its scan: a higher DPI adds no
+    detail, a lower one loses diacritics. Unknown scans use the default.
+    """
+    if not image_dpi:
+        return PDF_OCR_DEFAULT_DPI
+    return max(PDF_OCR_MIN_DPI, min(PDF_OCR_MAX_DPI, image_dpi))
+
+
+def rasterize_pdf_page(pdf_path, page, dpi, image_path):
+    """Render one page of a PDF to a grayscale PNG with Ghostscript."""
+    subprocess.run(
+        [
+            "gs", "-q", "-dNOPAUSE", "-dBATCH", "-dSAFER",
+            "-sDEVICE=pnggray", f"-r{dpi}",
+            f"-dFirstPage={page}", f"-dLastPage={page}",
+            f"-sOutputFile={image_path}", pdf_path,
+        ],
+        check=True,
+        capture_output=True,
+        timeout=GHOSTSCRIPT_TIMEOUT,
+    )
+
+
+def ocr_pdf_page(pdf_path, page):
+    """
+    Rasterize a scanned page and run it through the image OCR path.
+    Returns a tuple of (valid_texts, errors).
+    """
+    reader = PdfReader(pdf_path)
+    dpi = choose_ocr_dpi(page_stats(reader.pages[page - 1], reader)["image_dpi"])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = os.path.join(tmp_dir, f"page_{page}.png")
+        start_time = time.monotonic()
+        try:
+            rasterize_pdf_page(pdf_path, page, dpi, image_path)
+        except subprocess.CalledProcessError as e:
+            error = e.stderr.decode("utf-8", errors="replace").strip() or str(e)
+            logger.error(f"Error rasterizing page {page} of PDF file: {error}")
+            return [], [f"Error rasterizing page {page}: {error}"]
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"Error rasterizing page {page} of PDF file: {e}")
+            return [], [f"Error rasterizing page {page}: {str(e)}"]
+        rasterize_seconds = time.monotonic() - start_time
+
+        start_time = time.monotonic()
+        with open(image_path, "rb") as image_file:
+            texts, errors = process_image_file(image_file)
+        ocr_seconds = time.monotonic() - start_time
+        for text_obj in texts:
+            text_obj["table"] = f"page {page}"
+
+    metrics.observe("pdf.rasterize", rasterize_seconds)
+    metrics.observe("pdf.ocr_page", ocr_seconds)
+    # Pages per DPI bucket, e.g. pdf.ocr_page.dpi.300 for 300-349 DPI
+    metrics.increment(f"pdf.ocr_page.dpi.{dpi // PDF_OCR_DPI_BUCKET * PDF_OCR_DPI_BUCKET}")
+    logger.info(
+        f"OCR of PDF page {page} at {dpi} DPI: rasterized in {rasterize_seconds:.2f}s, "
+        f"recognized in {ocr_seconds:.2f}s, {len(texts)} valid texts."
+    )
+    return texts, [f"Page {page}: {error}" for error in errors]
+
+
+def process_pdf_ocr_pages(pdf_path, pages):
+    """OCR the scanned pages of a range, page by page."""
+    valid_texts = []
+    errors = []
+    for page in expand_page_range(pages):
+        texts, page_errors = ocr_pdf_page(pdf_path, int(page))
+        valid_texts.extend(texts)
+        errors.extend(page_errors)
+    return valid_texts, errors
+
+
+def process_pdf_route(pdf_path, route, pages):
+    """Extract a page range with the parser chosen for its route."""
+    start_time = time.monotonic()
+    try:
+        if route == ROUTE_TEXT:
+            return process_pdf_text_pages(pdf_path, pages)
+        if route == ROUTE_OCR:
+            return process_pdf_ocr_pages(pdf_path, pages)
+        return process_pdf_pages(pdf_path, pages, flavor=route)
+    finally:
+        metrics.observe(f"pdf.route.{route}", time.monotonic() - start_time)
+
+
+def process_pdf_file(file_stream, page_range=None):
+    """
+    Process a PDF file and extract valid texts from its tables.
+    Every page is triaged first: ruled tables go to camelot lattice, whitespace
+    tables to camelot stream, plain text is read from the text layer, scanned
+    pages are rasterized and OCRed one by one and blank, cover and signature
+    pages are skipped. Runs of pages sharing a route are parsed by parallel
+    workers and the results are merged back in page order. `page_range`
+    limits the work to one range, e.g. for a process pool job.
+    `file_stream` may also be the path of a spooled upload, which is read in
+    place instead of being copied to a temporary file.
+    """
+    if isinstance(file_stream, str):
+        return process_pdf_path(file_stream, page_range)
+
+    with tempfile.NamedTemporaryFile(delete=True, suffix=".pdf") as tmp_pdf:
+        tmp_pdf.write(file_stream.read())
+        tmp_pdf.flush()
+        return process_pdf_path(tmp_pdf.name, page_range)
+
+
+def process_pdf_path(pdf_path, page_range=None):
+    """Run process_pdf_file on a PDF file on disk."""
+    try:
+        reader = PdfReader(pdf_path)
+        page_numbers = (
+            [int(page) for page in expand_page_range(page_range)]
+            if page_range
+            else range(1, len(reader.pages) + 1)
+        )
+        routes = triage_pdf_pages(reader, page_numbers)
+    except FATAL_ERRORS:
+        raise
+    except Exception as e:
+        logger.error(f"Error reading PDF file: {e}")
+        return [], [f"Error reading PDF file: {str(e)}"]
+
+    for route, count in Counter(route for _, route in routes).items():
+        metrics.increment(f"pdf.pages.{route}", count)
+    jobs = group_page_routes(routes, PDF_PAGES_PER_CHUNK)
+
+    results = [([], []) for _ in jobs]
+    with ThreadPoolExecutor(max_workers=max(1, min(PDF_PAGE_WORKERS, len(jobs)))) as executor:
+        future_to_index = {
+            executor.submit(process_pdf_route, pdf_path, route, pages): index
+            for index, (route, pages) in enumerate(jobs)
+        }
+        for done, future in enumerate(as_completed(future_to_index), start=1):
+            index = future_to_index[future]
+            route, pages = jobs[index]
+            try:
+                results[index] = future.result()
+            except FATAL_ERRORS:
+                raise
+            except Exception as e:
+                logger.error(f"Error processing pages {pages} of PDF file: {e}")
+                results[index] = ([], [f"Error processing pages {pages}: {str(e)}"])
+            metrics.increment("pdf.page_ranges")
+            logger.info(
+                f"PDF progress: pages {pages} ({route}) done ({done}/{len(jobs)} ranges)."
+            )
+
+    valid_texts = [text for texts, _ in results for text in texts]
+    errors = [error for _, range_errors in results for error in range_errors]
+
+    # A range of a split file does not know about the others, the caller
+    # reports a file without tables once (see iter_file_results)
+    if not valid_texts and not errors and page_range is None:
+        logger.warning("No tables found in PDF file.")
+        return [], [NO_PDF_TABLES_ERROR]
+
+    return valid_texts, errors
+
+
+def load_grayscale_image(file_stream):
+    """
+    Load an image file as a grayscale numpy array. Large JPEG photos are
+    decoded straight at a reduced scale that still covers PREPROCESS_MAX_SIDE.
+    """
+    image = Image.open(file_stream)
+    scale = PREPROCESS_MAX_SIDE / max(image.size)
+    if scale < 1:
+        # Only JPEG supports draft decoding, other formats ignore it
+        image.draft("L", (round(image.width * scale), round(image.height * scale)))
+    return np.array(image.convert("L"))
+
 
-    # Detect horizontal lines
-    horizontal_lines = cv2.morphologyEx(
-        binary_image, cv2.MORPH_OPEN, horizontal_kernel, iterations=2
+def normalize_resolution(image):
+    """
+    Resize an image so that its long side is between PREPROCESS_MIN_SIDE and
+    PREPROCESS_MAX_SIDE: phone photos are shrunk before any full-size work,
+    small scans are enlarged so that thin lines and diacritics survive.
+    """
+    long_side = max(image.shape)
+    if PREPROCESS_MIN_SIDE <= long_side <= PREPROCESS_MAX_SIDE:
+        return image
+
+    scale = (PREPROCESS_MAX_SIDE if long_side > PREPROCESS_MAX_SIDE else PREPROCESS_MIN_SIDE) / long_side
+    if scale > 1:
+        interpolation = cv2.INTER_CUBIC
+    else:
+        # Area averaging is only worth its cost for strong reductions
+        interpolation = cv2.INTER_AREA if scale < 0.5 else cv2.INTER_LINEAR
+    logger.debug(f"Resizing image of {image.shape[1]}x{image.shape[0]} by {scale:.2f}.")
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+def line_kernels(shape):
+    """Line detection kernels sized to the image: 20 px on a 1000 px side."""
+    height, width = shape
+    horizontal_length = max(LINE_KERNEL_MIN, round(width * LINE_KERNEL_RATIO))
+    vertical_length = max(LINE_KERNEL_MIN, round(height * LINE_KERNEL_RATIO))
+    return (
+        cv2.getStructuringElement(cv2.MORPH_RECT, (horizontal_length, 1)),
+        cv2.getStructuringElement(cv2.MORPH_RECT, (1, vertical_length)),
     )
 
-    # Detect vertical lines
-    vertical_lines = cv2.morphologyEx(
-        binary_image, cv2.MORPH_OPEN, vertical_kernel, iterations=2
+
+def preprocess_image(image):
+    """
+    Preprocess the image to improve OCR accuracy by removing table lines and adjusting contrast.
+    Works on a grayscale numpy array at normalized resolution and writes into
+    its buffers in place, so only the binary image, the line masks and one
+    half-size buffer are allocated. Returns (processed, horizontal_lines,
+    vertical_lines, line_mask); `processed` is black text on white and goes
+    to OCR as it is.
+    """
+    # Apply binary threshold to make the image black and white
+    binary_image = np.empty_like(image)
+    cv2.threshold(image, BINARY_THRESHOLD, 255, cv2.THRESH_BINARY_INV, dst=binary_image)
+
+    # Lines are long, so they are detected at half resolution, where every
+    # pixel keeps any ink of its 2x2 block and morphology costs a quarter
+    small_binary = cv2.resize(
+        binary_image, None, fx=LINE_DETECTION_SCALE, fy=LINE_DETECTION_SCALE,
+        interpolation=cv2.INTER_AREA,
     )
+    cv2.threshold(small_binary, 0, 255, cv2.THRESH_BINARY, dst=small_binary)
+    horizontal_kernel, vertical_kernel = line_kernels(small_binary.shape)
+    small_lines = np.empty_like(small_binary)
+
+    # Detect horizontal and vertical lines, back at full size on the ink only
+    horizontal_lines = np.empty_like(image)
+    cv2.morphologyEx(small_binary, cv2.MORPH_OPEN, horizontal_kernel, dst=small_lines, iterations=2)
+    cv2.resize(small_lines, image.shape[::-1], dst=horizontal_lines, interpolation=cv2.INTER_NEAREST)
+    cv2.bitwise_and(horizontal_lines, binary_image, dst=horizontal_lines)
+
+    vertical_lines = np.empty_like(image)
+    cv2.morphologyEx(small_binary, cv2.MORPH_OPEN, vertical_kernel, dst=small_lines, iterations=2)
+    cv2.resize(small_lines, image.shape[::-1], dst=vertical_lines, interpolation=cv2.INTER_NEAREST)
+    cv2.bitwise_and(vertical_lines, binary_image, dst=vertical_lines)
 
     # Combine both horizontal and vertical lines to form a mask
-    mask = cv2.add(horizontal_lines, vertical_lines)
+    line_mask = np.empty_like(image)
+    cv2.add(horizontal_lines, vertical_lines, dst=line_mask)
 
-    # Subtract the mask from the original image to remove lines
-    processed_image = cv2.subtract(binary_image, mask)
+    # Remove the lines and turn the text black on white, in the same buffer
+    cv2.subtract(binary_image, line_mask, dst=binary_image)
+    cv2.bitwise_not(binary_image, dst=binary_image)
 
-    # Convert back to PIL image for Tesseract OCR
-    processed_pil_image = Image.fromarray(cv2.bitwise_not(processed_image))
+    # The line masks locate the table grid, its rows and its columns
+    return binary_image, horizontal_lines, vertical_lines, line_mask
 
-    return processed_pil_image
 
+def find_table_region(mask):
+    """
+    Find the table grid in a line mask: the bounding box of all line
+    components that span a good part of the image. Short strokes of stamps
+    or handwriting are left out. Returns (x, y, width, height), or None when
+    the image has no grid worth cropping to.
+    """
+    image_height, image_width = mask.shape
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    boxes = [
+        stats[label, :4]
+        for label in range(1, count)
+        if stats[label, cv2.CC_STAT_WIDTH] >= image_width * TABLE_LINE_MIN_RATIO
+        or stats[label, cv2.CC_STAT_HEIGHT] >= image_height * TABLE_LINE_MIN_RATIO
+    ]
+    if not boxes:
+        return None
+
+    boxes = np.array(boxes)
+    left = max(0, int(boxes[:, 0].min()) - TABLE_PADDING)
+    top = max(0, int(boxes[:, 1].min()) - TABLE_PADDING)
+    right = min(image_width, int((boxes[:, 0] + boxes[:, 2]).max()) + TABLE_PADDING)
+    bottom = min(image_height, int((boxes[:, 1] + boxes[:, 3]).max()) + TABLE_PADDING)
+
+    if (right - left) * (bottom - top) < image_width * image_height * TABLE_MIN_AREA_RATIO:
+        return None
+    return left, top, right - left, bottom - top
+
+
+def split_row_bands(row_edges, region, band_count=OCR_BANDS):
+    """
+    Split a table region into about `band_count` bands of similar height,
+    cutting only on ruling lines so that no text line is cut in half.
+    Returns a list of (top, bottom) in image coordinates, top to bottom.
+    """
+    _, top, _, height = region
+    cuts = [top]
+    if row_edges:
+        row_edges = np.array(row_edges)
+        for band in range(1, band_count):
+            target = top + height * band / band_count
+            cut = int(row_edges[np.argmin(np.abs(row_edges - target))])
+            if cut - cuts[-1] >= OCR_MIN_BAND_HEIGHT and top + height - cut >= OCR_MIN_BAND_HEIGHT:
+                cuts.append(cut)
+    cuts.append(top + height)
 
-def process_image_file(file_stream):
+    return list(zip(cuts, cuts[1:]))
+
+
+# Band OCR threads live as long as the process: with a local engine (process
+# and sandbox backends) the tesseract model of each thread stays loaded
+_ocr_executor = ThreadPoolExecutor(max_workers=OCR_BANDS, thread_name_prefix="ocr")
+
+
+def ocr_image_bands(bands):
     """
-    Process an image file using OCR (Tesseract) and extract valid texts via Markdown conversion.
+    OCR image bands in parallel. Each band is (image, left, top); word boxes
+    are moved back to image coordinates and line numbers kept unique, in
+    reading order.
     """
-    try:
-        # Load the image using PIL
-        # image = Image.open(file_stream)
-
-        # Preprocess the image to improve OCR accuracy
-        processed_image = preprocess_image(file_stream)
-        
-        # Perform OCR on the image
-        extracted_text = pytesseract.image_to_string(processed_image, lang="vie", config=r'--oem 3 --psm 12', output_type=pytesseract.Output.STRING)
-
-        # logger.debug(f"Extracted text from image: {extracted_text}")
-        
-        # Split the extracted text by lines
-        lines = extracted_text.split('\n')
-
-        # Initialize an empty list for the cleaned text
-        cleaned_lines = []
-
-        # Iterate over lines to remove empty lines and handle lowercase line joining
-        previous_line = ""
-        for line in lines:
-            line = line.strip()
-
-            # Skip empty lines
-            if not line:
-                continue
+    # Even a single band goes to the OCR threads, whose engines are warm
+    band_words = list(_ocr_executor.map(ocr_pool.image_to_data, [band[0] for band in bands]))
 
-            # If the line starts with a lowercase letter, append it to the previous line
-            if line[0].islower() and previous_line:
-                previous_line = previous_line.rstrip() + ' ' + line
-            else:
-                if previous_line:
-                    cleaned_lines.append(previous_line)
-                previous_line = line
+    words = []
+    first_line = 0
+    for (_, left, top), band in zip(bands, band_words):
+        for word in band:
+            words.append({
+                **word,
+                "left": word["left"] + left,
+                "top": word["top"] + top,
+                "line": word["line"] + first_line,
+            })
+        first_line += max((word["line"] for word in band), default=-1) + 1
+    return words
 
-        # Append the last processed line
-        if previous_line:
-            cleaned_lines.append(previous_line)
 
-        # Initialize an empty list for the markdown table
-        markdown_table = []
+def line_confidence(words):
+    """Mean tesseract confidence of the words of a line."""
+    return sum(word["conf"] for word in words) / len(words)
+
+
+def binarization_variants(crop):
+    """
+    Yield alternative renderings of a grayscale line crop for a second OCR
+    attempt, as (image, scale): the crop is upscaled, then binarized with
+    Otsu's threshold and with an adaptive threshold instead of the fixed one.
+    """
+    upscaled = cv2.resize(
+        crop, None, fx=OCR_RETRY_SCALE, fy=OCR_RETRY_SCALE, interpolation=cv2.INTER_CUBIC
+    )
+    _, otsu = cv2.threshold(upscaled, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    yield otsu, OCR_RETRY_SCALE
+    adaptive = cv2.adaptiveThreshold(
+        upscaled, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15
+    )
+    yield adaptive, OCR_RETRY_SCALE
+
+
+def reocr_line(image, line_mask, line_words):
+    """
+    OCR one line crop again with the binarization variants, until one reads
+    confidently, and keep the best reading, in image coordinates.
+    """
+    image_height, image_width = image.shape
+    left = max(0, min(word["left"] for word in line_words) - OCR_LINE_PADDING)
+    top = max(0, min(word["top"] for word in line_words) - OCR_LINE_PADDING)
+    right = min(image_width, max(word["left"] + word["width"] for word in line_words) + OCR_LINE_PADDING)
+    bottom = min(image_height, max(word["top"] + word["height"] for word in line_words) + OCR_LINE_PADDING)
+
+    crop = image[top:bottom, left:right].copy()
+    # Ruling lines crossing the crop would be read as characters
+    crop[line_mask[top:bottom, left:right] > 0] = 255
+
+    best_words = line_words
+    best_confidence = line_confidence(line_words)
+    for variant, scale in binarization_variants(crop):
+        words = ocr_pool.image_to_data(variant, ocr_pool.OCR_LINE_PSM)
+        if words and line_confidence(words) > best_confidence:
+            best_confidence = line_confidence(words)
+            best_words = [
+                {
+                    **word,
+                    "left": left + round(word["left"] / scale),
+                    "top": top + round(word["top"] / scale),
+                    "width": round(word["width"] / scale),
+                    "height": round(word["height"] / scale),
+                    "line": line_words[0]["line"],
+                }
+                for word in words
+            ]
+        if best_confidence >= OCR_LINE_MIN_CONF:
+            break
+    return best_words
+
+
+def reocr_low_confidence_lines(image, line_mask, words):
+    """
+    Re-OCR only the lines whose mean confidence is below OCR_LINE_MIN_CONF,
+    worst first and at most OCR_MAX_RETRY_LINES of them, and merge the
+    better readings back in line order. The rest of the page is not OCRed
+    again.
+    """
+    lines = defaultdict(list)
+    for word in words:
+        lines[word["line"]].append(word)
+
+    low_lines = sorted(
+        (line for line, line_words in lines.items() if line_confidence(line_words) < OCR_LINE_MIN_CONF),
+        key=lambda line: line_confidence(lines[line]),
+    )[:OCR_MAX_RETRY_LINES]
+    metrics.increment("ocr.lines", len(lines))
+    if not low_lines:
+        return words
+
+    start_time = time.monotonic()
+    retried = dict(zip(
+        low_lines,
+        _ocr_executor.map(lambda line: reocr_line(image, line_mask, lines[line]), low_lines),
+    ))
+
+    improved = sum(1 for line in low_lines if retried[line] is not lines[line])
+    metrics.increment("ocr.low_confidence_lines", len(low_lines))
+    metrics.increment("ocr.improved_lines", improved)
+    metrics.observe("ocr.retry", time.monotonic() - start_time)
+    logger.debug(
+        f"Re-OCRed {len(low_lines)} of {len(lines)} lines below confidence "
+        f"{OCR_LINE_MIN_CONF}, {improved} improved."
+    )
+
+    for line, line_words in retried.items():
+        lines[line] = line_words
+    return [word for line in sorted(lines) for word in lines[line]]
 
-        # Iterate over the cleaned lines and process them
-        for line in cleaned_lines:
-            # Skip empty lines
-            if not line:
-                continue
-            
-            # Format the line based on whether it contains hierarchical markers
-            if line.startswith('A') or line.startswith('I'):
-                # Major section headers
-                markdown_table.append(f"| {line} | {'':<30} |")
-            elif line.startswith('1') or line.startswith('2'):
-                # Subsection with numbers
-                markdown_table.append(f"| {line} | {'':<30} |")
-            elif line.startswith('+'):
-                # Subsection with + symbols
-                markdown_table.append(f"| {'':<5} | {line} |")
-            else:
-                # General text content
-                markdown_table.append(f"| {'':<5} | {line} |")
-        
-        # logger.debug(markdown_table)
 
-        # Convert the table to markdown format
-        md_string = "\n".join(markdown_table)
+def ocr_image_boxes(file_stream):
+    """
+    Preprocess an image and OCR it in one pass to word boxes. An image with a
+    table grid is cropped to the grid, so that margins and stamps are not
+    OCRed, and cut into row bands that are OCRed in parallel. Lines read with
+    a low confidence are then OCRed again on their own.
+    Returns the box data {"words", "region", "rows", "columns"}; rows and
+    columns are the positions of the ruling lines of the grid.
+    """
+    image = normalize_resolution(load_grayscale_image(file_stream))
+    processed_image, horizontal_lines, vertical_lines, line_mask = preprocess_image(image)
+    region = find_table_region(line_mask)
+
+    if region is None:
+        logger.debug("No table grid found in image, OCR of the whole image.")
+        words = ocr_image_bands([(processed_image, 0, 0)])
+        words = reocr_low_confidence_lines(image, line_mask, words)
+        return {"words": words, "region": None, "rows": [], "columns": []}
+
+    left, top, width, height = region
+    row_edges = [
+        top + position
+        for position in ruling_positions(
+            horizontal_lines[top : top + height, left : left + width], 1, RULING_LINE_MIN_FILL
+        )
+    ]
+    column_edges = [
+        left + position
+        for position in ruling_positions(
+            vertical_lines[top : top + height, left : left + width], 0, RULING_LINE_MIN_FILL
+        )
+    ]
+    bands = [
+        (processed_image[band_top:band_bottom, left : left + width], left, band_top)
+        for band_top, band_bottom in split_row_bands(row_edges, region)
+    ]
+    metrics.increment("ocr.table_regions")
+    logger.debug(
+        f"Table region {region} covers "
+        f"{width * height / processed_image.size:.0%} "
+        f"of the image, split into {len(bands)} band(s)."
+    )
 
-        # Extract the best column with valid texts
-        texts = find_best_column_in_markdown(md_string)
+    words = reocr_low_confidence_lines(image, line_mask, ocr_image_bands(bands))
+    return {"words": words, "region": list(region), "rows": row_edges, "columns": column_edges}
 
-        return texts, []
 
+def process_image_file(file_stream):
+    """
+    Process an image file using OCR (Tesseract). Words and their boxes from
+    one OCR pass are rebuilt into the rows and columns of the table before
+    the best column is selected. Box data is cached by the sha256 of the
+    image, so the same image is never OCRed twice.
+    """
+    try:
+        content = file_stream.read()
+        image_hash = hashlib.sha256(content).hexdigest()
+
+        box_data = get_cached_boxes(image_hash)
+        if box_data is None:
+            box_data = ocr_image_boxes(BytesIO(content))
+            store_boxes(image_hash, box_data)
+
+        rows = build_table_rows(box_data)
+        logger.debug(
+            f"OCR found {len(box_data['words'])} words in {len(rows)} rows of the image."
+        )
+        best_column, cells = select_best_column_in_rows(rows)
+        return build_task_records(cells, "image", best_column), []
+
+    except FATAL_ERRORS:
+        raise
     except Exception as e:
         logger.error(f"Error processing image file: {e}")
         return [], [f"Error processing image file: {str(e)}"]
@@ -354,148 +1005,684 @@ def process_image_file(file_stream):
 def filter_texts(texts):
     """
     Filter out texts based on exclusion criteria.
+    The whole list is classified in one pass and rejections are counted per rule.
     """
-    filtered = []
-    for text_obj in texts:
-        text = text_obj["name"]
-        text_lower = text.lower()
-
-        if any(keyword.lower() == text_lower for keyword in KEYWORDS_TO_EXCLUDE):
-            logger.debug(f"Excluding text due to exact keyword match: {text}")
-            continue
-
-        if any(text_lower.startswith(prefix.lower()) for prefix in PREFIXES_TO_EXCLUDE):
-            logger.debug(f"Excluding text due to prefix match: {text}")
-            continue
+    reasons = TASK_TEXT_FILTER.reasons([text_obj["name"] for text_obj in texts])
 
-        if START_WORDS_REGEX.match(text):
-            logger.debug(f"Excluding text due to start words rule: {text}")
-            continue
-        if any(text.lower().startswith(keyword) for keyword in EXCLUDE_KEYWORDS):
+    filtered = []
+    rejected = Counter()
+    for text_obj, reason in zip(texts, reasons):
+        if reason:
+            rejected[reason] += 1
+            logger.debug(f"Excluding text due to {reason}: {text_obj['name']}")
             continue
 
         filtered.append(text_obj)
 
-    logger.info(f"Filtered texts: {len(filtered)} out of {len(texts)}")
+    logger.info(
+        f"Filtered texts: {len(filtered)} out of {len(texts)}, rejected by rule: {dict(rejected)}"
+    )
     return filtered
 
 
-def process_files(files):
+def extract_file_content(extension, content, part=None):
     """
-    Process uploaded files and return a tuple of (valid_texts, errors).
+    Run the extractor matching `extension` on the raw bytes of one file, or of
+    one part of it: a sheet name for workbooks, a page range for PDFs.
+    Module-level so that process pool workers can receive it; only the bytes,
+    or the path of a spooled upload, go in and small task lists come back.
+    Results are kept in the artifact store by the sha256 of the bytes, so a
+    file uploaded again is not parsed.
     """
-    all_valid_texts = []
-    all_errors = []
+    buffer = None
+    try:
+        buffer = load_content(content)
+        file_hash = content_hash(buffer)
+        artifact = load_artifact(file_hash, part)
+        if artifact is not None:
+            return artifact
+
+        if extension == "pdf" and isinstance(content, str):
+            # camelot and ghostscript read the spooled file in place
+            valid_texts, errors = process_pdf_file(content, part)
+        else:
+            valid_texts, errors = run_extractor(extension, content_stream(buffer), part)
+        # Errors may be transient (a timeout, a missing tool), so only clean runs are kept
+        if not errors:
+            store_artifact(file_hash, part, valid_texts, errors)
+        return valid_texts, errors
+    finally:
+        close_content(buffer)
+        # Pool workers may sit idle for a long time, push their counters now
+        metrics.flush()
+
+
+def read_upload(file):
+    """
+    Return the content of an uploaded file for extract_file_content: the path
+    of a file spooled by the upload store, which is never read into memory
+    here, or the bytes of a file received in the request.
+    """
+    path = getattr(file.stream, "name", None)
+    if isinstance(path, str) and os.path.isfile(path):
+        return path
+    return file.read()
 
-    if not files:
-        logger.warning("No files provided for processing.")
-        return all_valid_texts, all_errors
 
-    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS) as executor:
-        future_to_file = {}
+class MappedFile(mmap.mmap):
+    """Read-only memory map that can stand in for a binary file object."""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+
+def load_content(content):
+    """
+    Return the bytes of a file as a buffer: bytes are returned as they are, a
+    path is memory-mapped read-only so its pages are shared, not copied.
+    """
+    if not isinstance(content, str):
+        return content
+    with open(content, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return MappedFile(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def close_content(buffer):
+    """Unmap a buffer from load_content; bytes need nothing."""
+    if isinstance(buffer, mmap.mmap):
+        buffer.close()
+
+
+def content_stream(buffer):
+    """Wrap a buffer from load_content in a seekable stream without copying it."""
+    if isinstance(buffer, mmap.mmap):
+        buffer.seek(0)
+        return buffer
+    return BytesIO(buffer)
+
+
+def run_extractor(extension, file_stream, part=None):
+    """Dispatch a file stream to the extractor of its extension."""
+    if extension in EXCEL_EXTENSIONS:
+        if part is not None:
+            return process_excel_file_streaming(file_stream, [part])
+        return process_excel_file(file_stream)
+    if extension == "pdf":
+        return process_pdf_file(file_stream, part)
+    if extension in IMAGE_EXTENSIONS:
+        return process_image_file(file_stream)
+
+    return [], [f"Unsupported file type: {extension}"]
+
+
+def init_extraction_worker():
+    """Prepare a process pool worker; it is reused for many files."""
+    # One OpenCV thread per worker, parallelism comes from the pool itself
+    cv2.setNumThreads(1)
+    # The worker lives as long as an OCR worker would, so it keeps its own model
+    ocr_pool.use_local_engine()
+    logger.debug(f"Extraction worker {os.getpid()} ready.")
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """Return the shared extraction process pool, creating it on first use."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            mp_context = multiprocessing.get_context(EXTRACTION_START_METHOD)
+            if EXTRACTION_START_METHOD == "forkserver":
+                # Import cv2, camelot and pandas once in the fork server
+                mp_context.set_forkserver_preload([__name__])
+            _process_pool = ProcessPoolExecutor(
+                max_workers=MAX_EXTRACTION_PROCESSES,
+                mp_context=mp_context,
+                initializer=init_extraction_worker,
+            )
+            logger.info(
+                f"Started extraction process pool with {MAX_EXTRACTION_PROCESSES} worker(s)."
+            )
+        return _process_pool
+
+
+def reset_process_pool(broken_pool):
+    """
+    Drop a broken process pool so the next job starts a fresh one. Other
+    requests may have replaced it already, their new pool is kept.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is broken_pool:
+            _process_pool.shutdown(wait=False)
+            _process_pool = None
+            metrics.increment("extraction.pool.restarts")
+
+
+def get_sandbox_context():
+    """Return the multiprocessing context sandboxed jobs are started from."""
+    mp_context = multiprocessing.get_context(EXTRACTION_START_METHOD)
+    if EXTRACTION_START_METHOD == "forkserver":
+        # Children are forked from a server that has imported this module once
+        mp_context.set_forkserver_preload([__name__])
+    return mp_context
+
+
+def current_address_space():
+    """Return the virtual memory size of this process in bytes, 0 if unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def run_sandboxed_job(conn, job):
+    """
+    Entry point of a sandboxed child: cap its memory, extract one job and send
+    the result back. The child leads its own process group, so ghostscript
+    started by it is killed along with it.
+    """
+    os.setpgrp()
+    # RLIMIT_RSS is not enforced by Linux; capping the address space makes
+    # oversized allocations fail in this child (and in ghostscript) instead
+    memory_limit = current_address_space() + EXTRACTION_MAX_MEMORY_MB * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    init_extraction_worker()
+    try:
+        result = extract_file_content(*job)
+    except MemoryError:
+        metrics.increment("extraction.sandbox.memory_errors")
+        metrics.flush()
+        result = [], [f"Error: extraction exceeded the memory limit of {EXTRACTION_MAX_MEMORY_MB} MB"]
+    conn.send(result)
+    conn.close()
+
+
+def kill_process_group(process):
+    """Kill a sandboxed child and everything it started."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+def extract_in_sandbox(extension, content, part=None):
+    """
+    Run extract_file_content in a fresh child process, so that a hanging or
+    ballooning parser can be killed without touching the gunicorn worker.
+    Returns (valid_texts, errors) like the extractors; a job that hits the
+    time or memory limit, or crashes, returns an error for itself only.
+    """
+    mp_context = get_sandbox_context()
+    receiver, sender = mp_context.Pipe(duplex=False)
+    process = mp_context.Process(
+        target=run_sandboxed_job, args=(sender, (extension, content, part)), daemon=True
+    )
+    start_time = time.monotonic()
+    process.start()
+    sender.close()
+
+    try:
+        if not receiver.poll(EXTRACTION_TIMEOUT):
+            kill_process_group(process)
+            metrics.increment("extraction.sandbox.timeouts")
+            logger.error(f"Sandboxed extraction killed after {EXTRACTION_TIMEOUT}s.")
+            return [], [f"Error: extraction timed out after {EXTRACTION_TIMEOUT}s"]
+        return receiver.recv()
+    except EOFError:
+        # The child died without sending a result: a crash or the OOM killer
+        process.join()
+        metrics.increment("extraction.sandbox.crashes")
+        logger.error(f"Sandboxed extraction exited with code {process.exitcode}.")
+        return [], [f"Error: extraction process exited with code {process.exitcode}"]
+    finally:
+        receiver.close()
+        process.join(timeout=1)
+        if process.is_alive():
+            kill_process_group(process)
+            process.join()
+        metrics.observe("extraction.sandbox", time.monotonic() - start_time)
+
+
+def split_into_jobs(extension, content, use_processes):
+    """
+    Return the extract_file_content argument tuples for one file, given as
+    bytes or as the path of a spooled upload. With a process pool, large
+    workbooks become one job per visible sheet and long PDFs one job per page
+    range.
+    """
+    if not use_processes:
+        return [(extension, content)]
+
+    buffer = load_content(content)
+    try:
+        return split_content(extension, content, buffer)
+    finally:
+        close_content(buffer)
+
+
+def split_content(extension, content, buffer):
+    """Split the content of a file, mapped as `buffer`, into jobs; see split_into_jobs."""
+    if (
+        extension in EXCEL_EXTENSIONS
+        and len(buffer) >= SHEET_PARALLEL_MIN_BYTES
+        and zipfile.is_zipfile(content_stream(buffer))
+    ):
+        try:
+            sheet_names = list_visible_sheet_names(content_stream(buffer))
+        except Exception as e:
+            logger.warning(f"Cannot list sheets, processing workbook as a whole: {e}")
+        else:
+            if len(sheet_names) > 1:
+                return [(extension, content, sheet_name) for sheet_name in sheet_names]
+
+    if extension == "pdf":
+        try:
+            page_ranges = split_page_ranges(count_pdf_pages(content_stream(buffer)))
+        except Exception as e:
+            logger.warning(f"Cannot count PDF pages, processing document as a whole: {e}")
+        else:
+            if len(page_ranges) > 1:
+                return [(extension, content, pages) for pages in page_ranges]
+
+    return [(extension, content)]
+
 
-        for file in files:
+def iter_file_results(files):
+    """
+    Extract uploaded files and yield (job_index, valid_texts, errors) for every
+    file, sheet or page range as soon as it is done. `job_index` follows the
+    upload order, then the sheet/page order within a file, so callers can
+    merge results back in order. Every text carries the 'file' it came from,
+    next to its 'table', 'row', 'column' and 'stt'.
+    """
+    if not files:
+        logger.warning("No files provided for processing.")
+        return
+
+    use_processes = EXTRACTION_BACKEND in ("process", "sandbox")
+    if EXTRACTION_BACKEND == "process":
+        executor_context = nullcontext(get_process_pool())
+        extract = extract_file_content
+    elif EXTRACTION_BACKEND == "sandbox":
+        # Each thread only waits on its child, the children do the work
+        executor_context = ThreadPoolExecutor(max_workers=MAX_EXTRACTION_PROCESSES)
+        extract = extract_in_sandbox
+    else:
+        executor_context = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS)
+        extract = extract_file_content
+
+    with executor_context as executor:
+        future_to_job = {}
+        job_index = 0
+        # Page ranges of split PDFs: file number -> [pending ranges, texts or errors found]
+        split_pdfs = {}
+
+        for file_number, file in enumerate(files):
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 extension = filename.rsplit(".", 1)[1].lower()
                 logger.info(f"Submitting {filename} for processing.")
 
                 try:
-                    file_content = file.read()
-                    seekable_stream = BytesIO(file_content)
-
-                    if extension in {"xlsx", "xls"}:
-                        future = executor.submit(process_excel_file, seekable_stream)
-                    elif extension == "pdf":
-                        future = executor.submit(process_pdf_file, seekable_stream)
-                    elif extension in {"png", "jpg", "jpeg"}:
-                        future = executor.submit(process_image_file, seekable_stream)
-                    else:
-                        # This condition should not occur due to allowed_file check
-                        logger.error(f"Unsupported file extension: {extension}")
-                        all_errors.append(f"Unsupported file type: {filename}")
-                        continue
-
-                    future_to_file[future] = filename
+                    file_content = read_upload(file)
+
+                    for job in split_into_jobs(extension, file_content, use_processes):
+                        future = executor.submit(extract, *job)
+                        part = job[2] if len(job) > 2 else None
+                        future_to_job[future] = (job_index, file_number, filename, part)
+                        if extension == "pdf" and part is not None:
+                            split_pdfs.setdefault(file_number, [0, False])[0] += 1
+                        job_index += 1
                 except Exception as e:
                     logger.error(f"Error preparing file {filename} for processing: {e}")
-                    all_errors.append(f"Error preparing file {filename}: {str(e)}")
+                    yield job_index, [], [f"Error preparing file {filename}: {str(e)}"]
+                    job_index += 1
             else:
                 filename = file.filename if file else "No filename"
                 logger.error(f"Unsupported or invalid file: {filename}")
-                all_errors.append(f"Unsupported or invalid file: {filename}")
+                yield job_index, [], [f"Unsupported or invalid file: {filename}"]
+                job_index += 1
 
-        for future in as_completed(future_to_file):
-            filename = future_to_file[future]
+        for future in as_completed(future_to_job):
+            index, file_number, filename, part = future_to_job[future]
+            label = f"{filename} ({part})" if part else filename
             try:
                 valid_texts, errors = future.result()
-                all_valid_texts.extend(valid_texts)
-                if errors:
-                    all_errors.extend([f"{filename}: {error}" for error in errors])
-                logger.info(f"Completed processing file: {filename}")
+                logger.info(f"Completed processing file: {label}")
+                for text_obj in valid_texts:
+                    text_obj["file"] = filename
+            except BrokenProcessPool as e:
+                logger.error(f"Extraction worker died while processing {label}: {e}")
+                reset_process_pool(executor)
+                valid_texts, errors = [], [f"Error processing file {label}: {str(e)}"]
             except Exception as e:
-                logger.error(f"Error processing file {filename}: {e}")
-                all_errors.append(f"Error processing file {filename}: {str(e)}")
+                logger.error(f"Error processing file {label}: {e}")
+                valid_texts, errors = [], [f"Error processing file {label}: {str(e)}"]
+            else:
+                errors = [f"{filename}: {error}" for error in errors]
+
+            if file_number in split_pdfs:
+                split_pdf = split_pdfs[file_number]
+                split_pdf[0] -= 1
+                split_pdf[1] = split_pdf[1] or bool(valid_texts or errors)
+                if split_pdf[0] == 0 and not split_pdf[1]:
+                    logger.warning(f"No tables found in PDF file {filename}.")
+                    errors = [f"{filename}: {NO_PDF_TABLES_ERROR}"]
+            yield index, valid_texts, errors
+
+
+def process_files(files):
+    """
+    Process uploaded files and return a tuple of (valid_texts, errors).
+    Results are merged in upload order, and in sheet/page order within a file.
+    """
+    all_valid_texts = []
+    all_errors = []
+
+    for _, valid_texts, errors in sorted(iter_file_results(files), key=lambda result: result[0]):
+        all_valid_texts.extend(valid_texts)
+        all_errors.extend(errors)
 
     return all_valid_texts, all_errors
 
 
-def process_files_and_analyze_data(files):
+def iter_preview_tables(extension, file_stream, max_rows):
     """
-    Process uploaded files and analyze data by calculating relevance scores.
-    Returns a tuple of (analyzed_data, errors).
+    Yield (source, best_column, valid_texts) for the first `max_rows` rows of
+    every sheet or table, using the same column selection as a full run.
+    Layouts chosen from partial data are not written to the layout cache.
+    """
+    if extension in EXCEL_EXTENSIONS:
+        if EXCEL_READER_MODE == "streaming" and zipfile.is_zipfile(file_stream):
+            file_stream.seek(0)
+            for sheet_name, rows in iter_workbook_sheets(file_stream, max_rows=max_rows):
+                best_column, texts = select_best_column_in_rows(rows, remember_layout=False)
+                yield sheet_name, best_column, texts
+            return
+
+        file_stream.seek(0)
+        sheet_dict = pd.read_excel(file_stream, sheet_name=None, dtype=str, nrows=max_rows)
+        for sheet_name, df in sheet_dict.items():
+            best_column, texts = select_best_column_in_dataframe(df, remember_layout=False)
+            yield sheet_name, best_column, texts
+        return
+
+    if extension == "pdf":
+        with tempfile.NamedTemporaryFile(delete=True, suffix=".pdf") as tmp_pdf:
+            tmp_pdf.write(file_stream.read())
+            tmp_pdf.flush()
+            tables = camelot.read_pdf(tmp_pdf.name, pages=PREVIEW_PDF_PAGES, flavor="stream")
+        for table_num, table in enumerate(tables, start=1):
+            best_column, texts = select_best_column_in_dataframe(
+                table.df.head(max_rows), include_header=False, remember_layout=False
+            )
+            yield f"table {table_num}", best_column, texts
+        return
+
+    raise ValueError("Preview is not available for image files, OCR needs the full run.")
+
+
+def preview_files(files, max_rows=PREVIEW_ROWS, sample_size=PREVIEW_SAMPLE_SIZE):
+    """
+    Read only the first rows of each sheet/table and report the column a full
+    run would select, with a few sample texts. Nothing is scored.
+    Returns a tuple of (previews, errors) with one preview per sheet or table.
     """
-    valid_texts, processing_errors = process_files(files)
+    previews = []
+    errors = []
+
+    for file in files:
+        if not (file and allowed_file(file.filename)):
+            filename = file.filename if file else "No filename"
+            errors.append(f"Unsupported or invalid file: {filename}")
+            continue
+
+        filename = secure_filename(file.filename)
+        extension = filename.rsplit(".", 1)[1].lower()
+        buffer = None
+        try:
+            buffer = load_content(read_upload(file))
+            file_stream = content_stream(buffer)
+            for source, best_column, texts in iter_preview_tables(
+                extension, file_stream, max_rows
+            ):
+                sample_texts = filter_texts(build_task_records(texts[:sample_size]))
+                previews.append(
+                    {
+                        "file": filename,
+                        "source": source,
+                        "column": best_column,
+                        "valid_texts": len(texts),
+                        "sample_texts": [text_obj["name"] for text_obj in sample_texts],
+                    }
+                )
+        except Exception as e:
+            logger.error(f"Error previewing file {filename}: {e}")
+            errors.append(f"{filename}: Error previewing file: {str(e)}")
+        finally:
+            close_content(buffer)
+
+    return previews, errors
+
 
-    if not valid_texts:
-        logger.info("No valid data to analyze after processing files.")
-        return [], processing_errors
+def task_result(item, score):
+    """Build the scored task of an extracted text, keeping its source coordinates."""
+    result = {"id": item.get("id", ""), "name": item.get("name", ""), "score": score}
+    for field in TASK_SOURCE_FIELDS:
+        if field in item:
+            result[field] = item[field]
+    return result
 
-    # Filter texts based on exclusion criteria
-    filtered_texts = filter_texts(valid_texts)
-    
-    if not filtered_texts:
-        logger.info("No data left after filtering texts.")
-        return [], processing_errors
+
+def process_files_and_analyze_data(files, previous_scores=None):
+    """
+    Process uploaded files and analyze data by calculating relevance scores.
+    `previous_scores` maps row hashes (see utils.text_utils.text_hash) to the
+    scores of an earlier upload; matching rows reuse their score and only new
+    or changed rows are scored.
+    Extraction, filtering and scoring run as a pipeline joined by bounded
+    queues: the texts of a file, sheet or page range are filtered and scored
+    as soon as it is extracted, while slower files are still being parsed.
+    Every result keeps the source coordinates of its text and results come
+    back in document order. Duplicate and near-duplicate texts of the upload
+    are clustered and only the first text of a cluster is scored; its score
+    is copied to the other members, and so is its error if scoring failed.
+    Returns a tuple of (analyzed_data, errors, stats) where stats counts the
+    reused and rescored rows, the scoring calls made (llm_calls) and the
+    calls avoided by cache hits, clustering and batching (llm_calls_saved).
+    """
+    stats = {"reused": 0, "rescored": 0, "llm_calls": 0, "llm_calls_saved": 0}
+    extracted_queue = queue.Queue(maxsize=EXTRACTED_QUEUE_SIZE)
+    score_queue = queue.Queue(maxsize=SCORE_QUEUE_SIZE)
+    scoring_workers = max(1, MAX_CONCURRENT_TASKS)
+    results_lock = threading.Lock()
+    # (job_index, position) pairs order results and errors after the parallel stages
+    processing_errors = []
+    analyzed_data = []
+    analysis_errors = []
+    duplicate_index = NearDuplicateIndex(DEDUP_SIMILARITY)
+    duplicates = []  # (order, item, cluster) waiting for the score of their cluster
+    cluster_scores = {}
+    cluster_errors = {}  # Clusters whose representative could not be scored
+    start_time = time.monotonic()
 
     def analyze_item(item):
-        """Analyze a single text item to calculate its relevance score."""
+        """
+        Analyze a single text item to calculate its relevance score. Errors
+        are raised, score_stage reports them for the item and its cluster.
+        Returns (result, model calls made): 0 when the answer was cached.
+        """
         item_name = item.get("name", "")
         if not item_name:
             logger.debug("Skipping item with empty 'name'.")
-            return {"id": item.get("id", ""), "name": item_name, "score": 0}
+            return task_result(item, 0), 0
 
         logger.info(f"Analyzing item: '{item_name}'.")
+        # Unreadable answers get 0, which is never persisted as a row score
+        score, cached = calculate_relevance_score_cached(item_name, default=0)
+        # score = 1
+        logger.debug(f"Calculated score for '{item_name}': {score}")
+        return task_result(item, score), 0 if cached else 1
+
+    def extract_stage():
+        """Push the texts of every file, sheet or page range as it is extracted."""
         try:
-            score = calculate_relevance_score(item_name)
-            # score = 1
-            logger.debug(f"Calculated score for '{item_name}': {score}")
-            return {"id": item.get("id", ""), "name": item_name, "score": score}
+            for job_index, valid_texts, errors in iter_file_results(files):
+                processing_errors.extend(((job_index, 0), error) for error in errors)
+                if valid_texts:
+                    extracted_queue.put((job_index, valid_texts))
         except Exception as e:
-            logger.error(f"Error calculating relevance score for '{item_name}': {e}")
-            return {"id": item.get("id", ""), "name": item_name, "score": 0}
-
-    analyzed_data = []
-    analysis_errors = []
+            logger.error(f"Error extracting files: {e}")
+            processing_errors.append(((float("inf"), 0), f"Error extracting files: {str(e)}"))
+        finally:
+            metrics.observe("pipeline.extract", time.monotonic() - start_time)
+            extracted_queue.put(None)
+
+    def filter_batch(job_index, valid_texts):
+        """Filter one extracted batch and queue the rows that need a score."""
+        filtered_texts = filter_texts(valid_texts)
+
+        # Reuse the scores of rows that did not change since the previous upload
+        for position, item in enumerate(filtered_texts):
+            previous_score = (
+                previous_scores.get(text_hash(item["name"])) if previous_scores else None
+            )
+            if previous_score is not None:
+                stats["reused"] += 1
+                with results_lock:
+                    analyzed_data.append(
+                        ((job_index, position), task_result(item, previous_score))
+                    )
+                continue
 
-    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS) as executor:
-        future_to_item = {
-            executor.submit(analyze_item, item): item for item in filtered_texts
-        }
+            stats["rescored"] += 1
+            cluster, is_new = duplicate_index.add(item["name"])
+            if is_new:
+                score_queue.put(((job_index, position), item, cluster))
+            else:
+                duplicates.append(((job_index, position), item, cluster))
 
-        for future in as_completed(future_to_item):
-            item = future_to_item[future]
+    def filter_stage():
+        """Filter extracted batches until the extraction stage is done."""
+        try:
+            while (batch := extracted_queue.get()) is not None:
+                job_index, valid_texts = batch
+                try:
+                    filter_batch(job_index, valid_texts)
+                except Exception as e:
+                    # Keep draining, the extraction stage would block on a full queue
+                    logger.error(f"Error filtering texts: {e}")
+                    processing_errors.append(((job_index, 1), f"Error filtering texts: {str(e)}"))
+        finally:
+            for _ in range(scoring_workers):
+                score_queue.put(None)
+
+    def analyze_batch(items):
+        """
+        Score several text items with one call; items with an empty 'name' get 0,
+        so do items whose score cannot be read, without failing the batch.
+        Returns (results, model calls made, calls avoided by the cache or by
+        scoring items together).
+        """
+        if SCORE_BATCH_SIZE == 1:
+            result, calls = analyze_item(items[0])
+            return [result], calls, 1 - calls if items[0].get("name") else 0
+
+        named = [item for item in items if item.get("name")]
+        if not named:
+            return [task_result(item, 0) for item in items], 0, 0
+        logger.info(f"Analyzing a batch of {len(named)} items.")
+        scores, calls, saved = calculate_relevance_scores(
+            [item["name"] for item in named], default=0
+        )
+        named_scores = {id(item): score for item, score in zip(named, scores)}
+        return [task_result(item, named_scores.get(id(item), 0)) for item in items], calls, saved
+
+    def next_score_batch():
+        """
+        Take up to SCORE_BATCH_SIZE queued rows, waiting at most SCORE_BATCH_WAIT
+        for each row after the first. Returns (batch, done); done is set once
+        this worker has received its end-of-queue marker.
+        """
+        queued = score_queue.get()
+        if queued is None:
+            return [], True
+        batch = [queued]
+        while len(batch) < SCORE_BATCH_SIZE:
+            try:
+                queued = score_queue.get(timeout=SCORE_BATCH_WAIT)
+            except queue.Empty:
+                break
+            if queued is None:
+                return batch, True
+            batch.append(queued)
+        return batch, False
+
+    def score_stage():
+        """Score queued rows, alone or in batches, until the filter stage is done."""
+        done = False
+        while not done:
+            batch, done = next_score_batch()
+            if not batch:
+                continue
             try:
-                result = future.result()
-                analyzed_data.append(result)
+                results, calls, saved = analyze_batch([item for _, item, _ in batch])
             except Exception as e:
-                logger.error(f"Error analyzing item '{item.get('name', '')}': {e}")
-                analysis_errors.append(
-                    f"Error analyzing item '{item.get('name', '')}': {str(e)}"
-                )
+                logger.error(f"Error analyzing {len(batch)} item(s): {e}")
+                with results_lock:
+                    for order, item, cluster in batch:
+                        cluster_errors[cluster] = str(e)
+                        analysis_errors.append(
+                            (order, f"Error analyzing item '{item.get('name', '')}': {str(e)}")
+                        )
+                continue
+            with results_lock:
+                stats["llm_calls"] += calls
+                stats["llm_calls_saved"] += saved
+                for (order, _, cluster), result in zip(batch, results):
+                    cluster_scores[cluster] = result["score"]
+                    analyzed_data.append((order, result))
+
+    with ThreadPoolExecutor(max_workers=scoring_workers + 2) as executor:
+        stages = [executor.submit(extract_stage), executor.submit(filter_stage)]
+        stages += [executor.submit(score_stage) for _ in range(scoring_workers)]
+        for stage in stages:
+            stage.result()
+
+    # Members of a cluster take the score, or the error, of its representative
+    for order, item, cluster in duplicates:
+        if cluster in cluster_scores:
+            analyzed_data.append((order, task_result(item, cluster_scores[cluster])))
+        else:
+            error = cluster_errors.get(cluster, "its duplicate was not scored")
+            analysis_errors.append((order, f"Error analyzing item '{item.get('name', '')}': {error}"))
+
+    # Cluster members are never sent to the model
+    stats["llm_calls_saved"] += len(duplicates)
+    metrics.observe("pipeline.total", time.monotonic() - start_time)
+    metrics.increment("scoring.llm_calls", stats["llm_calls"])
+    metrics.increment("scoring.llm_calls_saved", stats["llm_calls_saved"])
+    logger.info(
+        f"Reused {stats['reused']} row score(s), scored {stats['rescored']} row(s) "
+        f"with {stats['llm_calls']} call(s), {stats['llm_calls_saved']} saved by the cache, clustering and batching."
+    )
 
-    total_errors = processing_errors + analysis_errors
+    analyzed_data = [result for _, result in sorted(analyzed_data, key=lambda entry: entry[0])]
+    total_errors = [error for _, error in sorted(processing_errors, key=lambda entry: entry[0])]
+    total_errors += [error for _, error in sorted(analysis_errors, key=lambda entry: entry[0])]
     logger.info(
         f"Completed analysis for {len(analyzed_data)} items with {len(total_errors)} error(s)."
     )
-    return analyzed_data, total_errors
+    return analyzed_data, total_errors, stats
@@ -1,6 +1,12 @@
 import pandas as pd
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from ai_analysis import calculate_relevance_score, analyze_and_identify_column
+from layout_cache import (
+    LAYOUT_SAMPLE_ROWS,
+    get_cached_layout,
+    layout_fingerprint,
+    store_layout,
+)
 import os
 import re
 from pdfminer.high_level import extract_text
@@ -17,18 +23,45 @@ POSSIBLE_COLUMNS = [
 ]
 
 
+# Phạm vi cache bố cục cho cách chọn cột theo tên cột và AI
+LAYOUT_SCOPE = "task_column"
+
+
 def find_task_column(df):
     """
     Xác định cột liên quan đến nhiệm vụ trong DataFrame.
+    Nếu bố cục sheet đã gặp trước đó, dùng lại cột đã xác định (cache Redis).
     Nếu không tìm thấy, sử dụng AI để xác định.
     """
+    sample_rows = [list(df.columns)] + df.head(LAYOUT_SAMPLE_ROWS - 1).fillna("").values.tolist()
+    fingerprint, stt_column = layout_fingerprint(sample_rows)
+    layout = get_cached_layout(LAYOUT_SCOPE, fingerprint)
+    if layout is not None and layout["task_column"] < len(df.columns):
+        logging.debug(f"Layout cache hit, task column index {layout['task_column']}")
+        return df.columns[layout["task_column"]]
+
+    identified_column = find_task_column_by_name(df)
+    if identified_column is None:
+        identified_column = analyze_and_identify_column(df)
+
+    if identified_column is not None and identified_column in df.columns:
+        store_layout(
+            LAYOUT_SCOPE,
+            fingerprint,
+            list(df.columns).index(identified_column),
+            stt_column,
+        )
+    return identified_column
+
+
+def find_task_column_by_name(df):
+    """Tìm cột nhiệm vụ theo danh sách tên cột POSSIBLE_COLUMNS."""
     columns_lower = [col.strip().lower() for col in df.columns]
     logging.debug(f"Columns in DataFrame: {columns_lower}")
     for col_name in POSSIBLE_COLUMNS:
         if col_name in columns_lower:
             return df.columns[columns_lower.index(col_name)]
-
-    return analyze_and_identify_column(df)
+    return None
 
 
 def calculate_score_multithreaded(tasks):
@@ -38,6 +71,31 @@ def calculate_score_multithreaded(tasks):
     return scores
 
 
+def is_bad_header(values):
+    """Header không hợp lệ nếu có ô trống ('nan') hoặc cột 'Unnamed'."""
+    for value in values:
+        if pd.isna(value):
+            return True
+        value = str(value)
+        if value.startswith("Unnamed") or value.lower() == "nan":
+            return True
+    return False
+
+
+def find_header_row(df):
+    """
+    Tìm dòng header đầu tiên hợp lệ trong một lần duyệt.
+    Trả về -1 nếu header hiện tại đã hợp lệ, chỉ số dòng nếu header nằm trong dữ liệu,
+    hoặc None nếu không có dòng nào hợp lệ.
+    """
+    if not is_bad_header(df.columns):
+        return -1
+    for row_idx, values in enumerate(df.itertuples(index=False, name=None)):
+        if not is_bad_header(values):
+            return row_idx
+    return None
+
+
 def process_single_sheet(sheet_name, df):
     """Xử lý một sheet và trả về các tasks với điểm số."""
     result_data = []
@@ -49,11 +107,13 @@ def process_single_sheet(sheet_name, df):
     df.columns = df.columns.map(str)
     logging.debug(f"Final columns in sheet '{sheet_name}': {df.columns}")
     # Loại bỏ các cột 'Unnamed' và đặt lại header nếu cần
-    while any(col.startswith("Unnamed") or pd.isna(col) or col.lower() == 'nan' for col in df.columns):
-        df.columns = df.iloc[0].map(str)
-        logging.debug(df.columns)
-        df = df[1:].reset_index(drop=True)
-    logging.debug("end while")
+    header_row = find_header_row(df)
+    if header_row is None:
+        logging.debug(f"No complete header row found in sheet '{sheet_name}'")
+    elif header_row >= 0:
+        df.columns = df.iloc[header_row].map(str)
+        df = df.iloc[header_row + 1 :].reset_index(drop=True)
+    logging.debug(f"Header row of sheet '{sheet_name}': {header_row}")
     df.replace("N/A", pd.NA, inplace=True)
     df.dropna(how="all", inplace=True)
 
@@ -5,8 +5,11 @@ import sys
 import uuid
 import json
 import logging
+import threading
 from io import BytesIO
+import pandas as pd
 from werkzeug.datastructures import FileStorage
+import process_and_analyze_data
 from process_and_analyze_data import (
     process_files_and_analyze_data,
     allowed_file
@@ -68,7 +71,7 @@ def test_process_files():
     logger.info(f"Found {len(test_files)} file(s) for testing.")
 
     # Process the files
-    analyzed_data, errors = process_files_and_analyze_data(test_files)
+    analyzed_data, errors, stats = process_files_and_analyze_data(test_files)
 
     # Optionally, save the results to a JSON file
     output_file = os.path.join(files_dir, "valid_texts.json")
@@ -76,6 +79,63 @@ def test_process_files():
 
     # Print the number of valid texts found
     logger.info(f"Total valid texts found: {len(analyzed_data)}")
+    logger.info(f"Analysis stats: {stats}")
+
+def generate_excel_file(filename, names):
+    """
+    Generate an in-memory .xlsx FileStorage with an STT column and a task column.
+    """
+    df = pd.DataFrame({"STT": [str(i + 1) for i in range(len(names))], "Nội dung": names})
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+    buffer.seek(0)
+    return FileStorage(stream=buffer, filename=filename)
+
+def test_filter_stage_failure():
+    """
+    A failure while filtering one extracted batch must not stop the pipeline:
+    with more batches than the extraction queue holds, the other files are
+    still scored and the failed one is reported as an error.
+    """
+    file_count = process_and_analyze_data.EXTRACTED_QUEUE_SIZE * 2
+    files = [
+        generate_excel_file(
+            f"file_{file_index}.xlsx",
+            [f"Chi hỗ trợ hoạt động giáo dục {file_index} số {row}" for row in range(5)],
+        )
+        for file_index in range(file_count)
+    ]
+
+    original_text_hash = process_and_analyze_data.text_hash
+    original_score = process_and_analyze_data.calculate_relevance_score_cached
+
+    def failing_text_hash(text):
+        if "giáo dục 0 " in text:
+            raise ValueError("injected failure")
+        return original_text_hash(text)
+
+    process_and_analyze_data.text_hash = failing_text_hash
+    process_and_analyze_data.calculate_relevance_score_cached = lambda text, default=1: (8, False)
+    results = []
+    try:
+        worker = threading.Thread(
+            target=lambda: results.append(
+                process_files_and_analyze_data(files, {"unknown row": 5})
+            ),
+            daemon=True,
+        )
+        worker.start()
+        worker.join(timeout=120)
+    finally:
+        process_and_analyze_data.text_hash = original_text_hash
+        process_and_analyze_data.calculate_relevance_score_cached = original_score
+
+    assert not worker.is_alive(), "Pipeline did not finish after a filtering failure"
+    analyzed_data, errors, stats = results[0]
+    assert any("injected failure" in error for error in errors), errors
+    assert {task["file"] for task in analyzed_data} == {f"file_{i}.xlsx" for i in range(1, file_count)}
+    logger.info(f"Filter stage failure handled: {len(analyzed_data)} tasks, errors: {errors}")
 
 if __name__ == "__main__":
+    test_filter_stage_failure()
     test_process_files()
@@ -0,0 +1,185 @@
+# text_filter.py
+
+import re
+
+import numpy as np
+
+# Constants
+EXCLUDE_KEYWORDS = {
+    "unnamed",
+    "phụ biểu",
+    "tạm tính",
+    "xã",
+    "huyện",
+    "tỉnh",
+    "quận",
+    "tổng cộng",
+    "stt",
+}
+KEYWORDS_TO_EXCLUDE = {
+    "chỉ tiêu",
+    "nội dung",
+    "nhiệm vụ",
+    "tổng số",
+    "dự toán chi",
+    "chỉ tiêu xác định dự toán",
+    "gồm",
+    "gồm:",
+    "nhiệm vụ ctx"
+}
+PREFIXES_TO_EXCLUDE = {"đơn vị tính:"}
+
+START_WORDS_TO_EXCLUDE = {
+    "nguyễn",
+    "trần",
+    "lê",
+    "hoàng",
+    "bùi",
+    "vũ",
+    "hà",
+    "lương",
+    "phạm",
+    "la",
+    "lự",
+    "bàn",
+    "triệu",
+    "ma",
+    "chu",
+    "vi",
+    "lý",
+    "ngô",
+    "đặng",
+    "sầm",
+    "nông",
+    "hứa",
+    "đỗ",
+    "dương",
+    "phùng",
+    "trương",
+    "vàng",
+    "sùng",
+    "vương",
+    "giàng",
+}
+
+# Reasons that are decided outside the combined regex
+NOT_TEXT = "not_text"
+TOO_SHORT = "too_short"
+EXACT_KEYWORD = "exact_keyword"
+
+
+def trie_pattern(words):
+    """
+    Build a regex alternation from a prefix trie of `words`, so that shared
+    prefixes ("nhiệm vụ", "nhiệm vụ ctx") are matched once instead of trying
+    every word in turn.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word.lower():
+            node = node.setdefault(char, {})
+        node[""] = {}  # End of word marker
+    return _trie_node_pattern(trie)
+
+
+def _trie_node_pattern(node):
+    branches = [
+        re.escape(char) + _trie_node_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    pattern = "(?:" + "|".join(branches) + ")"
+    return pattern + "?" if "" in node else pattern
+
+
+# Prefix rules, all anchored at the start of the stripped, lower-cased text
+RULE_PATTERNS = {
+    "money": r"\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2})?$",
+    "number": r"-?\d+[.,]?\d*$",
+    "separator": r":?-----",
+    "excluded_keyword": trie_pattern(EXCLUDE_KEYWORDS),
+    "excluded_prefix": trie_pattern(PREFIXES_TO_EXCLUDE),
+    "person_name": trie_pattern(START_WORDS_TO_EXCLUDE) + r"\b(?:\s+\w+){1,3}$",
+}
+
+
+class TextFilter:
+    """
+    Precompiled classifier for cell texts.
+
+    The prefix rules are merged into a single anchored regex with one named
+    group per rule, exact keywords are kept in a set, and each text is
+    stripped and lower-cased once. `reason` returns the name of the first
+    rule that rejects a text, or None when the text is kept.
+    """
+
+    def __init__(self, rules, min_length=0, exact_keywords=()):
+        self.rules = tuple(rules)
+        self.min_length = min_length
+        self.exact_keywords = frozenset(keyword.lower() for keyword in exact_keywords)
+        alternatives = [f"(?P<{rule}>{RULE_PATTERNS[rule]})" for rule in self.rules]
+        self.pattern = re.compile("(?:" + "|".join(alternatives) + ")") if alternatives else None
+
+    def reason(self, text):
+        """Return why `text` is rejected, or None if it passes every rule."""
+        if not isinstance(text, str):
+            return NOT_TEXT
+
+        text = text.strip()
+        if len(text) < self.min_length:
+            return TOO_SHORT
+
+        lowered = text.lower()
+        if lowered in self.exact_keywords:
+            return EXACT_KEYWORD
+
+        if self.pattern is not None:
+            match = self.pattern.match(lowered)
+            if match:
+                return match.lastgroup
+
+        return None
+
+    def reasons(self, texts):
+        """
+        Classify a whole column in one pass. Repeated cells are classified once.
+        Returns a list with one reason (or None) per text.
+        """
+        memo = {}
+        reason = self.reason
+        result = []
+        for text in texts:
+            try:
+                text_reason = memo[text]
+            except KeyError:
+                text_reason = memo[text] = reason(text)
+            except TypeError:  # Unhashable cell value
+                text_reason = reason(text)
+            result.append(text_reason)
+        return result
+
+    def mask(self, values):
+        """Return a boolean array of the same shape as `values` marking kept cells."""
+        values = np.asarray(values, dtype=object)
+        reasons = self.reasons(values.ravel())
+        return np.fromiter(
+            (text_reason is None for text_reason in reasons), dtype=bool, count=len(reasons)
+        ).reshape(values.shape)
+
+
+# Rules applied to every extracted cell when choosing the task column
+VALID_TEXT_FILTER = TextFilter(
+    ("money", "number", "separator", "excluded_keyword"), min_length=5
+)
+
+# Rules applied to the texts of the chosen column before scoring; they have
+# already passed VALID_TEXT_FILTER, so its rules are not repeated here
+TASK_TEXT_FILTER = TextFilter(
+    ("excluded_prefix", "person_name"),
+    exact_keywords=KEYWORDS_TO_EXCLUDE,
+)
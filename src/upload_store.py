@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Uploads are kept on local disk so a preview can be followed by a full run
+# without sending the files again; all gunicorn workers of a node share it.
+UPLOAD_STORE_DIR = os.getenv(
+    "UPLOAD_STORE_DIR", os.path.join(tempfile.gettempdir(), "bumas_uploads")
+)
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", 3600))  # 1 hour
+UPLOAD_KEY_LENGTH = 32
+# Chunked uploads (see create_chunked_upload) may exceed the request size
+# limit; set UPLOAD_STORE_DIR to /dev/shm to spool them to memory instead
+UPLOAD_MAX_FILE_SIZE = int(os.getenv("UPLOAD_MAX_FILE_SIZE", 200 * 1024 * 1024))
+UPLOAD_COPY_BLOCK_SIZE = 1024 * 1024
+MANIFEST_NAME = "manifest.json"
+PART_SUFFIX = ".part"
+
+
+def upload_dir(upload_key):
+    """
+    Return the directory of an upload, or None if the key is malformed.
+
+    :param upload_key: Key returned by save_uploads.
+    """
+    if not upload_key or len(upload_key) != UPLOAD_KEY_LENGTH or not upload_key.isalnum():
+        return None
+    return os.path.join(UPLOAD_STORE_DIR, upload_key)
+
+
+def purge_expired_uploads():
+    """Delete uploads older than UPLOAD_TTL."""
+    if not os.path.isdir(UPLOAD_STORE_DIR):
+        return
+    expiry = time.time() - UPLOAD_TTL
+    for entry in os.scandir(UPLOAD_STORE_DIR):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < expiry:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                logger.debug(f"Purged expired upload {entry.name}")
+        except FileNotFoundError:
+            continue
+
+
+def save_uploads(files):
+    """
+    Store uploaded files on disk and rewind them so they can still be read.
+
+    :param files: List of FileStorage objects.
+    :return: Upload key to pass to load_uploads.
+    """
+    purge_expired_uploads()
+
+    upload_key = uuid.uuid4().hex
+    directory = upload_dir(upload_key)
+    os.makedirs(directory)
+
+    for index, file in enumerate(files):
+        if not file or not file.filename:
+            continue
+        filename = secure_filename(file.filename)
+        # The index prefix keeps the upload order and allows duplicate names
+        file.save(os.path.join(directory, f"{index:03d}_{filename}"))
+        file.stream.seek(0)
+
+    logger.debug(f"Stored {len(files)} file(s) under upload key {upload_key}")
+    return upload_key
+
+
+def load_uploads(upload_key):
+    """
+    Open the files of a stored upload.
+
+    :param upload_key: Key returned by save_uploads.
+    :return: List of FileStorage objects (the caller closes them), or None if
+             the upload does not exist or has expired.
+    """
+    directory = upload_dir(upload_key)
+    if directory is None or not os.path.isdir(directory):
+        return None
+
+    files = []
+    for name in sorted(os.listdir(directory)):
+        if name == MANIFEST_NAME or name.endswith(PART_SUFFIX):
+            continue
+        filename = name.split("_", 1)[1] if "_" in name else name
+        files.append(
+            FileStorage(stream=open(os.path.join(directory, name), "rb"), filename=filename)
+        )
+    # Keep a reused upload alive for another UPLOAD_TTL
+    os.utime(directory)
+    return files
+
+
+def read_manifest(directory):
+    """Return the manifest of a chunked upload, or None for a plain upload."""
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(directory, manifest):
+    """Replace the manifest of a chunked upload atomically."""
+    tmp_path = os.path.join(directory, f"{MANIFEST_NAME}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_NAME))
+
+
+@contextmanager
+def locked_upload(directory, shared=False):
+    """
+    Hold a lock on an upload directory, shared by all gunicorn workers.
+    Chunks of different files are appended under shared locks; creating a
+    file and completing the upload need the exclusive lock.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def create_chunked_upload(filename, size, upload_key=None):
+    """
+    Reserve a file of `size` bytes that will be sent in chunks. A new upload is
+    created, or the file is added to an existing, incomplete one.
+
+    :param filename: Original file name.
+    :param size: Total size of the file in bytes.
+    :param upload_key: Upload to add the file to, if any.
+    :return: Tuple of (upload_key, file_index).
+    :raises ValueError: If the name, size or upload key is not acceptable.
+    """
+    filename = secure_filename(filename or "")
+    if not filename:
+        raise ValueError("Invalid filename")
+    if not 0 < size <= UPLOAD_MAX_FILE_SIZE:
+        raise ValueError(f"File size must be between 1 and {UPLOAD_MAX_FILE_SIZE} bytes")
+
+    if upload_key is None:
+        purge_expired_uploads()
+        upload_key = uuid.uuid4().hex
+        os.makedirs(upload_dir(upload_key))
+        write_manifest(upload_dir(upload_key), {"complete": False, "files": []})
+
+    directory = upload_dir(upload_key)
+    if directory is None or not os.path.isdir(directory):
+        raise ValueError("Upload not found or expired")
+
+    with locked_upload(directory):
+        manifest = read_manifest(directory)
+        if manifest is None:
+            raise ValueError("Upload was not created in chunks")
+        if manifest["complete"]:
+            raise ValueError("Upload is already complete")
+        file_index = len(manifest["files"])
+        name = f"{file_index:03d}_{filename}"
+        open(os.path.join(directory, name + PART_SUFFIX), "wb").close()
+        manifest["files"].append({"name": name, "filename": filename, "size": size})
+        write_manifest(directory, manifest)
+
+    logger.debug(f"Reserved {filename} ({size} bytes) as file {file_index} of upload {upload_key}")
+    return upload_key, file_index
+
+
+def append_chunk(upload_key, file_index, offset, stream):
+    """
+    Append a chunk read from `stream` to a file of a chunked upload, copying it
+    block by block. The chunk is only accepted at the current end of the file,
+    so a client that lost a response resumes from the offset it is given back.
+
+    :return: Tuple of (accepted, offset) where offset is the size received so far.
+    :raises ValueError: If the upload or file does not exist, or the chunk
+                        goes past the declared size.
+    """
+    directory = upload_dir(upload_key)
+    if directory is None or not os.path.isdir(directory):
+        raise ValueError("Upload not found or expired")
+
+    # complete_upload renames the parts under the exclusive lock, so the
+    # manifest read here stays valid until the chunk is written
+    with locked_upload(directory, shared=True):
+        accepted, received = append_chunk_locked(directory, file_index, offset, stream)
+
+    # Keep an upload that is still receiving data alive
+    os.utime(directory)
+    return accepted, received
+
+
+def append_chunk_locked(directory, file_index, offset, stream):
+    """Append a chunk to a file of an upload whose directory lock is held, see append_chunk."""
+    manifest = read_manifest(directory)
+    if manifest is None or not 0 <= file_index < len(manifest["files"]):
+        raise ValueError("Upload not found or expired")
+    if manifest["complete"]:
+        raise ValueError("Upload is already complete")
+
+    entry = manifest["files"][file_index]
+    # Opened without O_CREAT, a part file is never recreated
+    with open(os.path.join(directory, entry["name"] + PART_SUFFIX), "r+b") as part_file:
+        fcntl.flock(part_file, fcntl.LOCK_EX)
+        received = part_file.seek(0, os.SEEK_END)
+        if offset != received:
+            return False, received
+
+        remaining = entry["size"] - received
+        while True:
+            block = stream.read(min(UPLOAD_COPY_BLOCK_SIZE, remaining + 1))
+            if not block:
+                break
+            if len(block) > remaining:
+                # Keep the data that fits, so the client sees where it overflowed
+                part_file.write(block[:remaining])
+                part_file.truncate(entry["size"])
+                raise ValueError(f"Chunk goes past the declared size of {entry['size']} bytes")
+            part_file.write(block)
+            remaining -= len(block)
+        part_file.flush()
+        received = entry["size"] - remaining
+
+    return True, received
+
+
+def upload_status(upload_key):
+    """
+    Report the progress of a chunked upload.
+
+    :return: {"upload_key", "complete", "files": [{"file_index", "filename",
+             "size", "received"}]}, or None if the upload does not exist.
+    """
+    directory = upload_dir(upload_key)
+    manifest = read_manifest(directory) if directory and os.path.isdir(directory) else None
+    if manifest is None:
+        return None
+
+    files = []
+    for file_index, entry in enumerate(manifest["files"]):
+        path = os.path.join(directory, entry["name"])
+        if not manifest["complete"]:
+            path += PART_SUFFIX
+        try:
+            received = os.path.getsize(path)
+        except FileNotFoundError:
+            received = 0
+        files.append(
+            {
+                "file_index": file_index,
+                "filename": entry["filename"],
+                "size": entry["size"],
+                "received": received,
+            }
+        )
+    return {"upload_key": upload_key, "complete": manifest["complete"], "files": files}
+
+
+def complete_upload(upload_key):
+    """
+    Mark a chunked upload as complete once every file is fully received, after
+    which load_uploads returns its files.
+
+    :return: Upload status, see upload_status.
+    :raises ValueError: If the upload does not exist or a file is incomplete.
+    """
+    status = upload_status(upload_key)
+    if status is None:
+        raise ValueError("Upload not found or expired")
+    if status["complete"]:
+        return status
+    if not status["files"]:
+        raise ValueError("Upload has no files")
+
+    incomplete = [file["filename"] for file in status["files"] if file["received"] != file["size"]]
+    if incomplete:
+        raise ValueError(f"Files not fully received: {', '.join(incomplete)}")
+
+    directory = upload_dir(upload_key)
+    with locked_upload(directory):
+        manifest = read_manifest(directory)
+        for entry in manifest["files"]:
+            part_path = os.path.join(directory, entry["name"] + PART_SUFFIX)
+            if os.path.exists(part_path):
+                os.replace(part_path, os.path.join(directory, entry["name"]))
+        manifest["complete"] = True
+        write_manifest(directory, manifest)
+
+    logger.debug(f"Chunked upload {upload_key} complete with {len(manifest['files'])} file(s)")
+    return upload_status(upload_key)
@@ -0,0 +1,96 @@
+import re
+import zlib
+
+import numpy as np
+
+from utils.text_utils import canonical_text
+
+# Số nguyên tố Mersenne 2^31 - 1: tích với hệ số băm vẫn nằm trong int64
+MERSENNE_PRIME = (1 << 31) - 1
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]+")
+
+
+class NearDuplicateIndex:
+    """
+    Gom các văn bản trùng hoặc gần trùng thành cụm, để mỗi cụm chỉ chấm điểm
+    một lần. Văn bản trùng sau khi chuẩn hóa (canonical_text) vào cùng cụm
+    ngay; các văn bản khác được so bằng MinHash trên n-gram ký tự, tìm ứng viên
+    qua LSH (chia chữ ký thành các band) rồi kiểm tra độ tương đồng ước lượng.
+    Văn bản đầu tiên của mỗi cụm là đại diện.
+    """
+
+    def __init__(self, threshold=1.0, ngram=3, num_perm=64, bands=16, seed=1):
+        """
+        Args:
+        - threshold: Độ tương đồng Jaccard ước lượng tối thiểu để gộp; >= 1 chỉ gộp văn bản trùng.
+        - ngram: Độ dài n-gram ký tự.
+        - num_perm: Số hàm băm của chữ ký MinHash.
+        - bands: Số band LSH; num_perm phải chia hết cho bands.
+        - seed: Hạt giống của các hàm băm.
+        """
+        rng = np.random.default_rng(seed)
+        self.threshold = threshold
+        self.ngram = ngram
+        self.rows = num_perm // bands
+        self._a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.int64)
+        self._b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.int64)
+        self._clusters = {}  # Văn bản chuẩn hóa -> cụm
+        self._signatures = []  # Chữ ký của đại diện mỗi cụm
+        self._buckets = [{} for _ in range(bands)]
+
+    def signature(self, text):
+        """Chữ ký MinHash của tập n-gram ký tự của một văn bản đã chuẩn hóa, bỏ qua dấu câu."""
+        text = " ".join(PUNCTUATION_PATTERN.sub(" ", text).split())
+        shingles = {text[i:i + self.ngram] for i in range(max(1, len(text) - self.ngram + 1))}
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) % MERSENNE_PRIME for shingle in shingles),
+            dtype=np.int64,
+            count=len(shingles),
+        )
+        return ((np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME).min(axis=0)
+
+    def band_keys(self, signature):
+        """Khóa của chữ ký trong từng band LSH."""
+        return [
+            signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            for band in range(len(self._buckets))
+        ]
+
+    def add(self, text):
+        """
+        Xếp một văn bản vào cụm.
+
+        Returns:
+        - Tuple (cluster, is_new): số thứ tự cụm và True nếu văn bản là đại diện của một cụm mới.
+        """
+        key = canonical_text(text)
+        if key in self._clusters:
+            return self._clusters[key], False
+
+        cluster = None
+        signature = None
+        if self.threshold < 1:
+            signature = self.signature(key)
+            band_keys = self.band_keys(signature)
+            candidates = {
+                candidate
+                for bucket, band_key in zip(self._buckets, band_keys)
+                for candidate in bucket.get(band_key, ())
+            }
+            best_similarity = self.threshold
+            for candidate in sorted(candidates):
+                similarity = float(np.mean(self._signatures[candidate] == signature))
+                if similarity >= best_similarity:
+                    cluster, best_similarity = candidate, similarity
+
+        if cluster is not None:
+            self._clusters[key] = cluster
+            return cluster, False
+
+        cluster = len(self._signatures)
+        self._clusters[key] = cluster
+        self._signatures.append(signature)
+        if signature is not None:
+            for bucket, band_key in zip(self._buckets, band_keys):
+                bucket.setdefault(band_key, []).append(cluster)
+        return cluster, True
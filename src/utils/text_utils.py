@@ -0,0 +1,47 @@
+import re
+import hashlib
+import unicodedata
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+TRAILING_PUNCTUATION = ".,;:!?…-–*"
+
+
+def normalize_text(text):
+    """
+    Chuẩn hóa văn bản trước khi so sánh: Unicode NFC, gộp khoảng trắng, chữ thường.
+
+    Args:
+    - text: Chuỗi cần chuẩn hóa.
+
+    Returns:
+    - Chuỗi đã chuẩn hóa.
+    """
+    text = unicodedata.normalize("NFC", str(text))
+    return WHITESPACE_PATTERN.sub(" ", text).strip().lower()
+
+
+def canonical_text(text):
+    """
+    Dạng chuẩn để nhận ra các văn bản trùng nhau: chuẩn hóa như normalize_text
+    và bỏ dấu câu ở cuối (ví dụ "Chi thường xuyên." và "chi thường xuyên").
+
+    Args:
+    - text: Chuỗi cần chuẩn hóa.
+
+    Returns:
+    - Chuỗi đã chuẩn hóa.
+    """
+    return normalize_text(text).rstrip(TRAILING_PUNCTUATION + " ")
+
+
+def text_hash(text):
+    """
+    Hash (sha1) của văn bản sau khi chuẩn hóa, dùng để nhận ra một dòng đã được chấm điểm.
+
+    Args:
+    - text: Chuỗi cần hash.
+
+    Returns:
+    - Chuỗi hex sha1.
+    """
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()